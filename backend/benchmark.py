@@ -0,0 +1,145 @@
+"""
+Micro-benchmarks for the London protocol codec, run with
+python benchmark.py
+"""
+import random
+import timeit
+
+from soundweb_proto import *
+
+
+# original byte -> escaped sequence, and escaped byte -> original byte (None if not a substitution)
+escape_table = [bytes([c]) for c in range(256)]
+unescape_table = [None] * 256
+for k, v in byte_substitution.items():
+    escape_table[k[0]] = byte_substitution_prefix + v
+    unescape_table[v[0]] = k[0]
+
+
+def encode_loop(body, out):
+    # the per byte table loop encode_frame replaced
+    out.append(0x02)
+    chksm = 0
+    for c in body:
+        chksm ^= c
+        out += escape_table[c]
+    out += escape_table[chksm]
+    out.append(0x03)
+    return out
+
+
+def unescape_loop(data):
+    # the per byte loop unescape_body replaced
+    body = bytearray()
+    x = 0
+    escaped = False
+    for c in data:
+        if escaped:
+            escaped = False
+            u = unescape_table[c]
+            if u is None: # not a substitution, keep the prefix
+                x ^= byte_substitution_prefix[0]
+                body += byte_substitution_prefix
+            else:
+                c = u
+        elif c == byte_substitution_prefix[0]:
+            escaped = True
+            continue
+        x ^= c
+        body.append(c)
+    if escaped: # trailing prefix byte
+        x ^= byte_substitution_prefix[0]
+        body += byte_substitution_prefix
+    return body, x
+
+
+def decode_packets_baseline(msg: bytes):
+    # decode_packets before PacketDecoder, as it was
+    packets = []
+    pkt_msg = b''
+    while msg:
+        if msg[:1] == 0x02:
+            pkt_msg = b'' # start of message nyte
+        pkt_msg += msg[:1] # take next byte
+        msg = msg[1:]
+        if pkt_msg[-1] == 0x03:
+            try:
+                packets.append(Packet.decode(pkt_msg))
+            except InvalidChecksum as ex:
+                print(ex, flush=True)
+            # clear packet so it doesn't get returned as remaining
+            pkt_msg = b''
+    return packets, pkt_msg # return remaining bytes
+
+
+def meter_packets(count):
+    # meter SETs as a node sends them, values in 1/10000 dB
+    random.seed(1)
+    return [Packet(MessageType.SET, node=random.randrange(1, 4), v_device=3, obj_id=random.randrange(0x100, 0x200),
+        param_id=random.randrange(64), value=random.randrange(-1000000, 0)) for _ in range(count)]
+
+
+def best_of(fn, number, repeat=5):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def benchmark_unescape():
+    print("Unescape 20000 frame bodies:")
+    bodies = [p.encode()[1:-1] for p in meter_packets(20000)]
+    for body in bodies:
+        expected, x = unescape_loop(body)
+        assert unescape_body(body) == (bytes(expected), x)
+    old = best_of(lambda: [unescape_loop(body) for body in bodies], 1, repeat=20)
+    new = best_of(lambda: [unescape_body(body) for body in bodies], 1, repeat=20)
+    print(f"  per byte loop {old * 1e3:6.1f} ms, bytes.replace {new * 1e3:6.1f} ms ({old / new:.1f}x)")
+
+
+def benchmark_encode():
+    print("Encode 20000 frame bodies:")
+    bodies = [packet_codecs[p.message_type][0](p) for p in meter_packets(20000)]
+    for body in bodies:
+        assert encode_frame(body) == encode_loop(body, bytearray())
+    old = best_of(lambda: [encode_loop(body, bytearray()) for body in bodies], 1, repeat=20)
+    new = best_of(lambda: [encode_frame(body) for body in bodies], 1, repeat=20)
+    print(f"  per byte loop {old * 1e3:6.1f} ms, bytes.replace {new * 1e3:6.1f} ms ({old / new:.1f}x)")
+
+
+def benchmark_frames():
+    # about 1 MB of SET frames, as the node's socket hands them over
+    packets = meter_packets(62000)
+    stream = b''.join(p.encode() for p in packets)
+    print(f"Decode {len(packets)} SET frames, {len(stream) / 1e6:.2f} MB:")
+    # a read per segment, and larger reads when the socket has been backlogged
+    for read_size in (1460, 16384, 65536):
+        reads = [stream[i:i+read_size] for i in range(0, len(stream), read_size)]
+
+        def old():
+            # data_received before PacketDecoder
+            decoded, remaining = [], b''
+            for data in reads:
+                new_packets, remaining = decode_packets_baseline(remaining + data)
+                decoded += new_packets
+            return decoded
+
+        def new():
+            decoder = PacketDecoder()
+            decoded = []
+            for data in reads:
+                decoded += decoder.feed(data)
+            return decoded
+
+        assert new() == packets
+        # the baseline is quadratic in the read size, so it is only timed once
+        start = timeit.default_timer()
+        assert old() == packets
+        old_t = timeit.default_timer() - start
+        new_t = best_of(new, 1)
+        print(f"  {read_size:>5} byte reads: decode_packets {old_t * 1e3:8.1f} ms, PacketDecoder {new_t * 1e3:6.1f} ms ({old_t / new_t:.0f}x)")
+    # an empty frame and an unknown message type are skipped, the next frame still decodes
+    assert PacketDecoder().feed(b'\x02\x03\x02\x00\x00\x03' + stream[:1460])[:1] == packets[:1]
+
+
+if __name__ == "__main__":
+    benchmark_frames()
+    benchmark_encode()
+    benchmark_unescape()
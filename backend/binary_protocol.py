@@ -0,0 +1,58 @@
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from pending_updates import PendingUpdates
+
+# a parameter update: (index in the session's table, value), big endian
+RECORD = struct.Struct(">Hi")
+MAX_INDEX = 0xffff
+INT32_MIN = -2**31
+INT32_MAX = 2**31 - 1
+
+class BinarySession:
+    """
+    The parameter index table and pending update records for a websocket client
+    with the binary option. An index is assigned the first time the client subscribes
+    to a (message type, parameter) and kept until it disconnects, so the table entry
+    only has to be sent once.
+    """
+    def __init__(self, client: dict, interval: float):
+        self.client = client
+        # (message type, parameter string) -> index
+        self.indices: Dict[Tuple[str, str], int] = {}
+        # index -> (message type, parameter string)
+        self.params: List[Tuple[str, str]] = []
+        # packed records waiting for the batch thread, by (message type, parameter string)
+        self.pending = PendingUpdates(interval)
+
+    def add(self, msg_type: str, parameter: str) -> Optional[int]:
+        """ Assign an index, returns None if it already has one or the table is full """
+        key = (msg_type, parameter)
+        if key in self.indices or len(self.params) > MAX_INDEX:
+            return None
+        index = self.indices[key] = len(self.params)
+        self.params.append(key)
+        return index
+
+    def pack(self, msg: dict) -> Optional[bytes]:
+        """ Record for a message, or None if it can't be sent as one """
+        index = self.indices.get((msg["type"], msg["parameter"]))
+        value = msg["value"]
+        if index is None or type(value) != int or value < INT32_MIN or value > INT32_MAX:
+            return None
+        return RECORD.pack(index, value)
+
+    def take(self) -> bytes:
+        """ Join the records pending so far into one message """
+        return b"".join(self.pending.take())
+
+    def unpack(self, data: bytes) -> List[dict]:
+        """ Json messages for the records sent by the client, unknown indices are skipped """
+        if len(data) % RECORD.size != 0:
+            raise ValueError(f"Binary message length {len(data)} is not a multiple of {RECORD.size}")
+        msgs = []
+        for index, value in RECORD.iter_unpack(data):
+            if index < len(self.params):
+                msg_type, parameter = self.params[index]
+                msgs.append({"type": msg_type, "parameter": parameter, "value": value})
+        return msgs
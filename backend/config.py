@@ -8,6 +8,14 @@ def default_config() -> Dict[str, Any]:
         "subscription_rate_ms": 100,
         "sync_thread_timeout_s": 60*10,
         "websocket_port": 8765,
+        "shared_event_loop": False,
+        "batch_window_ms": 20,
+        "websocket_engine": "threaded",
+        "websocket_deflate": False,
+        "websocket_deflate_window_bits": 15,
+        "websocket_deflate_level": 6,
+        "deadband": {"SET": 0},
+        "deadband_parameters": {},
         "authTokenSecret": "different_password_at_least_32_characters_long"
     }
 
@@ -20,6 +28,9 @@ def check_dict_type(d: dict, k_type, v_type) -> bool:
 def check_range(v: int, min_v: int, max_v: int):
     return isinstance(v, int) and v >= min_v and v <= max_v
 
+def check_deadbands(d: dict) -> bool:
+    return check_dict_type(d, str, int) and all(v >= 0 for v in d.values())
+
 def invalid_message(key):
     print(f"Invalid value for {key} in config")
 
@@ -56,6 +67,38 @@ def load_config(config_filename: str = "config.json", disable_save = False) -> d
         invalid_message("sync_thread_timeout_s")
         config["sync_thread_timeout_s"] = default_config()["sync_thread_timeout_s"]
         save_config = True
+    if "shared_event_loop" not in config or not isinstance(config["shared_event_loop"], bool):
+        invalid_message("shared_event_loop")
+        config["shared_event_loop"] = default_config()["shared_event_loop"]
+        save_config = True
+    if "batch_window_ms" not in config or not check_range(config["batch_window_ms"], 1, 1000):
+        invalid_message("batch_window_ms")
+        config["batch_window_ms"] = default_config()["batch_window_ms"]
+        save_config = True
+    if "websocket_engine" not in config or config["websocket_engine"] not in ("threaded", "asyncio"):
+        invalid_message("websocket_engine")
+        config["websocket_engine"] = default_config()["websocket_engine"]
+        save_config = True
+    if "websocket_deflate" not in config or not isinstance(config["websocket_deflate"], bool):
+        invalid_message("websocket_deflate")
+        config["websocket_deflate"] = default_config()["websocket_deflate"]
+        save_config = True
+    if "websocket_deflate_window_bits" not in config or not check_range(config["websocket_deflate_window_bits"], 9, 15):
+        invalid_message("websocket_deflate_window_bits")
+        config["websocket_deflate_window_bits"] = default_config()["websocket_deflate_window_bits"]
+        save_config = True
+    if "websocket_deflate_level" not in config or not check_range(config["websocket_deflate_level"], 0, 9):
+        invalid_message("websocket_deflate_level")
+        config["websocket_deflate_level"] = default_config()["websocket_deflate_level"]
+        save_config = True
+    if "deadband" not in config or not check_deadbands(config["deadband"]):
+        invalid_message("deadband")
+        config["deadband"] = default_config()["deadband"]
+        save_config = True
+    if "deadband_parameters" not in config or not check_deadbands(config["deadband_parameters"]):
+        invalid_message("deadband_parameters")
+        config["deadband_parameters"] = default_config()["deadband_parameters"]
+        save_config = True
     if save_config and not disable_save:
         print(f"Modified config saved as {config_filename}")
         with open(config_filename, "w") as f:
@@ -0,0 +1,41 @@
+from typing import Any, Hashable, List
+
+class PendingUpdates:
+    """
+    The latest message for each parameter waiting to be sent to a client,
+    flushed at the client's own rate. A parameter that changes several times
+    between flushes is only sent once, with its latest value, so what a client
+    is sent is bounded by its rate rather than by how fast the nodes send values.
+    Any number of broadcast threads can put while one thread takes.
+    """
+    def __init__(self, interval: float):
+        # seconds between flushes
+        self.interval = interval
+        self.next_flush = 0.0
+        self.messages = {}
+        # messages replaced by a newer value before they were sent
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, key: Hashable, message: Any):
+        if key in self.messages:
+            self.coalesced += 1
+        self.messages[key] = message
+
+    def due(self, t: float) -> bool:
+        """ Check if it is time to flush, starting the next interval if it is """
+        if t < self.next_flush:
+            return False
+        self.next_flush += self.interval
+        if self.next_flush < t:
+            # don't try to catch up on missed flushes
+            self.next_flush = t + self.interval
+        return True
+
+    def take(self) -> List[Any]:
+        """ Remove and return the pending messages, oldest parameter first """
+        # a put after its key is popped is left for the next take
+        messages = self.messages
+        return [messages.pop(key) for key in list(messages)]
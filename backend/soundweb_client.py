@@ -3,20 +3,13 @@ from contextlib import suppress
 from janus import Queue, SyncQueue, SyncQueueEmpty
 import janus
 
-from soundweb_proto import MessageType, Packet, meter_value_db, decode_packets
+from soundweb_proto import MessageType, Packet, PacketDecoder, meter_value_db
+from subscriptions import SubscriptionRegistry
 
 # self.send(b'\x02\xff\x03')
 
-def run_in_executor(f):
-    @functools.wraps(f)
-    def inner(*args, **kwargs):
-        loop = asyncio.get_running_loop()
-        return loop.run_in_executor(None, lambda: f(*args, **kwargs))
-
-    return inner
-
 class SoundWebClientProtocol(asyncio.Protocol):
-    def __init__(self, name: str, h_id: str, msg_queue: SyncQueue, resp_queue: SyncQueue, subscribed_params: list, health_queue: SyncQueue, loop):
+    def __init__(self, name: str, h_id: str, msg_queue: Queue, resp_queue: SyncQueue, subscribed_params: SubscriptionRegistry, health_queue: SyncQueue, queue_loop, loop):
         self.name = name
         self.h_id = h_id
         self.msg_queue = msg_queue
@@ -24,36 +17,56 @@ class SoundWebClientProtocol(asyncio.Protocol):
         self.subscribed_params = subscribed_params
         self.health_queue = health_queue
         self._ready = asyncio.Event()
+        self.queue_loop = queue_loop
         self.loop = loop
         self.send_task = loop.create_task(self.send_messages())
         self.transport = None
-        self.read_buffer = b""
+        self.decoder = PacketDecoder()
         self.last_time = 0
+        self.disconnected = False
 
     def end_connection(self):
         self.send_task.cancel()
 
-    @run_in_executor
-    def get_next_message(self):  # Your wrapper for async use
-        if self.msg_queue.closed:
-            self.end_connection()
-            return
-        try:
-            return self.msg_queue.get(timeout=1)
-        except SyncQueueEmpty:
-            pass
+    async def get_next_message(self):
+        """ Wait on the async side of the message queue, which lives on the main loop """
+        fut = asyncio.run_coroutine_threadsafe(self.msg_queue.async_q.get(), self.queue_loop)
+        return await asyncio.wrap_future(fut)
+
+    def get_queued_messages(self):
+        """ Take everything else that is currently queued without blocking """
+        packets = []
+        while True:
+            try:
+                packets.append(self.msg_queue.sync_q.get_nowait())
+            except SyncQueueEmpty:
+                return packets
+
+    def encode_messages(self, packets):
+        """ Encode packets into a single buffer so they go out in one write """
+        data = bytearray()
+        for p in packets:
+            try:
+                p.encode_into(data)
+            except (AssertionError, OverflowError) as ex:
+                print(self.name, "Error Encoding Message:", ex, flush=True)
+        return data
 
     async def send_messages(self):
         """ Send messages to the server as they become available. """
         await self._ready.wait()
         while True:
-            p = await self.get_next_message()
-            if p:
-                # print("O", p, flush=True)
-                self.transport.write(p.encode())
-                # Only start timeout once we have at least 1 subscription
-                if p.message_type in [MessageType.SUBSCRIBE, MessageType.SUBSCRIBE_PERCENT]:
-                    self.last_time = time.time()
+            if self.msg_queue.closed or self.queue_loop.is_closed():
+                return
+            packets = [await self.get_next_message()]
+            packets += self.get_queued_messages()
+            # print("O", packets, flush=True)
+            data = self.encode_messages(packets)
+            if data:
+                self.transport.write(data)
+            # Only start timeout once we have at least 1 subscription
+            if any(p.message_type in (MessageType.SUBSCRIBE, MessageType.SUBSCRIBE_PERCENT) for p in packets):
+                self.last_time = time.time()
 
     def connection_test_packet(self, transport):
         # this packet gives no response and doesn't make soundweb kill the connection
@@ -63,20 +76,19 @@ class SoundWebClientProtocol(asyncio.Protocol):
         print(self.name, "Connected", flush=True)
         self.health_queue.put({"id": self.h_id, "status": True})
         if self.subscribed_params:
-            for p in self.subscribed_params:
-                transport.write(p.encode())
+            transport.write(self.encode_messages(self.subscribed_params.packets()))
         # empty message queue to clear delayed commands (otherwise could cause unexpected changes on connection)
-        while (not self.msg_queue.closed) and (not self.msg_queue.empty()):
-            self.msg_queue.get(timeout=1)
+        if not self.msg_queue.closed:
+            self.get_queued_messages()
         self.transport = transport
         # clear read buffer
-        self.read_buffer = b""
+        self.decoder.reset()
         self._ready.set()
         
     def data_received(self, data):
         if not self.resp_queue:
             return
-        packets, self.read_buffer = decode_packets(self.read_buffer + data)
+        packets = self.decoder.feed(data)
         if packets:
             if self.last_time > 0: # Only reset timer if its started and we get correctly formed packets
                 self.last_time = time.time()
@@ -93,11 +105,13 @@ class SoundWebClientProtocol(asyncio.Protocol):
     def connection_lost(self, exc):
         print(self.name, "Connection Error:", exc, flush=True)
         self.end_connection()
-        self.loop.stop()
+        self.disconnected = True
 
-class SoundWebThread(threading.Thread):
-    def __init__(self, name: str, h_id: str, soundweb_ip: str, soundweb_port: int, msg_queue: Queue, resp_queue: Queue, subscribed_params: list, health_check_queue: Queue, sync_timeout_rate: int = 0):
-        super().__init__(daemon=True)
+class SoundWebConnection:
+    """ A connection to a single SoundWeb node, reconnecting until exitFlag is set """
+    def __init__(self, name: str, h_id: str, soundweb_ip: str, soundweb_port: int, msg_queue: Queue, resp_queue: Queue, subscribed_params: SubscriptionRegistry, health_check_queue: Queue, sync_timeout_rate: int = 0):
+        # janus queues are bound to the loop they were created on
+        self.queue_loop = asyncio.get_running_loop()
         self.name = name
         self.h_id = h_id
         self.soundweb_ip = soundweb_ip
@@ -110,60 +124,95 @@ class SoundWebThread(threading.Thread):
         self.exitFlag = False
         self.sync_timeout_rate = sync_timeout_rate
         self.fast_reconnect = False
+
+    async def connection_test(self, protocol: SoundWebClientProtocol, transport):
+        """ Check the connection is alive every 10 seconds """
+        while True:
+            await asyncio.sleep(10)
+            protocol.connection_test_packet(transport)
+
     async def createClient(self, loop):
-        if self.resp_queue:
-            transport, protocol = await loop.create_connection(
-                lambda: SoundWebClientProtocol(self.name, self.h_id,
-                    self.msg_queue.sync_q, self.resp_queue.sync_q,
-                    self.subscribed_params, self.health_queue.sync_q, loop),
-                self.soundweb_ip, self.soundweb_port)
-        else:
-            transport, protocol = await loop.create_connection(
-                lambda: SoundWebClientProtocol(self.name, self.h_id,
-                    self.msg_queue.sync_q, None,
-                    self.subscribed_params, self.health_queue.sync_q, loop),
-                self.soundweb_ip, self.soundweb_port)
-        n = 0
-        while not self.exitFlag:
+        resp_queue = self.resp_queue.sync_q if self.resp_queue else None
+        transport, protocol = await loop.create_connection(
+            lambda: SoundWebClientProtocol(self.name, self.h_id,
+                self.msg_queue, resp_queue,
+                self.subscribed_params, self.health_queue.sync_q, self.queue_loop, loop),
+            self.soundweb_ip, self.soundweb_port)
+        test_task = loop.create_task(self.connection_test(protocol, transport))
+        while not self.exitFlag and not protocol.disconnected:
             await asyncio.sleep(1)
-            n += 1  # check connection is alive every 10 seconds
-            if n >= 10:
-                n = 0
-                protocol.connection_test_packet(transport)
             # check how long since last message
             if self.sync_timeout_rate > 0 and protocol.last_time > 0:
                 if time.time() - protocol.last_time > self.sync_timeout_rate:
                     self.fast_reconnect = True
                     break
         transport.close()
-        # cancel send task
+        # cancel send and test tasks
         protocol.send_task.cancel()
-        try:
-            await protocol.send_task
-        except asyncio.CancelledError:
-            pass
-    def run(self):
+        test_task.cancel()
+        for task in [protocol.send_task, test_task]:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
         print(self.name, "started", flush=True)
+        loop = asyncio.get_running_loop()
         while not self.exitFlag:
             self.fast_reconnect = False
             try:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                client_task = loop.create_task(self.createClient(loop))
-                loop.run_until_complete(client_task)
-                loop.stop()
-                loop.close()
+                await self.createClient(loop)
             except Exception as ex:
                 print(self.name, "Error:", ex, flush=True)
-                self.health_queue.sync_q.put({"id": self.h_id, "status": False})
+            self.health_queue.sync_q.put({"id": self.h_id, "status": False})
             if not self.exitFlag:
                 if self.fast_reconnect:
                     print(self.name, "Subscription thread timeout, Reconnecting now", flush=True)
-                    time.sleep(0.5)
+                    await asyncio.sleep(0.5)
                 else:
                     print(self.name, "Disconnected from SoundWeb, Reconnecting in 5 seconds", flush=True)
                     for i in range(5):
                         if self.exitFlag:
                             break
-                        time.sleep(1)
-        print(self.name, "exited", flush=True)
\ No newline at end of file
+                        await asyncio.sleep(1)
+        print(self.name, "exited", flush=True)
+
+class SoundWebThread(threading.Thread):
+    """ Runs a single SoundWebConnection on its own event loop """
+    def __init__(self, *args, **kwargs):
+        super().__init__(daemon=True)
+        self.connection = SoundWebConnection(*args, **kwargs)
+        self.name = self.connection.name
+
+    @property
+    def exitFlag(self):
+        return self.connection.exitFlag
+
+    @exitFlag.setter
+    def exitFlag(self, value):
+        self.connection.exitFlag = value
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.connection.run())
+        loop.close()
+
+class SoundWebConnectionManager(threading.Thread):
+    """ Runs every SoundWebConnection as a task on one shared event loop """
+    def __init__(self, connections: list):
+        super().__init__(daemon=True)
+        self.name = "SoundWeb Connection Manager"
+        self.connections = connections
+
+    async def run_connections(self):
+        await asyncio.gather(*[c.run() for c in self.connections])
+
+    def run(self):
+        print(self.name, "started", flush=True)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.run_connections())
+        loop.close()
+        print(self.name, "exited", flush=True)
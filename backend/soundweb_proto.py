@@ -2,6 +2,7 @@ from enum import Enum
 from dataclasses import dataclass
 import binascii
 import re
+import struct
 
 class MessageType(Enum):
     SET = 0x88
@@ -29,33 +30,111 @@ byte_substitution = {
     b'\x1B': b'\x9B' # make sure this is last so we don't get a double substitution
 }
 
+# original byte -> escaped sequence, 1B first so the prefix bytes it adds aren't escaped again
+escape_pairs = [(k, byte_substitution_prefix + v) for k, v in reversed(byte_substitution.items())]
+# escaped sequence -> original byte, in the same order so 1B 9B is undone last
+unescape_pairs = [(byte_substitution_prefix + v, k) for k, v in byte_substitution.items()]
+
 def sub_body(body: bytes):
-    substituted = body
-    for k, v in reversed(byte_substitution.items()):
-        substituted = substituted.replace(k, byte_substitution_prefix + v)
+    substituted = bytes(body)
+    for original, escaped in escape_pairs:
+        substituted = substituted.replace(original, escaped)
     return substituted
 def unsub_body(sub_body: bytes):
-    body = sub_body
-    for k, v in byte_substitution.items():
-        body = body.replace(byte_substitution_prefix + v, k)
-    return body
+    return unescape_body(sub_body)[0]
 def calc_checksum(body: bytes):
     x = 0
     for c in body:
         x ^= c
     return x
-    
-@dataclass
+
+def encode_frame(body: bytes, out: bytearray = None):
+    """
+    Append body and its checksum to out as a byte stuffed STX/ETX frame,
+    the substitution is done with bytes.replace so it runs in C rather than per byte
+    """
+    if out is None:
+        out = bytearray()
+    out.append(0x02)
+    out += sub_body(body + bytes((calc_checksum(body),)))
+    out.append(0x03)
+    return out
+
+def unescape_body(data: bytes):
+    """
+    Undo the byte substitution with bytes.replace, the reverse of sub_body.
+    Returns the body and the xor of every byte in it (0 if the trailing checksum is valid)
+    """
+    body = bytes(data)
+    if byte_substitution_prefix in body:
+        for escaped, original in unescape_pairs:
+            body = body.replace(escaped, original)
+    return body, calc_checksum(body)
+
+# Precompiled body layouts, obj_id is 3 bytes so it is split into a high byte and low word
+ADDRESS_STRUCT = struct.Struct(">BHBBHH")
+ADDRESS_VALUE_STRUCT = struct.Struct(">BHBBHHi")
+ADDRESS_STRING_STRUCT = struct.Struct(">BHBBHHB")
+PRESET_STRUCT = struct.Struct(">BI")
+
+def encode_address(p: 'Packet'):
+    return ADDRESS_STRUCT.pack(p.message_type.value, p.node, p.v_device, p.obj_id >> 16, p.obj_id & 0xffff, p.param_id)
+def decode_address(p: 'Packet', body):
+    _, p.node, p.v_device, obj_hi, obj_lo, p.param_id = ADDRESS_STRUCT.unpack_from(body)
+    p.obj_id = (obj_hi << 16) | obj_lo
+
+def encode_address_value(p: 'Packet'):
+    return ADDRESS_VALUE_STRUCT.pack(p.message_type.value, p.node, p.v_device, p.obj_id >> 16, p.obj_id & 0xffff, p.param_id, p.value)
+def decode_address_value(p: 'Packet', body):
+    _, p.node, p.v_device, obj_hi, obj_lo, p.param_id, p.value = ADDRESS_VALUE_STRUCT.unpack_from(body)
+    p.obj_id = (obj_hi << 16) | obj_lo
+
+def encode_address_string(p: 'Packet'):
+    header = ADDRESS_STRING_STRUCT.pack(p.message_type.value, p.node, p.v_device, p.obj_id >> 16, p.obj_id & 0xffff, p.param_id, len(p.string_bytes))
+    return header + p.string_bytes + b'\x00' # null byte
+def decode_address_string(p: 'Packet', body):
+    _, p.node, p.v_device, obj_hi, obj_lo, p.param_id, str_len = ADDRESS_STRING_STRUCT.unpack_from(body)
+    p.obj_id = (obj_hi << 16) | obj_lo
+    p.string_bytes = bytes(body[10:10+str_len])
+    assert body[10+str_len] == 0, "String must end with 0x00"
+
+def encode_preset(p: 'Packet'):
+    return PRESET_STRUCT.pack(p.message_type.value, p.value)
+def decode_preset(p: 'Packet', body):
+    _, p.value = PRESET_STRUCT.unpack_from(body)
+
+# message type -> (body encoder, body decoder)
+packet_codecs = {
+    MessageType.SET: (encode_address_value, decode_address_value),
+    MessageType.SUBSCRIBE: (encode_address_value, decode_address_value),
+    MessageType.SUBSCRIBE_PERCENT: (encode_address_value, decode_address_value),
+    MessageType.BUMP_PERCENT: (encode_address_value, decode_address_value),
+    MessageType.SET_STRING: (encode_address_string, decode_address_string),
+    MessageType.UNSUBSCRIBE: (encode_address, decode_address),
+    MessageType.UNSUBSCRIBE_PERCENT: (encode_address, decode_address),
+    MessageType.RECALL_PRESET: (encode_preset, decode_preset),
+}
+
+@dataclass(init=False)
 class Packet:
+    # slotted to keep the per packet overhead down, as meter traffic decodes continuously
+    __slots__ = ("message_type", "node", "v_device", "obj_id", "param_id", "value", "string_bytes")
     message_type: MessageType
-    node: int = 0
-    v_device: int = 0
-    obj_id: int = 0
-    param_id: int = 0
-    value: int = 0
-    string_bytes: bytes = b''
-
-    def __post_init__(self):
+    node: int
+    v_device: int
+    obj_id: int
+    param_id: int
+    value: int
+    string_bytes: bytes
+
+    def __init__(self, message_type: MessageType, node: int = 0, v_device: int = 0, obj_id: int = 0, param_id: int = 0, value: int = 0, string_bytes: bytes = b''):
+        self.message_type = message_type
+        self.node = node
+        self.v_device = v_device
+        self.obj_id = obj_id
+        self.param_id = param_id
+        self.value = value
+        self.string_bytes = string_bytes
         assert len(self.string_bytes) <= 32, "String longer than 32 bytes"
 
     def __str__(self):
@@ -74,55 +153,38 @@ class Packet:
         return s + "}"
 
     def encode(self):
-        body = self.message_type.value.to_bytes(1, byteorder='big')
-        if self.message_type in (MessageType.SET, MessageType.SUBSCRIBE, MessageType.SUBSCRIBE_PERCENT, MessageType.BUMP_PERCENT,
-                MessageType.SET_STRING, MessageType.UNSUBSCRIBE, MessageType.UNSUBSCRIBE_PERCENT):
-            body += self.node.to_bytes(2, byteorder='big')
-            body += self.v_device.to_bytes(1, byteorder='big')
-            body += self.obj_id.to_bytes(3, byteorder='big')
-            body += self.param_id.to_bytes(2, byteorder='big')
-            if self.message_type in (MessageType.SET, MessageType.SUBSCRIBE, MessageType.SUBSCRIBE_PERCENT, MessageType.BUMP_PERCENT):
-                body += self.value.to_bytes(4, byteorder='big', signed=True)
-            elif self.message_type == MessageType.SET_STRING:
-                body += len(self.string_bytes).to_bytes(1, byteorder='big')
-                body += self.string_bytes
-                body += b'\x00' # null byte
-        elif self.message_type == MessageType.RECALL_PRESET:
-            body += self.value.to_bytes(4, byteorder='big')
-        else:
-            assert False, "Unknown Message Type: " + self.message_type
-        chksm = calc_checksum(body).to_bytes(1, byteorder='big')
-        msg = b'\x02' + sub_body(body + chksm) + b'\x03'
-        return msg
+        return bytes(self.encode_into(bytearray()))
+
+    def encode_into(self, out: bytearray):
+        """Append the encoded frame to out"""
+        codec = packet_codecs.get(self.message_type)
+        assert codec is not None, "Unknown Message Type: " + self.message_type.name
+        try:
+            body = codec[0](self)
+        except struct.error as ex:
+            raise OverflowError(f"Unable to encode {self!r}: {ex}")
+        return encode_frame(body, out)
 
     @classmethod
     def decode(cls, data):
         assert data[0] == 0x02, "Packet must start with 0x02"
         assert data[-1] == 0x03, "Packet must end with 0x03"
-        body = unsub_body(data[1:-1])
-        chksm = calc_checksum(body[:-1])
-        if chksm != body[-1]:
+        body, x = unescape_body(memoryview(data)[1:-1])
+        if x != 0:
+            chksm = x ^ body[-1]
             raise InvalidChecksum("Invalid Checksum! Calculated: " + format(chksm, '02x') + " Got: " + format(body[-1], '02x') + " Msg: " + data.hex())
         message_type = MessageType(body[0])
         c = cls(message_type)
-        if message_type in (MessageType.SET, MessageType.SUBSCRIBE, MessageType.SUBSCRIBE_PERCENT, MessageType.BUMP_PERCENT,
-                MessageType.SET_STRING, MessageType.UNSUBSCRIBE, MessageType.UNSUBSCRIBE_PERCENT):
-            c.node = int.from_bytes(body[1:3], byteorder='big')
-            c.v_device = body[3]
-            c.obj_id = int.from_bytes(body[4:7], byteorder='big')
-            c.param_id = int.from_bytes(body[7:9], byteorder='big')
-            if message_type in (MessageType.SET, MessageType.SUBSCRIBE, MessageType.SUBSCRIBE_PERCENT, MessageType.BUMP_PERCENT):
-                c.value = int.from_bytes(body[9:13], byteorder='big', signed=True)
-            elif message_type == MessageType.SET_STRING:
-                str_len = body[9]
-                c.string_bytes = body[10:10+str_len]
-                assert body[10+str_len] == 0, "String must end with 0x00"
-        elif message_type == MessageType.RECALL_PRESET:
-            c.value = int.from_bytes(body[1:5], byteorder='big')
-
+        codec = packet_codecs.get(message_type)
+        if codec is not None:
+            try:
+                codec[1](c, body)
+            except struct.error as ex:
+                raise DecodeFailed(f"Packet too short: {ex} Msg: {data.hex()}")
         return c
+
     def param_str(self):
-        return format(self.node, '04x') + ":" + format(self.v_device, '02x') + ":" + format(self.obj_id, '06x') + ":" + format(self.param_id, '04x')
+        return f"{self.node:04x}:{self.v_device:02x}:{self.obj_id:06x}:{self.param_id:04x}"
     def to_json(self):
         return {
             "type": self.message_type.name,
@@ -161,22 +223,63 @@ __test_p2 = Packet.decode(__test_p2_hex)
 assert __test_p == __test_p2, "Failed to decode test packet"
 assert __test_p2.encode() == __test_p2_hex, "Failed to encode test packet"
 
+class PacketDecoder:
+    """
+    Incremental decoder for the STX/ETX framed stream from a SoundWeb node.
+    Partial frames are kept between calls to feed(), so each received
+    chunk is only scanned once.
+    Frames that can't be decoded are skipped, only the first is logged
+    and the rest are counted until the next reset.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.invalid_frames = 0
+
+    def reset(self):
+        self.buffer.clear()
+        if self.invalid_frames > 1:
+            print(self.invalid_frames, "invalid frames received", flush=True)
+        self.invalid_frames = 0
+
+    def _invalid_frame(self, frame: bytearray, ex: Exception):
+        self.invalid_frames += 1
+        if self.invalid_frames == 1:
+            print("Unable to decode", frame.hex() + ":", repr(ex), "(further invalid frames are only counted)", flush=True)
+
+    def feed(self, data: bytes):
+        buf = self.buffer
+        buf += data
+        packets = []
+        start = 0
+        while True:
+            etx = buf.find(b'\x03', start)
+            if etx < 0:
+                break
+            # the body is byte substituted, so the last STX before the ETX starts the frame
+            stx = buf.rfind(b'\x02', start, etx)
+            if stx >= 0:
+                try:
+                    packets.append(Packet.decode(bytes(buf[stx:etx+1])))
+                except (InvalidChecksum, DecodeFailed, IndexError, ValueError, AssertionError) as ex:
+                    # bad checksum, empty frame, unknown message type or bad string, skip to the next frame
+                    self._invalid_frame(buf[stx:etx+1], ex)
+            start = etx + 1
+        # keep any partial frame, bytes outside of a frame are discarded
+        stx = buf.rfind(b'\x02', start)
+        if stx < 0:
+            buf.clear()
+        else:
+            del buf[:stx]
+        return packets
+
+__test_decoder = PacketDecoder()
+assert __test_decoder.feed(__test_p2_hex[:5]) == [], "Failed to buffer partial test packet"
+assert __test_decoder.feed(__test_p2_hex[5:] + __test_p2_hex) == [__test_p, __test_p], "Failed to decode test packet stream"
+
 def decode_packets(msg: bytes):
-    packets = []
-    pkt_msg = b''
-    while msg:
-        if msg[:1] == 0x02:
-            pkt_msg = b'' # start of message nyte
-        pkt_msg += msg[:1] # take next byte
-        msg = msg[1:]
-        if pkt_msg[-1] == 0x03:
-            try:
-                packets.append(Packet.decode(pkt_msg))
-            except InvalidChecksum as ex:
-                print(ex, flush=True)
-            # clear packet so it doesn't get returned as remaining
-            pkt_msg = b''
-    return packets, pkt_msg # return remaining bytes
+    decoder = PacketDecoder()
+    packets = decoder.feed(msg)
+    return packets, bytes(decoder.buffer) # return remaining bytes
 
 def meter_value_db(value):
     return str(value / 10000) + " dB"
@@ -0,0 +1,104 @@
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from soundweb_proto import MessageType, Packet
+
+# (node, v_device, obj_id, param_id, kind) where kind is the subscribe message type
+SubscriptionKey = Tuple[int, int, int, int, MessageType]
+
+UNSUBSCRIBE_TYPES = {
+    MessageType.SUBSCRIBE: MessageType.UNSUBSCRIBE,
+    MessageType.SUBSCRIBE_PERCENT: MessageType.UNSUBSCRIBE_PERCENT,
+}
+SUBSCRIBE_TYPES = {v: k for k, v in UNSUBSCRIBE_TYPES.items()}
+
+def subscription_key(p: Packet) -> SubscriptionKey:
+    """ Key for a subscribe or unsubscribe packet, both map to the same subscription """
+    kind = SUBSCRIBE_TYPES.get(p.message_type, p.message_type)
+    return (p.node, p.v_device, p.obj_id, p.param_id, kind)
+
+def param_str_key(param_str: str, kind: MessageType) -> SubscriptionKey:
+    node, v_device, obj_id, param_id = (int(s, 16) for s in param_str.split(":"))
+    return (node, v_device, obj_id, param_id, kind)
+
+def unsubscribe_packet(p: Packet) -> Packet:
+    return Packet(UNSUBSCRIBE_TYPES[p.message_type], p.node, p.v_device, p.obj_id, p.param_id)
+
+class Subscription:
+    __slots__ = ("packet", "unsub_packet", "subscribers")
+
+    def __init__(self, packet: Packet, unsub_packet: Packet):
+        self.packet = packet
+        self.unsub_packet = unsub_packet
+        # addresses of the websocket clients using this subscription
+        self.subscribers: Set[str] = set()
+
+    @property
+    def refcount(self):
+        return len(self.subscribers)
+
+class SubscriptionRegistry:
+    """
+    The parameters subscribed to on a node, shared between the websocket
+    clients and the sync connection (which resubscribes on reconnect).
+    Iteration is in insertion order.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions: Dict[SubscriptionKey, Subscription] = {}
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def __contains__(self, key: SubscriptionKey):
+        return key in self.subscriptions
+
+    def add_subscriber(self, key: SubscriptionKey, addr: str) -> bool:
+        """ Add addr to an existing subscription, returns False if there isn't one """
+        with self.lock:
+            sub = self.subscriptions.get(key)
+            if sub is None:
+                return False
+            sub.subscribers.add(addr)
+            return True
+
+    def subscribe(self, key: SubscriptionKey, packet: Packet, addr: str) -> Subscription:
+        """ Add or replace the subscribe packet for key, and add addr to its subscribers """
+        with self.lock:
+            sub = self.subscriptions.get(key)
+            if sub is None:
+                sub = self.subscriptions[key] = Subscription(packet, unsubscribe_packet(packet))
+            else:
+                sub.packet = packet
+            sub.subscribers.add(addr)
+            return sub
+
+    def release(self, key: SubscriptionKey, addr: str) -> bool:
+        """ Remove addr from the subscription, returns True if no subscribers remain """
+        with self.lock:
+            sub = self.subscriptions.get(key)
+            if sub is None:
+                return True
+            sub.subscribers.discard(addr)
+            return not sub.subscribers
+
+    def unsubscribe(self, key: SubscriptionKey, addr: str, fallback_unsub: Packet) -> Optional[Packet]:
+        """
+        Remove addr from the subscription, and the subscription itself if no subscribers remain.
+        Returns the unsubscribe packet to send to the node, or None if other clients are still subscribed.
+        Both happen under one lock so a client subscribing in between isn't removed.
+        """
+        with self.lock:
+            sub = self.subscriptions.get(key)
+            if sub is None:
+                return fallback_unsub # unsubscribe even though we don't know about it
+            sub.subscribers.discard(addr)
+            if sub.subscribers:
+                return None
+            del self.subscriptions[key]
+            return sub.unsub_packet
+
+    def packets(self) -> List[Packet]:
+        """ Subscribe packets to send to the node, safe to iterate from another thread """
+        with self.lock:
+            return [sub.packet for sub in self.subscriptions.values()]
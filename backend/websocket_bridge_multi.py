@@ -1,16 +1,20 @@
 import asyncio, os, sys, threading
-from janus import Queue
+from janus import Queue, SyncQueueFull
 import json, hmac, hashlib, time
 from config import load_config
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial
+from typing import Dict, Tuple
 
-from websocket_server import WebsocketServer
+from websocket_server import WebsocketServer, AsyncWebsocketServer
 from soundweb_proto import MessageType, Packet, meter_value_db, decode_packets, DecodeFailed
-from soundweb_client import SoundWebThread
+from binary_protocol import BinarySession
+from pending_updates import PendingUpdates
+from subscriptions import SubscriptionRegistry, subscription_key, param_str_key
+from soundweb_client import SoundWebThread, SoundWebConnection, SoundWebConnectionManager
 
 token_time_range = 10 * 60 * 1000 # +-10 minutes
 
+# SubscriptionRegistry per node, resubscribed by the sync threads on reconnect
 subscribed_params = {}
 
 ws_server = None
@@ -20,6 +24,7 @@ WS_USER_DATA = {}
 RUN_SERVER = True
 
 param_cache_lock = threading.Lock()
+# parameter -> (time sent, value, json data, websocket frame)
 param_cache = {}
 param_rebroadcast_time = 5 # 5 seconds
 
@@ -34,44 +39,180 @@ except:
 if VERSION == "":
     VERSION = "Unknown"
 
-def should_send(client, msg=None):
-    if msg is None:
-        return True
-    if not "parameter" in msg:
-        return True
-    addr = client.get("address", "")
-    if not addr:
+# parameter string -> {client id: client} for the clients subscribed to it
+# entries are replaced rather than modified (under WS_DATA_LOCK) so resp_broadcast can read them without locking
+PARAM_CLIENTS: Dict[str, Dict[int, dict]] = {}
+# same as PARAM_CLIENTS for clients with the batch option, mapping to their pending batch instead
+PARAM_BATCH_CLIENTS: Dict[str, Dict[int, PendingUpdates]] = {}
+# client id -> (client, pending json messages) for clients with the batch option
+BATCH_CLIENTS: Dict[int, Tuple[dict, PendingUpdates]] = {}
+# same as PARAM_CLIENTS for clients with the binary option, mapping to their BinarySession instead
+PARAM_BINARY_CLIENTS: Dict[str, Dict[int, BinarySession]] = {}
+# client id -> BinarySession for clients with the binary option
+BINARY_CLIENTS: Dict[int, BinarySession] = {}
+
+def client_param_index(client: dict):
+    # the index for the client, and what it maps the client to
+    session = BINARY_CLIENTS.get(client["id"])
+    if session:
+        return PARAM_BINARY_CLIENTS, session
+    batch = BATCH_CLIENTS.get(client["id"])
+    if batch:
+        return PARAM_BATCH_CLIENTS, batch[1]
+    return PARAM_CLIENTS, client
+
+def add_param_client(parameter: str, client: dict):
+    index, value = client_param_index(client)
+    clients = dict(index.get(parameter, {}))
+    clients[client["id"]] = value
+    index[parameter] = clients
+
+def remove_param_client(parameter: str, client: dict):
+    index, _ = client_param_index(client)
+    clients = index.get(parameter)
+    if clients is None or client["id"] not in clients:
+        return
+    clients = dict(clients)
+    del clients[client["id"]]
+    if clients:
+        index[parameter] = clients
+    else:
+        del index[parameter]
+
+def remove_param_client_subs(client: dict, user_subs):
+    for param_str in user_subs[0] | user_subs[1]:
+        remove_param_client(param_str, client)
+
+def send_to_param_clients(msg: dict, data: str, frame: bytes):
+    parameter = msg["parameter"]
+    clients = PARAM_CLIENTS.get(parameter)
+    if clients:
+        # keyed on the type too, so a queued percent value is never replaced by a plain one
+        ws_server.send_frame_to_list(clients.values(), frame, (msg["type"], parameter))
+    batches = PARAM_BATCH_CLIENTS.get(parameter)
+    if batches:
+        for batch in batches.values():
+            batch.put((msg["type"], parameter), data)
+    sessions = PARAM_BINARY_CLIENTS.get(parameter)
+    if sessions:
+        for session in sessions.values():
+            record = session.pack(msg)
+            if record is None:
+                ws_server.send_frame(session.client, frame, (msg["type"], parameter))
+            else:
+                session.pending.put((msg["type"], parameter), record)
+
+def add_binary_index(client: dict, msg_type: str, parameter: str):
+    # send the table entry before any record can use it
+    session = BINARY_CLIENTS.get(client["id"])
+    if session is None:
+        return
+    index = session.add(msg_type, parameter)
+    if index is not None:
+        # keyed by index so a full send queue never drops it, the client ignores records for unknown indices
+        frame = ws_server.prepare_send_text(json.dumps({
+            "type": "BINARY_INDEX",
+            "data": {"index": index, "type": msg_type, "parameter": parameter}
+        }))
+        ws_server.send_frame(client, frame, ("BINARY_INDEX", index))
+
+def client_flush_interval(user_options: dict) -> float:
+    # seconds between flushes for a client's rate option (updates per second),
+    # at most once per batch window and at least once a second
+    window = config["batch_window_ms"] / 1000
+    rate = user_options.get("rate")
+    if type(rate) not in (int, float) or rate <= 0:
+        return window
+    return max(window, 1 / max(rate, 1))
+
+# send queue key for batch frames, see websocket_batch_thread
+BATCH_KEY = "BATCH"
+
+def websocket_batch_thread():
+    print("Starting websocket batch thread", flush=True)
+    window = config["batch_window_ms"] / 1000
+    while RUN_SERVER:
+        time.sleep(window)
+        t = time.monotonic()
+        with WS_DATA_LOCK:
+            batches = list(BATCH_CLIENTS.values())
+            sessions = list(BINARY_CLIENTS.values())
+        # while a client's last batch is still queued its updates stay pending (and coalescing),
+        # batches are keyed so a full send queue never drops the only copy of a value
+        for client, batch in batches:
+            if not batch or ws_server.client_send_backlog(client) or not batch.due(t):
+                continue
+            msgs = batch.take()
+            try:
+                ws_server.send_frame(client, ws_server.prepare_send_text("[" + ",".join(msgs) + "]"), BATCH_KEY)
+            except Exception as ex:
+                print("Websocket batch thread error:", ex, flush=True)
+        for session in sessions:
+            if not session.pending or ws_server.client_send_backlog(session.client) or not session.pending.due(t):
+                continue
+            try:
+                ws_server.send_binary(session.client, session.take(), BATCH_KEY)
+            except Exception as ex:
+                print("Websocket batch thread error:", ex, flush=True)
+    print("Finished websocket batch thread", flush=True)
+
+def get_deadband(msg_type: str, parameter: str) -> int:
+    # per parameter, then per object (parameter string without the parameter id), then per message type
+    deadband = config["deadband_parameters"].get(parameter)
+    if deadband is None:
+        deadband = config["deadband_parameters"].get(parameter.rsplit(":", 1)[0])
+    if deadband is None:
+        deadband = config["deadband"].get(msg_type, 0)
+    return deadband
+
+def within_deadband(old_value, value, deadband: int) -> bool:
+    if old_value == value:
         return True
-    if not addr in WS_USER_DATA:
-        return False
-    _, _, user_sub = WS_USER_DATA[addr]
-    return msg["parameter"] in user_sub
+    return deadband > 0 and type(old_value) == int and type(value) == int and abs(value - old_value) < deadband
 
 async def resp_broadcast(node: str):
     global param_cache, param_cache_lock, ws_server, WEBSOCKET_LIST
     while True:
         # Get a "work item" out of the queue.
         msg = await resp_queues[node].async_q.get()
-        data = json.dumps(msg)
         if msg["type"] == "SET":
+            parameter = msg["parameter"]
+            value = msg["value"]
             with param_cache_lock:
                 t = time.time()
-                # check if value has stayed the same in the cache
-                if msg["parameter"] in param_cache and param_cache[msg["parameter"]][1] == data:
-                    # if it has not been the minimum rebroadcast time, don't bother resending the data
-                    if t - param_cache[msg["parameter"]][0] < param_rebroadcast_time:
-                        continue
-                param_cache[msg["parameter"]] = (t, data)
-        SEND_LIST = filter(partial(should_send, msg=msg), WEBSOCKET_LIST)
-        if SEND_LIST:
-            ws_server.send_message_to_list(SEND_LIST, data)
+                cached = param_cache.get(parameter)
+                # if the value is within the deadband of the last value sent, and it has not been
+                # the minimum rebroadcast time, don't bother resending the data
+                if cached is not None and t - cached[0] < param_rebroadcast_time and within_deadband(cached[1], value, get_deadband(msg["type"], parameter)):
+                    continue
+                if cached is not None and cached[1] == value:
+                    data, frame = cached[2], cached[3]
+                else:
+                    data = json.dumps(msg)
+                    frame = ws_server.prepare_send_text(data)
+                param_cache[parameter] = (t, value, data, frame)
+        else:
+            data = json.dumps(msg)
+            frame = ws_server.prepare_send_text(data)
+        send_to_param_clients(msg, data, frame)
 
-def get_packet_node_handler(p: Packet) -> str:
+def get_node_handler(node: int) -> str:
     global config
-    if hex(p.node) in config["nodes"]:
-        return hex(p.node)
+    if hex(node) in config["nodes"]:
+        return hex(node)
     return "default"
 
+def get_packet_node_handler(p: Packet) -> str:
+    return get_node_handler(p.node)
+
+def queue_packet(queues: dict, node: str, p: Packet):
+    # never blocks, the websocket callbacks can run on the server's event loop
+    # the queue fills up while a node is disconnected, subscriptions are resent on reconnect
+    try:
+        queues[node].sync_q.put_nowait(p)
+    except SyncQueueFull:
+        print(f"Queue for node {node} is full, dropping {p}", flush=True)
+
 previous_tokens = {}
 
 def check_auth_token_hmac(message: str):
@@ -121,9 +262,13 @@ def ws_on_data_receive(client, server, message):
             return
         user_options = user_data.get("options", {})
         with WS_DATA_LOCK:
-            WS_USER_DATA[client["address"]] = (user_data, user_options, [])
+            WS_USER_DATA[client["address"]] = (user_data, user_options, (set(), set()))
             if not user_options.get("status", False):
                 WEBSOCKET_LIST.append(client)
+                if user_options.get("binary", False):
+                    BINARY_CLIENTS[client["id"]] = BinarySession(client, client_flush_interval(user_options))
+                elif user_options.get("batch", False):
+                    BATCH_CLIENTS[client["id"]] = (client, PendingUpdates(client_flush_interval(user_options)))
         # send __test__ to acknowledge websocket auth
         server.send_message(client, "__test__")
         # if not user_options.get("status", False):
@@ -152,53 +297,88 @@ def ws_on_data_receive(client, server, message):
         try:
             data = json.loads(message)
             if data.get("type", "") == "UNSUBSCRIBE_ALL":
-                user_subs = []
+                release_subscriptions(client["address"], user_subs)
                 with WS_DATA_LOCK:
+                    remove_param_client_subs(client, user_subs)
+                    user_subs = (set(), set())
                     WS_USER_DATA[client["address"]] = (user_data, user_options, user_subs)
             else:
                 p = Packet.from_json(json.loads(message))
                 sub_handler_node = get_packet_node_handler(p)
                 # print(p, flush=True)
-                sent_value = False
                 if p.message_type == MessageType.SUBSCRIBE or p.message_type == MessageType.SUBSCRIBE_PERCENT:
                     p.value = config["subscription_rate_ms"]
-                    for sub in subscribed_params[sub_handler_node]:
-                        if sub.param_str() == p.param_str() and sub.message_type == p.message_type:
-                            if p.param_str() in param_cache: # avoid resubscribing to parameters if value cached
-                                server.send_message(client, param_cache[p.param_str()][1])
-                                sent_value = True
-                            else:
-                                subscribed_params[sub_handler_node].remove(sub)
-                    if not sent_value: # avoid resubscribing to parameters
-                        subscribed_params[sub_handler_node].append(p)
-                        # subscribe_queues[sub_handler_node].sync_q.put(p)
-                    subscribe_queues[sub_handler_node].sync_q.put(p) # resubscribe (sometimes soundweb forgets about us i think)
-                    if p.param_str not in user_subs:
-                        user_subs.append(p.param_str())
+                    subscriptions = subscribed_params[sub_handler_node]
+                    key = subscription_key(p)
+                    param_str = p.param_str()
+                    # avoid resubscribing to parameters if value cached
+                    if subscriptions.add_subscriber(key, client["address"]) and param_str in param_cache:
+                        server.send_frame(client, param_cache[param_str][3])
+                    else:
+                        subscriptions.subscribe(key, p, client["address"])
+                    queue_packet(subscribe_queues, sub_handler_node, p) # resubscribe (sometimes soundweb forgets about us i think)
+                    is_percent = p.message_type == MessageType.SUBSCRIBE_PERCENT
+                    if param_str not in user_subs[1 if is_percent else 0]:
                         with WS_DATA_LOCK:
+                            user_subs[1 if is_percent else 0].add(param_str)
+                            if not user_options.get("status", False):
+                                add_binary_index(client, "SET_PERCENT" if is_percent else "SET", param_str)
+                                add_param_client(param_str, client)
                             WS_USER_DATA[client["address"]] = (user_data, user_options, user_subs)
                 elif p.message_type == MessageType.UNSUBSCRIBE or p.message_type == MessageType.UNSUBSCRIBE_PERCENT:
-                    for sub in subscribed_params[sub_handler_node]:
-                        if sub.param_str() == p.param_str() and sub.message_type == p.message_type:
-                            subscribed_params[sub_handler_node].remove(sub)
-                    subscribe_queues[sub_handler_node].sync_q.put(p)
-                    if p.param_str() in user_subs:
-                        user_subs.remove(p.param_str())
+                    subscriptions = subscribed_params[sub_handler_node]
+                    key = subscription_key(p)
+                    # only unsubscribe on the node once no other clients are using the parameter
+                    unsub_packet = subscriptions.unsubscribe(key, client["address"], p)
+                    if unsub_packet is not None:
+                        queue_packet(subscribe_queues, sub_handler_node, unsub_packet)
+                    is_percent = p.message_type == MessageType.UNSUBSCRIBE_PERCENT
+                    if p.param_str() in user_subs[1 if is_percent else 0]:
                         with WS_DATA_LOCK:
+                            user_subs[1 if is_percent else 0].remove(p.param_str())
+                            # still wanted if subscribed to the other (percent/non percent) value
+                            if p.param_str() not in user_subs[0 if is_percent else 1]:
+                                remove_param_client(p.param_str(), client)
                             WS_USER_DATA[client["address"]] = (user_data, user_options, user_subs)
                 else:
-                    msg_queues[sub_handler_node].sync_q.put(p)
+                    queue_packet(msg_queues, sub_handler_node, p)
         except (json.JSONDecodeError, DecodeFailed) as ex:
             print("Failed to decode:", ex, ":", message, flush=True)
 
+def ws_on_binary_receive(client, server, data):
+    # parameter updates as records, for clients with the binary option
+    session = BINARY_CLIENTS.get(client["id"])
+    _, user_options, _ = WS_USER_DATA.get(client["address"], (None, None, None))
+    if session is None or user_options is None or user_options.get("statusonly", False):
+        return
+    try:
+        for msg in session.unpack(data):
+            p = Packet.from_json(msg)
+            queue_packet(msg_queues, get_packet_node_handler(p), p)
+    except (ValueError, DecodeFailed) as ex:
+        print("Failed to decode binary message:", ex, flush=True)
+
+def release_subscriptions(addr, user_subs):
+    # the node subscriptions are kept, so the cached values stay up to date for the next client
+    for i, kind in enumerate((MessageType.SUBSCRIBE, MessageType.SUBSCRIBE_PERCENT)):
+        for param_str in user_subs[i]:
+            key = param_str_key(param_str, kind)
+            subscribed_params[get_node_handler(key[0])].release(key, addr)
+
 def ws_on_connection_close(client, server):
     global WS_DATA_LOCK, WEBSOCKET_LIST, WS_USER_DATA
+    user_subs = None
+    ip = client["address"]
     with WS_DATA_LOCK:
         if client in WEBSOCKET_LIST:
             WEBSOCKET_LIST.remove(client)
-        ip = client["address"]
         if ip in WS_USER_DATA:
-            WS_USER_DATA.pop(ip)
+            _, _, user_subs = WS_USER_DATA.pop(ip)
+            remove_param_client_subs(client, user_subs)
+        BATCH_CLIENTS.pop(client["id"], None)
+        BINARY_CLIENTS.pop(client["id"], None)
+    if user_subs is not None:
+        release_subscriptions(ip, user_subs)
 
 health_check_queue = None
 
@@ -228,36 +408,51 @@ def get_node_alias(n):
     return config["node_names"].get(n, n)
 
 soundweb_thread = None
-soundweb_subscribe_threads = []
+soundweb_msg_threads = {}
+soundweb_subscribe_threads = {}
+soundweb_connection_manager = None
+batch_thread = None
 async def main():
-    global config, ws_server, msg_queues, resp_queues, subscribe_queues, soundweb_msg_threads, soundweb_subscribe_threads, subscribed_params, health_check_queue, RUN_SERVER
+    global config, ws_server, msg_queues, resp_queues, subscribe_queues, soundweb_msg_threads, soundweb_subscribe_threads, soundweb_connection_manager, batch_thread, subscribed_params, health_check_queue, RUN_SERVER
     health_check_queue = Queue(50)
     msg_queues = {key: Queue(200) for key in config["nodes"].keys()}
     resp_queues = {key: Queue(200) for key in config["nodes"].keys()}
     subscribe_queues = {key: Queue(200) for key in config["nodes"].keys()}
     soundweb_ip = config["nodes"]["default"]
-    subscribed_params = {key: list() for key in config["nodes"].keys()}
+    subscribed_params = {key: SubscriptionRegistry() for key in config["nodes"].keys()}
     sync_timeout = config["sync_thread_timeout_s"]
 
+    # with a shared event loop all the node connections run as tasks on the connection manager thread
+    connection_type = SoundWebConnection if config["shared_event_loop"] else SoundWebThread
     soundweb_msg_threads = {
-        key: SoundWebThread(f"SoundWeb {key} Message Thread", "M: "+get_node_alias(key), ip, 1023, msg_queues[key], None, None, health_check_queue)
+        key: connection_type(f"SoundWeb {key} Message Thread", "M: "+get_node_alias(key), ip, 1023, msg_queues[key], None, None, health_check_queue)
         for key, ip in config["nodes"].items()}
     soundweb_subscribe_threads = {
-        key: SoundWebThread(f"SoundWeb {key} Sync Thread", "S: "+get_node_alias(key), ip, 1023, subscribe_queues[key], resp_queues[key], subscribed_params[key], health_check_queue, sync_timeout)
+        key: connection_type(f"SoundWeb {key} Sync Thread", "S: "+get_node_alias(key), ip, 1023, subscribe_queues[key], resp_queues[key], subscribed_params[key], health_check_queue, sync_timeout)
         for key, ip in config["nodes"].items()}
-    for t in soundweb_msg_threads.values():
-        t.start()
-    for t in soundweb_subscribe_threads.values():
-        t.start()
+    if config["shared_event_loop"]:
+        soundweb_connection_manager = SoundWebConnectionManager(
+            list(soundweb_msg_threads.values()) + list(soundweb_subscribe_threads.values()))
+        soundweb_connection_manager.start()
+    else:
+        for t in soundweb_msg_threads.values():
+            t.start()
+        for t in soundweb_subscribe_threads.values():
+            t.start()
     print(f"Websocket server listening on ws://0.0.0.0:{config['websocket_port']}", flush=True)
     
     for node in config["nodes"]:
         asyncio.create_task(resp_broadcast(node))
-    ws_server = WebsocketServer(host="0.0.0.0", port=config["websocket_port"])
+    ws_server_cls = AsyncWebsocketServer if config["websocket_engine"] == "asyncio" else WebsocketServer
+    ws_server = ws_server_cls(host="0.0.0.0", port=config["websocket_port"],
+        deflate=config["websocket_deflate"], deflate_window_bits=config["websocket_deflate_window_bits"], deflate_level=config["websocket_deflate_level"])
     ws_server.set_fn_new_client(ws_on_connection_open)
     ws_server.set_fn_client_left(ws_on_connection_close)
     ws_server.set_fn_message_received(ws_on_data_receive)
+    ws_server.set_fn_binary_message_received(ws_on_binary_receive)
     ws_server.run_forever(threaded=True)
+    batch_thread = threading.Thread(target=websocket_batch_thread, daemon=True)
+    batch_thread.start()
     health_task = asyncio.create_task(health_check())
     while RUN_SERVER:
         await asyncio.sleep(2)
@@ -274,20 +469,27 @@ if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        pass
+        RUN_SERVER = False
     print("Exiting...")
 
+    if batch_thread:
+        batch_thread.join()
+
     for t in soundweb_msg_threads.values():
         t.exitFlag = True
-    for t in soundweb_msg_threads.values():
-        t.join()
+    if not soundweb_connection_manager:
+        for t in soundweb_msg_threads.values():
+            t.join()
     if ws_server:
         ws_server.shutdown_gracefully()
         # should figure out how to get thread to exit, but thread is daemonized so will get killed when program exits
     for t in soundweb_subscribe_threads.values():
         t.exitFlag = True
-    for t in soundweb_subscribe_threads.values():
-        t.join()
+    if soundweb_connection_manager:
+        soundweb_connection_manager.join()
+    else:
+        for t in soundweb_subscribe_threads.values():
+            t.join()
 
     for q in msg_queues.values():
         q.close()
@@ -1 +1,2 @@
-from .websocket_server import *
\ No newline at end of file
+from .websocket_server import *
+from .async_server import AsyncWebsocketServer
@@ -0,0 +1,376 @@
+import sys
+import struct
+import ssl
+import socket
+import zlib
+import asyncio
+import logging
+import threading
+
+from websocket_server.websocket_server import *
+from websocket_server.websocket_server import logger
+from websocket_server.thread import WebsocketServerThread
+
+
+class AsyncWebsocketServer(API):
+    """
+    A websocket server running every client on a single asyncio event loop,
+    instead of a thread per client like WebsocketServer.
+    Takes the same arguments and provides the same API as WebsocketServer.
+    The callbacks are run on the event loop, so they should not block.
+    The send functions may be called from any thread.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, loglevel=logging.WARNING, key=None, cert=None, send_queue_size=DEFAULT_SEND_QUEUE_SIZE, deflate=False, deflate_window_bits=DEFAULT_DEFLATE_WINDOW_BITS, deflate_level=DEFAULT_DEFLATE_LEVEL):
+        logger.setLevel(loglevel)
+        self.socket = socket.create_server((host, port))
+        self.host = host
+        self.port = self.socket.getsockname()[1]
+
+        self.key = key
+        self.cert = cert
+        self.send_queue_size = send_queue_size
+        # permessage-deflate, used if the client offers it
+        self.deflate = deflate
+        self.deflate_window_bits = deflate_window_bits
+        self.deflate_level = deflate_level
+
+        self.clients = {}
+        self.id_counter = 0
+        self.thread = None
+        self.loop = None
+        self.server = None
+
+        self._deny_clients = False
+
+    # client bookkeeping is the same as the threaded server
+    _message_received_ = WebsocketServer._message_received_
+    _binary_message_received_ = WebsocketServer._binary_message_received_
+    _ping_received_ = WebsocketServer._ping_received_
+    _pong_received_ = WebsocketServer._pong_received_
+    _new_client_ = WebsocketServer._new_client_
+    _client_left_ = WebsocketServer._client_left_
+    _unicast = WebsocketServer._unicast
+    _multicast = WebsocketServer._multicast
+    _unicast_frame = WebsocketServer._unicast_frame
+    broadcast_list = WebsocketServer.broadcast_list
+    broadcast_frame_list = WebsocketServer.broadcast_frame_list
+    handler_to_client = WebsocketServer.handler_to_client
+    _terminate_client_handlers = WebsocketServer._terminate_client_handlers
+    _disconnect_clients_gracefully = WebsocketServer._disconnect_clients_gracefully
+    _disconnect_clients_abruptly = WebsocketServer._disconnect_clients_abruptly
+    _deny_new_connections = WebsocketServer._deny_new_connections
+    _allow_new_connections = WebsocketServer._allow_new_connections
+    prepare_send_text = WebsocketServer.prepare_send_text
+    prepare_send_binary = WebsocketServer.prepare_send_binary
+
+    def _ssl_context(self):
+        if not (self.key and self.cert):
+            return None
+        try:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(certfile=self.cert, keyfile=self.key)
+            return context
+        except (OSError, ssl.SSLError):
+            logger.warning("SSL not available (are the paths {} and {} correct for the key and cert?)".format(self.key, self.cert))
+            return None
+
+    def _serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: AsyncWebSocketHandler(self), sock=self.socket, ssl=self._ssl_context()))
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+    def _run_forever(self, threaded):
+        cls_name = self.__class__.__name__
+        try:
+            logger.info("Listening on port %d for clients.." % self.port)
+            if threaded:
+                self.daemon = True
+                self.thread = WebsocketServerThread(target=self._serve_forever, daemon=True, logger=logger)
+                logger.info(f"Starting {cls_name} on thread {self.thread.getName()}.")
+                self.thread.start()
+            else:
+                self.thread = threading.current_thread()
+                logger.info(f"Starting {cls_name} on main thread.")
+                self._serve_forever()
+        except KeyboardInterrupt:
+            self.socket.close()
+            logger.info("Server terminated.")
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+            sys.exit(1)
+
+    def _terminate_client_handler(self, handler):
+        handler.keep_alive = False
+        handler.close()
+
+    def _stop(self):
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            if self.thread and self.thread is not threading.current_thread():
+                self.thread.join()
+
+    def _shutdown_gracefully(self, status=CLOSE_STATUS_NORMAL, reason=DEFAULT_CLOSE_REASON):
+        """
+        Send a CLOSE handshake to all connected clients before terminating server
+        """
+        self.keep_alive = False
+        self._disconnect_clients_gracefully(status, reason)
+        self._stop()
+
+    def _shutdown_abruptly(self):
+        """
+        Terminate server without sending a CLOSE handshake
+        """
+        self.keep_alive = False
+        self._disconnect_clients_abruptly()
+        self._stop()
+
+
+class AsyncWebSocketHandler(asyncio.Protocol):
+    """
+    A websocket client connection on an AsyncWebsocketServer,
+    with the same send functions as WebSocketHandler.
+    """
+
+    def __init__(self, server: AsyncWebsocketServer):
+        self.server = server
+        self.loop = server.loop
+        self.send_queue = SendQueue(server.send_queue_size)
+        self.transport = None
+        self.client_address = None
+        self.client = None
+        self.deflate = None
+        self.keep_alive = True
+        self.handshake_done = False
+        self.valid_client = False
+        self.buffer = bytearray()
+        self._flush_scheduled = False
+        self._write_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info('peername')
+
+    def connection_lost(self, exc):
+        self.keep_alive = False
+        self.send_queue.close()
+        if self.valid_client:
+            self.server._client_left_(self)
+
+    def pause_writing(self):
+        self._write_paused = True
+
+    def resume_writing(self):
+        self._write_paused = False
+        self._flush()
+
+    def data_received(self, data):
+        self.buffer += data
+        if not self.handshake_done:
+            self.handshake()
+        if self.handshake_done and self.keep_alive:
+            self.read_messages()
+
+    def read_http_headers(self, request):
+        lines = request.decode().split('\r\n')
+        # first line should be HTTP GET
+        assert lines[0].strip().upper().startswith('GET')
+        # remaining should be headers
+        headers = {}
+        for header in lines[1:]:
+            header = header.strip()
+            if not header:
+                continue
+            head, value = header.split(':', 1)
+            headers[head.lower().strip()] = value.strip()
+        return headers
+
+    def handshake(self):
+        end = self.buffer.find(b'\r\n\r\n')
+        if end == -1:
+            return
+        request = bytes(self.buffer[:end])
+        del self.buffer[:end + 4]
+        try:
+            headers = self.read_http_headers(request)
+            assert headers['upgrade'].lower() == 'websocket'
+        except (AssertionError, KeyError, ValueError, UnicodeDecodeError):
+            self.close()
+            return
+
+        try:
+            key = headers['sec-websocket-key']
+        except KeyError:
+            logger.warning("Client tried to connect but was missing a key")
+            self.close()
+            return
+
+        extensions = None
+        if self.server.deflate and 'sec-websocket-extensions' in headers:
+            extensions, self.deflate = PerMessageDeflate.negotiate(headers['sec-websocket-extensions'], self.server.deflate_window_bits, self.server.deflate_level)
+
+        response = WebSocketHandler.make_handshake_response(key, extensions)
+        self.transport.write(response.encode())
+        self.handshake_done = True
+        self.valid_client = True
+        self.server._new_client_(self)
+
+    def read_messages(self):
+        buf = self.buffer
+        pos = 0
+        while self.keep_alive and len(buf) - pos >= 2:
+            b1, b2 = buf[pos], buf[pos + 1]
+            compressed = b1 & RSV1
+            opcode = b1 & OPCODE
+            masked = b2 & MASKED
+            payload_length = b2 & PAYLOAD_LEN
+            header_length = 2
+            if payload_length == 126:
+                if len(buf) - pos < 4:
+                    break
+                payload_length = struct.unpack_from(">H", buf, pos + 2)[0]
+                header_length = 4
+            elif payload_length == 127:
+                if len(buf) - pos < 10:
+                    break
+                payload_length = struct.unpack_from(">Q", buf, pos + 2)[0]
+                header_length = 10
+            if masked:
+                header_length += 4
+            if len(buf) - pos < header_length + payload_length:
+                break # wait for the rest of the frame
+            masks = buf[pos + header_length - 4:pos + header_length]
+            payload = buf[pos + header_length:pos + header_length + payload_length]
+            pos += header_length + payload_length
+
+            if opcode == OPCODE_CLOSE_CONN:
+                logger.info("Client asked to close connection.")
+                self.close()
+                break
+            if not masked:
+                logger.warning("Client must always be masked.")
+                self.close()
+                break
+            if compressed and not self.deflate:
+                logger.warning("Client sent a compressed frame without permessage-deflate.")
+                self.close()
+                break
+            if opcode == OPCODE_CONTINUATION:
+                logger.warning("Continuation frames are not supported.")
+                continue
+            elif opcode == OPCODE_BINARY:
+                opcode_handler = self.server._binary_message_received_
+            elif opcode == OPCODE_TEXT:
+                opcode_handler = self.server._message_received_
+            elif opcode == OPCODE_PING:
+                opcode_handler = self.server._ping_received_
+            elif opcode == OPCODE_PONG:
+                opcode_handler = self.server._pong_received_
+            else:
+                logger.warning("Unknown opcode %#x." % opcode)
+                self.close()
+                break
+
+            message_bytes = unmask_payload(payload, masks)
+            try:
+                if compressed:
+                    message_bytes = self.deflate.decompress(message_bytes)
+                if opcode == OPCODE_BINARY:
+                    message = bytes(message_bytes)
+                else:
+                    message = message_bytes.decode('utf8')
+            except zlib.error as e:
+                logger.warning("Client sent a message that could not be decompressed: %s" % e)
+                self.close()
+                break
+            except MessageTooBig as e:
+                logger.warning("Client sent a message that is too big: %s" % e)
+                self.send_close(CLOSE_STATUS_MESSAGE_TOO_BIG)
+                self.close()
+                break
+            except UnicodeDecodeError:
+                logger.warning("Client sent a message that is not valid UTF-8.")
+                self.close()
+                break
+            opcode_handler(self, message)
+        del buf[:pos]
+
+    def close(self):
+        """ Close the connection, safe to call from any thread """
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self.keep_alive = False
+        if self.transport:
+            self.transport.close()
+
+    def _flush(self):
+        """ Write out the send queue on the event loop, until the transport's buffer is full """
+        self._flush_scheduled = False
+        if self.transport is None or self.transport.is_closing():
+            return
+        frames = []
+        while not self._write_paused:
+            frame = self.send_queue.get(block=False)
+            if frame is None:
+                break
+            if self.deflate:
+                frame = self.deflate.compress_frame(frame)
+            frames.append(frame)
+            # write in chunks so pause_writing gets a chance to stop us
+            if len(frames) >= 64:
+                self.transport.write(b''.join(frames))
+                frames = []
+        if frames:
+            self.transport.write(b''.join(frames))
+
+    def send_message(self, message):
+        self.send_text(message)
+
+    def send_pong(self, message):
+        self.send_text(message, OPCODE_PONG)
+
+    def send_close(self, status=CLOSE_STATUS_NORMAL, reason=DEFAULT_CLOSE_REASON):
+        """
+        Send CLOSE to client
+        Args:
+            status: Status as defined in https://datatracker.ietf.org/doc/html/rfc6455#section-7.4.1
+            reason: Text with reason of closing the connection
+        """
+        if status < CLOSE_STATUS_NORMAL or status > 1015:
+            raise Exception(f"CLOSE status must be between 1000 and 1015, got {status}")
+
+        header = bytearray()
+        payload = struct.pack('!H', status) + reason
+        payload_length = len(payload)
+        assert payload_length <= 125, "We only support short closing reasons at the moment"
+
+        # Send CLOSE with status & reason
+        header.append(FIN | OPCODE_CLOSE_CONN)
+        header.append(payload_length)
+        self.loop.call_soon_threadsafe(self._write_close, bytes(header + payload))
+
+    def _write_close(self, frame):
+        if self.transport and not self.transport.is_closing():
+            self.transport.write(frame)
+
+    def send_raw(self, data, key=None):
+        if self.send_queue.put(data, key) and not self._flush_scheduled:
+            self._flush_scheduled = True
+            try:
+                self.loop.call_soon_threadsafe(self._flush)
+            except RuntimeError: # loop closed
+                pass
+
+    def send_text(self, message, opcode=OPCODE_TEXT):
+        frame = self.server.prepare_send_text(message, opcode)
+        if frame:
+            self.send_raw(frame)
@@ -10,6 +10,8 @@ import logging
 from socket import error as SocketError
 import errno
 import threading
+import zlib
+from collections import deque
 from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
 
 from websocket_server.thread import WebsocketServerThread
@@ -34,6 +36,7 @@ logging.basicConfig()
 '''
 
 FIN    = 0x80
+RSV1   = 0x40
 OPCODE = 0x0f
 MASKED = 0x80
 PAYLOAD_LEN = 0x7f
@@ -48,8 +51,16 @@ OPCODE_PING         = 0x9
 OPCODE_PONG         = 0xA
 
 CLOSE_STATUS_NORMAL = 1000
+CLOSE_STATUS_MESSAGE_TOO_BIG = 1009
 DEFAULT_CLOSE_REASON = bytes('', encoding='utf-8')
 
+DEFAULT_SEND_QUEUE_SIZE = 500
+
+DEFAULT_DEFLATE_WINDOW_BITS = 15
+DEFAULT_DEFLATE_LEVEL = 6
+# largest message a client may send compressed, so a small frame can't inflate to gigabytes
+MAX_DECOMPRESSED_SIZE = 1 << 20
+
 
 class API():
 
@@ -65,6 +76,9 @@ class API():
     def message_received(self, client, server, message):
         pass
 
+    def binary_message_received(self, client, server, data):
+        pass
+
     def set_fn_new_client(self, fn):
         self.new_client = fn
 
@@ -74,6 +88,9 @@ class API():
     def set_fn_message_received(self, fn):
         self.message_received = fn
 
+    def set_fn_binary_message_received(self, fn):
+        self.binary_message_received = fn
+
     def send_message(self, client, msg):
         self._unicast(client, msg)
 
@@ -83,6 +100,25 @@ class API():
     def send_message_to_list(self, clients, msg):
         self.broadcast_list(clients, msg)
 
+    def send_binary(self, client, data, key=None):
+        self._unicast_frame(client, self.prepare_send_binary(data), key)
+
+    def send_frame(self, client, frame, key=None):
+        self._unicast_frame(client, frame, key)
+
+    def send_frame_to_list(self, clients, frame, key=None):
+        self.broadcast_frame_list(clients, frame, key)
+
+    def client_send_backlog(self, client):
+        """ Number of frames queued for the client that haven't been written yet """
+        return len(client['handler'].send_queue)
+
+    def client_send_stats(self, client):
+        stats = client['handler'].send_queue.stats()
+        if client['handler'].deflate:
+            stats.update(client['handler'].deflate.stats())
+        return stats
+
     def deny_new_connections(self, status=CLOSE_STATUS_NORMAL, reason=DEFAULT_CLOSE_REASON):
         self._deny_new_connections(status, reason)
 
@@ -113,7 +149,7 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
         loglevel: Logging level from logging module to use for logging. By default
             warnings and errors are being logged.
     Properties:
-        clients(list): A list of connected clients. A client is a dictionary
+        clients(dict): The connected clients by id. A client is a dictionary
             like below.
                 {
                  'id'      : id,
@@ -125,7 +161,7 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
     allow_reuse_address = True
     daemon_threads = True  # comment to keep threads alive until finished
 
-    def __init__(self, host='127.0.0.1', port=0, loglevel=logging.WARNING, key=None, cert=None):
+    def __init__(self, host='127.0.0.1', port=0, loglevel=logging.WARNING, key=None, cert=None, send_queue_size=DEFAULT_SEND_QUEUE_SIZE, deflate=False, deflate_window_bits=DEFAULT_DEFLATE_WINDOW_BITS, deflate_level=DEFAULT_DEFLATE_LEVEL):
         logger.setLevel(loglevel)
         TCPServer.__init__(self, (host, port), WebSocketHandler)
         self.host = host
@@ -133,8 +169,13 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
 
         self.key = key
         self.cert = cert
+        self.send_queue_size = send_queue_size
+        # permessage-deflate, used if the client offers it
+        self.deflate = deflate
+        self.deflate_window_bits = deflate_window_bits
+        self.deflate_level = deflate_level
 
-        self.clients = []
+        self.clients = {}
         self.id_counter = 0
         self.thread = None
 
@@ -163,6 +204,9 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
     def _message_received_(self, handler, msg):
         self.message_received(self.handler_to_client(handler), self, msg)
 
+    def _binary_message_received_(self, handler, data):
+        self.binary_message_received(self.handler_to_client(handler), self, data)
+
     def _ping_received_(self, handler, msg):
         handler.send_pong(msg)
 
@@ -183,32 +227,43 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
             'handler': handler,
             'address': handler.client_address
         }
-        self.clients.append(client)
+        self.clients[client['id']] = client
+        handler.client = client
         self.new_client(client, self)
 
     def _client_left_(self, handler):
         client = self.handler_to_client(handler)
         self.client_left(client, self)
-        if client in self.clients:
-            self.clients.remove(client)
+        if client is not None:
+            self.clients.pop(client['id'], None)
+            handler.client = None
 
     def _unicast(self, receiver_client, msg):
         receiver_client['handler'].send_message(msg)
 
     def _multicast(self, msg):
-        for client in self.clients:
+        for client in list(self.clients.values()):
             self._unicast(client, msg)
 
+    def _unicast_frame(self, receiver_client, frame, key=None):
+        receiver_client['handler'].send_raw(frame, key)
+
     def broadcast_list(self, clients, msg):
         data = self.prepare_send_text(msg)
         if data:
-            for client in clients:
-                client['handler'].send_raw(data)
+            self.broadcast_frame_list(clients, data)
+
+    def broadcast_frame_list(self, clients, frame, key=None):
+        """
+        Send a frame built by prepare_send_text to each client,
+        so a message sent to many clients is only encoded once.
+        The key identifies the value in the frame, see SendQueue.
+        """
+        for client in clients:
+            client['handler'].send_raw(frame, key)
 
     def handler_to_client(self, handler):
-        for client in self.clients:
-            if client['handler'] == handler:
-                return client
+        return handler.client
 
     def _terminate_client_handler(self, handler):
         handler.keep_alive = False
@@ -219,7 +274,7 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
         """
         Ensures request handler for each client is terminated correctly
         """
-        for client in self.clients:
+        for client in list(self.clients.values()):
             self._terminate_client_handler(client["handler"])
 
     def _shutdown_gracefully(self, status=CLOSE_STATUS_NORMAL, reason=DEFAULT_CLOSE_REASON):
@@ -244,7 +299,7 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
         """
         Terminate clients gracefully without shutting down the server
         """
-        for client in self.clients:
+        for client in list(self.clients.values()):
             client["handler"].send_close(status, reason)
         self._terminate_client_handlers()
 
@@ -279,32 +334,235 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
             logger.warning('Can\'t send message, message has to be a string or bytes. Got %s' % type(message))
             return False
 
-        header  = bytearray()
         payload = encode_to_UTF8(message)
-        payload_length = len(payload)
+        return make_frame_header(FIN | opcode, len(payload)) + payload
 
-        # Normal payload
-        if payload_length <= 125:
-            header.append(FIN | opcode)
-            header.append(payload_length)
+    def prepare_send_binary(self, data):
+        return make_frame_header(FIN | OPCODE_BINARY, len(data)) + data
 
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
 
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
+class SendQueue():
+    """
+    Bounded queue of frames waiting to be written to a client, emptied by the
+    client's writer thread so a slow client never holds up sends to the others.
+    When full, a frame sent with a key replaces the queued frame with the same
+    key (a stale value). Otherwise the oldest superseded frame (one with a newer
+    frame queued for its key) is dropped, then the oldest frame without a key.
+    The newest frame for each key is never dropped, so the queue can go over
+    max_size by up to the number of keys, rather than leave a client showing a
+    stale value. A frame without a key is dropped if there is nothing else to drop.
+    Dropped frames are marked dead (frame None) and skipped by get, the drop
+    candidates are kept in their own queues so a full queue is never scanned.
+    """
 
-        else:
-            raise Exception("Message is too big. Consider breaking it into chunks.")
-            return
+    def __init__(self, max_size=DEFAULT_SEND_QUEUE_SIZE):
+        self.max_size = max_size
+        self.frames = deque()  # [key, frame] entries, frame is None once dropped
+        self.keyed = {}  # key -> latest queued entry for that key
+        self.superseded = deque()  # keyed entries with a newer entry queued, oldest first
+        self.unkeyed = deque()  # entries without a key, oldest first
+        self.size = 0  # live entries
+        self.cond = threading.Condition()
+        self.closed = False
+        self.backlog_bytes = 0
+        self.max_backlog = 0
+        self.sent = 0
+        self.dropped = 0
+        self.replaced = 0
+
+    def __len__(self):
+        return self.size
+
+    def put(self, frame, key=None):
+        with self.cond:
+            if self.closed:
+                return False
+            old = self.keyed.get(key) if key is not None else None
+            if self.size >= self.max_size:
+                if old is not None:
+                    self.backlog_bytes += len(frame) - len(old[1])
+                    old[1] = frame
+                    self.replaced += 1
+                    return True
+                if not self._drop_oldest(self.superseded) and not self._drop_oldest(self.unkeyed) and key is None:
+                    self.dropped += 1
+                    return False
+            # frames are sent in order, so sent entries collect at the front of the candidates
+            for candidates in (self.superseded, self.unkeyed):
+                while candidates and candidates[0][1] is None:
+                    candidates.popleft()
+            entry = [key, frame]
+            self.frames.append(entry)
+            if key is None:
+                self.unkeyed.append(entry)
+            else:
+                if old is not None:
+                    self.superseded.append(old)
+                self.keyed[key] = entry
+            self.size += 1
+            self.backlog_bytes += len(frame)
+            self.max_backlog = max(self.max_backlog, self.size)
+            self.cond.notify()
+            return True
+
+    def _drop_oldest(self, candidates):
+        while candidates:
+            entry = candidates.popleft()
+            if entry[1] is not None:
+                self._forget(entry)
+                self.dropped += 1
+                return True
+        return False
+
+    def _forget(self, entry):
+        self.backlog_bytes -= len(entry[1])
+        entry[1] = None
+        self.size -= 1
+        if entry[0] is not None and self.keyed.get(entry[0]) is entry:
+            del self.keyed[entry[0]]
+
+    def get(self, block=True):
+        """ Get the next frame, waiting for one if block is set. Returns None once closed or if empty """
+        with self.cond:
+            while block and not self.size and not self.closed:
+                self.cond.wait()
+            if self.closed or not self.size:
+                return None
+            entry = self.frames.popleft()
+            while entry[1] is None:
+                entry = self.frames.popleft()
+            frame = entry[1]
+            self._forget(entry)
+            if not self.size:
+                # only dead entries are left
+                self.frames.clear()
+                self.superseded.clear()
+                self.unkeyed.clear()
+            self.sent += 1
+            return frame
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.frames.clear()
+            self.keyed.clear()
+            self.superseded.clear()
+            self.unkeyed.clear()
+            self.size = 0
+            self.backlog_bytes = 0
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "backlog": self.size,
+                "backlog_bytes": self.backlog_bytes,
+                "max_backlog": self.max_backlog,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "replaced": self.replaced,
+            }
+
+
+class MessageTooBig(Exception):
+    pass
+
+
+class PerMessageDeflate():
+    """
+    permessage-deflate (RFC 7692) state for one client, with context takeover.
+    Frames are compressed as they are written rather than in prepare_send_text,
+    as the compressed data depends on every frame sent to the client before it.
+    """
+
+    def __init__(self, window_bits=DEFAULT_DEFLATE_WINDOW_BITS, level=DEFAULT_DEFLATE_LEVEL, no_context_takeover=False):
+        self.window_bits = window_bits
+        self.level = level
+        self.no_context_takeover = no_context_takeover
+        self.compressor = self._new_compressor()
+        # the client's window is at most 15 bits, so this can inflate any of its messages
+        self.decompressor = zlib.decompressobj(-15)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _new_compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -self.window_bits)
 
-        return header + payload
+    @classmethod
+    def negotiate(cls, extensions, window_bits=DEFAULT_DEFLATE_WINDOW_BITS, level=DEFAULT_DEFLATE_LEVEL):
+        """
+        Accept the first permessage-deflate offer in a Sec-WebSocket-Extensions header.
+        Returns the extension for the response and the PerMessageDeflate,
+        or (None, None) if there is no offer we can accept.
+        """
+        for offer in extensions.split(","):
+            params = [param.strip() for param in offer.split(";")]
+            if params[0].lower() != "permessage-deflate":
+                continue
+            bits = window_bits
+            no_context_takeover = False
+            names = set()
+            for param in params[1:]:
+                name, _, value = param.partition("=")
+                name = name.strip().lower()
+                value = value.strip().strip('"')
+                if name in names:
+                    break
+                names.add(name)
+                if name == "server_no_context_takeover" and not value:
+                    no_context_takeover = True
+                elif name == "client_no_context_takeover" and not value:
+                    pass
+                elif name == "server_max_window_bits" and value.isdigit() and 8 <= int(value) <= 15:
+                    bits = min(bits, int(value))
+                elif name == "client_max_window_bits" and (not value or (value.isdigit() and 8 <= int(value) <= 15)):
+                    pass
+                else:
+                    break
+            else:
+                # zlib can't compress with an 8 bit window
+                if bits < 9:
+                    continue
+                response = "permessage-deflate"
+                if no_context_takeover:
+                    response += "; server_no_context_takeover"
+                if bits < 15 or "server_max_window_bits" in names:
+                    response += "; server_max_window_bits=%d" % bits
+                return response, cls(bits, level, no_context_takeover)
+        return None, None
+
+    def compress_frame(self, frame):
+        """ Compress a data frame built by prepare_send_text, control frames are returned as is """
+        opcode = frame[0] & OPCODE
+        if opcode != OPCODE_TEXT and opcode != OPCODE_BINARY:
+            return frame
+        payload_length = frame[1] & PAYLOAD_LEN
+        if payload_length == PAYLOAD_LEN_EXT16:
+            payload = frame[4:]
+        elif payload_length == PAYLOAD_LEN_EXT64:
+            payload = frame[10:]
+        else:
+            payload = frame[2:]
+        data = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        data = data[:-4] # remove the 00 00 ff ff the client adds back
+        if self.no_context_takeover:
+            self.compressor = self._new_compressor()
+        self.bytes_in += len(payload)
+        self.bytes_out += len(data)
+        return make_frame_header(frame[0] | RSV1, len(data)) + data
+
+    def decompress(self, payload, max_length=MAX_DECOMPRESSED_SIZE):
+        """ Inflate a message from the client, raises MessageTooBig if it inflates to more than max_length """
+        data = self.decompressor.decompress(payload + b'\x00\x00\xff\xff', max_length)
+        if self.decompressor.unconsumed_tail:
+            raise MessageTooBig("Decompressed message larger than %d bytes" % max_length)
+        return data
+
+    def stats(self):
+        return {
+            "deflate_bytes_in": self.bytes_in,
+            "deflate_bytes_out": self.bytes_out,
+        }
 
 
 class WebSocketHandler(StreamRequestHandler):
@@ -313,6 +571,7 @@ class WebSocketHandler(StreamRequestHandler):
         self.server = server
         assert not hasattr(self, "_send_lock"), "_send_lock already exists"
         self._send_lock = threading.Lock()
+        self.send_queue = SendQueue(server.send_queue_size)
         if server.key and server.cert:
             try:
                 socket = ssl.wrap_socket(socket, server_side=True, certfile=server.cert, keyfile=server.key)
@@ -322,9 +581,29 @@ class WebSocketHandler(StreamRequestHandler):
 
     def setup(self):
         StreamRequestHandler.setup(self)
+        self.client = None
+        self.deflate = None
         self.keep_alive = True
         self.handshake_done = False
         self.valid_client = False
+        self._writer = threading.Thread(target=self._write_queued, daemon=True)
+        self._writer.start()
+
+    def _write_queued(self):
+        while True:
+            frame = self.send_queue.get()
+            if frame is None:
+                return
+            if self.deflate:
+                frame = self.deflate.compress_frame(frame)
+            try:
+                with self._send_lock:
+                    self.request.sendall(frame)
+            except (SocketError, ValueError) as e:
+                logger.info("Client send failed: %s" % e)
+                self.keep_alive = False
+                self.send_queue.close()
+                return
 
     def handle(self):
         while self.keep_alive:
@@ -349,6 +628,7 @@ class WebSocketHandler(StreamRequestHandler):
             b1, b2 = 0, 0
 
         fin    = b1 & FIN
+        compressed = b1 & RSV1
         opcode = b1 & OPCODE
         masked = b2 & MASKED
         payload_length = b2 & PAYLOAD_LEN
@@ -361,12 +641,15 @@ class WebSocketHandler(StreamRequestHandler):
             logger.warning("Client must always be masked.")
             self.keep_alive = 0
             return
+        if compressed and not self.deflate:
+            logger.warning("Client sent a compressed frame without permessage-deflate.")
+            self.keep_alive = 0
+            return
         if opcode == OPCODE_CONTINUATION:
             logger.warning("Continuation frames are not supported.")
             return
         elif opcode == OPCODE_BINARY:
-            logger.warning("Binary frames are not supported.")
-            return
+            opcode_handler = self.server._binary_message_received_
         elif opcode == OPCODE_TEXT:
             opcode_handler = self.server._message_received_
         elif opcode == OPCODE_PING:
@@ -384,11 +667,23 @@ class WebSocketHandler(StreamRequestHandler):
             payload_length = struct.unpack(">Q", self.rfile.read(8))[0]
 
         masks = self.read_bytes(4)
-        message_bytes = bytearray()
-        for message_byte in self.read_bytes(payload_length):
-            message_byte ^= masks[len(message_bytes) % 4]
-            message_bytes.append(message_byte)
-        opcode_handler(self, message_bytes.decode('utf8'))
+        message_bytes = unmask_payload(self.read_bytes(payload_length), masks)
+        if compressed:
+            try:
+                message_bytes = self.deflate.decompress(message_bytes)
+            except zlib.error as e:
+                logger.warning("Client sent a message that could not be decompressed: %s" % e)
+                self.keep_alive = 0
+                return
+            except MessageTooBig as e:
+                logger.warning("Client sent a message that is too big: %s" % e)
+                self.send_close(CLOSE_STATUS_MESSAGE_TOO_BIG)
+                self.keep_alive = 0
+                return
+        if opcode == OPCODE_BINARY:
+            opcode_handler(self, bytes(message_bytes))
+        else:
+            opcode_handler(self, message_bytes.decode('utf8'))
 
     def send_message(self, message):
         self.send_text(message)
@@ -417,9 +712,8 @@ class WebSocketHandler(StreamRequestHandler):
         with self._send_lock:
             self.request.send(header + payload)
 
-    def send_raw(self, data):
-        with self._send_lock:
-            self.request.send(data)
+    def send_raw(self, data, key=None):
+        self.send_queue.put(data, key)
 
     def send_text(self, message, opcode=OPCODE_TEXT):
         """
@@ -437,33 +731,8 @@ class WebSocketHandler(StreamRequestHandler):
             logger.warning('Can\'t send message, message has to be a string or bytes. Got %s' % type(message))
             return False
 
-        header  = bytearray()
         payload = encode_to_UTF8(message)
-        payload_length = len(payload)
-
-        # Normal payload
-        if payload_length <= 125:
-            header.append(FIN | opcode)
-            header.append(payload_length)
-
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
-
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
-
-        else:
-            raise Exception("Message is too big. Consider breaking it into chunks.")
-            return
-
-        with self._send_lock:
-            self.request.send(header + payload)
+        self.send_queue.put(make_frame_header(FIN | opcode, len(payload)) + payload)
 
     def read_http_headers(self):
         headers = {}
@@ -495,20 +764,26 @@ class WebSocketHandler(StreamRequestHandler):
             self.keep_alive = False
             return
 
-        response = self.make_handshake_response(key)
+        extensions = None
+        if self.server.deflate and 'sec-websocket-extensions' in headers:
+            extensions, self.deflate = PerMessageDeflate.negotiate(headers['sec-websocket-extensions'], self.server.deflate_window_bits, self.server.deflate_level)
+
+        response = self.make_handshake_response(key, extensions)
         with self._send_lock:
             self.handshake_done = self.request.send(response.encode())
         self.valid_client = True
         self.server._new_client_(self)
 
     @classmethod
-    def make_handshake_response(cls, key):
-        return \
+    def make_handshake_response(cls, key, extensions=None):
+        response = \
           'HTTP/1.1 101 Switching Protocols\r\n'\
           'Upgrade: websocket\r\n'              \
           'Connection: Upgrade\r\n'             \
-          'Sec-WebSocket-Accept: %s\r\n'        \
-          '\r\n' % cls.calculate_response_key(key)
+          'Sec-WebSocket-Accept: %s\r\n' % cls.calculate_response_key(key)
+        if extensions:
+            response += 'Sec-WebSocket-Extensions: %s\r\n' % extensions
+        return response + '\r\n'
 
     @classmethod
     def calculate_response_key(cls, key):
@@ -518,6 +793,7 @@ class WebSocketHandler(StreamRequestHandler):
         return response_key.decode('ASCII')
 
     def finish(self):
+        self.send_queue.close()
         self.server._client_left_(self)
 
 
@@ -538,4 +814,38 @@ def try_decode_UTF8(data):
     except UnicodeDecodeError:
         return False
     except Exception as e:
-        raise(e)
\ No newline at end of file
+        raise(e)
+
+
+def make_frame_header(b1, payload_length):
+    header = bytearray()
+    header.append(b1)
+
+    # Normal payload
+    if payload_length <= 125:
+        header.append(payload_length)
+
+    # Extended payload
+    elif payload_length >= 126 and payload_length <= 65535:
+        header.append(PAYLOAD_LEN_EXT16)
+        header.extend(struct.pack(">H", payload_length))
+
+    # Huge extended payload
+    elif payload_length < 18446744073709551616:
+        header.append(PAYLOAD_LEN_EXT64)
+        header.extend(struct.pack(">Q", payload_length))
+
+    else:
+        raise Exception("Message is too big. Consider breaking it into chunks.")
+
+    return header
+
+
+def unmask_payload(payload, masks):
+    """
+    XOR the payload with the 4 byte mask, as one big integer
+    rather than a byte at a time
+    """
+    length = len(payload)
+    key = (bytes(masks) * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'little') ^ int.from_bytes(key, 'little')).to_bytes(length, 'little')
@@ -0,0 +1,181 @@
+"""
+Micro-benchmarks for the HiQnet parameter codec, run with
+python benchmark.py
+"""
+import struct
+import timeit
+
+from hiqnet_proto import *
+
+
+def decode_if_chain(param_id, datatype, data, i):
+    # the if/elif chain the PARAM_CODECS table replaced
+    datatype = ParamType(datatype)
+    if datatype == ParamType.BYTE:
+        return i+1, Parameter(param_id, datatype, struct.unpack_from(">b", data, i)[0])
+    elif datatype == ParamType.UBYTE:
+        return i+1, Parameter(param_id, datatype, struct.unpack_from(">B", data, i)[0])
+    elif datatype == ParamType.WORD:
+        return i+2, Parameter(param_id, datatype, struct.unpack_from(">h", data, i)[0])
+    elif datatype == ParamType.UWORD:
+        return i+2, Parameter(param_id, datatype, struct.unpack_from(">H", data, i)[0])
+    elif datatype == ParamType.LONG:
+        return i+4, Parameter(param_id, datatype, struct.unpack_from(">l", data, i)[0])
+    elif datatype == ParamType.ULONG:
+        return i+4, Parameter(param_id, datatype, struct.unpack_from(">L", data, i)[0])
+    elif datatype == ParamType.FLOAT32:
+        return i+4, Parameter(param_id, datatype, struct.unpack_from(">f", data, i)[0])
+    elif datatype == ParamType.FLOAT64:
+        return i+8, Parameter(param_id, datatype, struct.unpack_from(">d", data, i)[0])
+    elif datatype == ParamType.BLOCK:
+        length = int.from_bytes(data[i:i+2], "big")
+        return i+2+length, Parameter(param_id, datatype, bytes(data[i+2:i+2+length]))
+    elif datatype == ParamType.STRING:
+        length = int.from_bytes(data[i:i+2], "big")
+        return i+2+length, Parameter(param_id, datatype, bytes(data[i+2:i+2+length-2]).decode("UTF-16BE"))
+    elif datatype == ParamType.LONG64:
+        return i+8, Parameter(param_id, datatype, struct.unpack_from(">q", data, i)[0])
+    elif datatype == ParamType.ULONG64:
+        return i+8, Parameter(param_id, datatype, struct.unpack_from(">Q", data, i)[0])
+
+
+def encode_if_chain(param):
+    # the if/elif chain Parameter.encode replaced
+    if param.datatype == ParamType.BYTE:
+        return struct.pack(">b", param.value)
+    elif param.datatype == ParamType.UBYTE:
+        return struct.pack(">B", param.value)
+    elif param.datatype == ParamType.WORD:
+        return struct.pack(">h", param.value)
+    elif param.datatype == ParamType.UWORD:
+        return struct.pack(">H", param.value)
+    elif param.datatype == ParamType.LONG:
+        return struct.pack(">l", param.value)
+    elif param.datatype == ParamType.ULONG:
+        return struct.pack(">L", param.value)
+    elif param.datatype == ParamType.FLOAT32:
+        return struct.pack(">f", param.value)
+    elif param.datatype == ParamType.FLOAT64:
+        return struct.pack(">d", param.value)
+    elif param.datatype == ParamType.BLOCK:
+        return len(param.value).to_bytes(2, "big") + param.value
+    elif param.datatype == ParamType.STRING:
+        encoded = (param.value + "\x00").encode("UTF-16BE")
+        return len(encoded).to_bytes(2, "big") + encoded
+    elif param.datatype == ParamType.LONG64:
+        return struct.pack(">q", param.value)
+    elif param.datatype == ParamType.ULONG64:
+        return struct.pack(">Q", param.value)
+
+
+def decode_params(decode, data, num_params):
+    # the per parameter loop of MultiParamSet.decode
+    params = []
+    i = 2
+    for _ in range(num_params):
+        param_id = int.from_bytes(data[i:i+2], "big")
+        param_datatype = data[i+2]
+        i, param = decode(param_id, param_datatype, data, i+3)
+        params.append(param)
+    return params
+
+
+def decode_objects(decode, data):
+    # the per object and per parameter loops of MultiObjectParamSet.decode
+    object_params = {}
+    num_objects, = COUNT_STRUCT.unpack_from(data, 0)
+    i = COUNT_STRUCT.size
+    for _ in range(num_objects):
+        object_dest, num_params = OBJECT_STRUCT.unpack_from(data, i)
+        i += OBJECT_STRUCT.size
+        params = []
+        for _ in range(num_params):
+            param_id, param_datatype = PARAM_STRUCT.unpack_from(data, i)
+            i, param = decode(param_id, param_datatype, data, i + PARAM_STRUCT.size)
+            params.append(param)
+        if params:
+            object_params[object_dest] = params
+    return object_params
+
+
+def meter_objects(num_objects, num_params):
+    # a MultiObjectParamSet payload of meter objects, as a node sends for subscribed meters
+    return MultiObjectParamSet({
+        0x100 + o: [Parameter(p, ParamType.LONG, -200000 + o * 100 + p) for p in range(num_params)]
+        for o in range(num_objects)}, HiQnetHeader(HiQnetAddress())).get_payload()
+
+
+def payload(params):
+    # a MultiParamSet payload, as received from a node
+    return MultiParamSet(params, HiQnetHeader(HiQnetAddress())).get_payload()
+
+
+def best_of(fn, number, repeat=5):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def benchmark_decode():
+    print("Decode MultiParamSet payload:")
+    payloads = [
+        # meters are LONG values in 1/10000 dB
+        ("32 meters", payload([Parameter(p, ParamType.LONG, -200000 + p) for p in range(32)])),
+        ("200 meters", payload([Parameter(p, ParamType.LONG, -200000 + p) for p in range(200)])),
+        # a channel strip: gain, mute, polarity, pan, name
+        ("mixed", payload([
+            Parameter(0, ParamType.LONG, -100000),
+            Parameter(1, ParamType.UBYTE, 1),
+            Parameter(2, ParamType.UBYTE, 0),
+            Parameter(3, ParamType.FLOAT32, 0.25),
+            Parameter(4, ParamType.STRING, "Lectern Mic"),
+        ])),
+    ]
+    for name, data in payloads:
+        num_params = int.from_bytes(data[:2], "big")
+        expected = decode_params(decode_if_chain, data, num_params)
+        assert decode_params(Parameter.decode, data, num_params) == expected
+        _, ids, datatypes, values = Parameter.decode_many(data, 2, num_params)
+        assert list(map(Parameter, ids, datatypes, values)) == expected
+        number = max(1, 20000 // num_params)
+        old = best_of(lambda: decode_params(decode_if_chain, data, num_params), number)
+        new = best_of(lambda: decode_params(Parameter.decode, data, num_params), number)
+        many = best_of(lambda: Parameter.decode_many(data, 2, num_params), number)
+        print(f"  {name:>10}: if chain {old * 1e6:8.1f} us, table {new * 1e6:8.1f} us ({old / new:.1f}x), decode_many {many * 1e6:8.1f} us ({old / many:.1f}x)")
+
+
+def benchmark_decode_objects():
+    print("Decode MultiObjectParamSet payload:")
+    payloads = [
+        # single channel meters, e.g. one per input
+        ("40x1", meter_objects(40, 1)),
+        # level and gain reduction meters on each channel's dynamics
+        ("40x2", meter_objects(40, 2)),
+        # 16 channel meter blocks, the most that fit in one datagram
+        ("8x16", meter_objects(8, 16)),
+    ]
+    header = HiQnetHeader(HiQnetAddress())
+    for name, data in payloads:
+        assert len(data) + HEADER_LENGTH <= MAX_MTU
+        expected = decode_objects(decode_if_chain, data)
+        assert decode_objects(Parameter.decode, data) == expected
+        assert MultiObjectParamSet.decode(data, header).object_params == expected
+        # the decoded lists give the same packets as the Parameter objects
+        assert Packet.from_msg(MultiObjectParamSet.decode(data, header)) == Packet.from_msg(MultiObjectParamSet(expected, header))
+        old = best_of(lambda: decode_objects(decode_if_chain, data), 100, repeat=20)
+        new = best_of(lambda: decode_objects(Parameter.decode, data), 100, repeat=20)
+        decode = best_of(lambda: MultiObjectParamSet.decode(data, header), 100, repeat=20)
+        print(f"  {name:>10}: if chain {old * 1e6:8.1f} us, table {new * 1e6:8.1f} us ({old / new:.1f}x), MultiObjectParamSet.decode {decode * 1e6:8.1f} us ({old / decode:.1f}x)")
+
+
+def benchmark_encode():
+    print("Encode parameter:")
+    for param in [Parameter(0, ParamType.UBYTE, 1), Parameter(0, ParamType.LONG, -200000), Parameter(0, ParamType.STRING, "Lectern Mic")]:
+        assert encode_if_chain(param) == param.encode()
+        old = best_of(lambda: encode_if_chain(param), 20000)
+        new = best_of(param.encode, 20000)
+        print(f"  {param.datatype.name:>10}: if chain {old * 1e6:6.2f} us, table {new * 1e6:6.2f} us ({old / new:.1f}x)")
+
+
+if __name__ == "__main__":
+    benchmark_decode()
+    benchmark_decode_objects()
+    benchmark_encode()
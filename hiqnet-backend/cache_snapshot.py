@@ -0,0 +1,38 @@
+import json, os, time
+from typing import Dict, Optional
+
+from param_cache import ParamCache
+from subscriptions import SubscriptionRegistry
+
+SNAPSHOT_VERSION = 1
+
+def save_snapshot(filename: str, caches: Dict[str, ParamCache], registries: Dict[str, SubscriptionRegistry]):
+    """
+    Write the cached values (by message type) and the subscriptions (by node) to filename.
+    Both are saved as lists, of [parameter string, value] and [message type, parameter string].
+    """
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "time": time.time(),
+        "values": {msg_type: [[parameter, entry.value] for parameter, entry in cache.items()] for msg_type, cache in caches.items()},
+        "subscriptions": {node: [[sub.packet.message_type.name, sub.packet.param_str()] for sub in registry.snapshot()] for node, registry in registries.items()},
+    }
+    # write then rename, so a restart while saving can't leave half a file
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(tmp_filename, filename)
+
+def load_snapshot(filename: str) -> Optional[dict]:
+    try:
+        with open(filename) as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as ex:
+        print("Error loading cache snapshot:", ex, flush=True)
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+        print("Ignoring cache snapshot from a different version", flush=True)
+        return None
+    return snapshot
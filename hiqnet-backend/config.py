@@ -20,6 +20,17 @@ def default_config() -> Dict[str, Any]:
         "support_email": "example@example.com",
         "proxy_ip_header": None,
         "proxy_port_header": None,
+        "shared_event_loop": False,
+        "batch_window_ms": 20,
+        "websocket_engine": "threaded",
+        "websocket_deflate": False,
+        "websocket_deflate_window_bits": 15,
+        "websocket_deflate_level": 6,
+        "deadband": {"SET": 0, "SET_PERCENT": 0},
+        "deadband_parameters": {},
+        "cache_snapshot_file": "config/cache_snapshot.json",
+        "cache_snapshot_interval_s": 30,
+        "cache_snapshot_grace_s": 600,
     }
 
 def check_list_type(l: list, v_type) -> bool:
@@ -53,6 +64,9 @@ def check_node_address(s: str) -> bool:
     node_addr_regex = r"^0[xX]([0-9a-fA-F]{1,4})$"
     return bool(re.match(node_addr_regex, s))
 
+def check_deadbands(d: dict) -> bool:
+    return check_dict_type(d, str, int) and all(v >= 0 for v in d.values())
+
 def invalid_message(key):
     print(f"Invalid value for {key} in config")
 
@@ -74,6 +88,17 @@ config_tests = {
     "support_email": lambda x: isinstance(x, str),
     "proxy_ip_header": lambda x: x is None or isinstance(x, str),
     "proxy_port_header": lambda x: x is None or isinstance(x, str),
+    "shared_event_loop": lambda x: isinstance(x, bool),
+    "batch_window_ms": lambda x: check_range(x, 1, 1000),
+    "websocket_engine": lambda x: x in ("threaded", "asyncio"),
+    "websocket_deflate": lambda x: isinstance(x, bool),
+    "websocket_deflate_window_bits": lambda x: check_range(x, 9, 15),
+    "websocket_deflate_level": lambda x: check_range(x, 0, 9),
+    "deadband": lambda x: check_deadbands(x),
+    "deadband_parameters": lambda x: check_deadbands(x),
+    "cache_snapshot_file": lambda x: isinstance(x, str),
+    "cache_snapshot_interval_s": lambda x: check_range(x, 1, 86400),
+    "cache_snapshot_grace_s": lambda x: check_range(x, 0, 86400),
 }
 
 def load_config(config_filename: str = "config.json", disable_save = False) -> dict:
@@ -1,9 +1,11 @@
-import asyncore, asyncio, threading, time, functools, socket, uuid
+import asyncore, asyncio, threading, time, functools, socket, struct, uuid
 from janus import Queue, SyncQueue, SyncQueueEmpty, SyncQueueFull
 import janus
 import traceback as tb
+from typing import List
 
 from hiqnet_proto import *
+from subscriptions import SubscriptionRegistry
 
 RX_MSG_SIZE = 4096
 UDP_TEST_INTERVAL = 5 # 5 seconds
@@ -23,17 +25,10 @@ ATTR_NAME = "Soundweb Control"
 
 SEQ_NUM_MIN_DIST = 0x1000
 SEQ_NUM_TIMEOUT = 10 # 10 seconds
-
-def run_in_executor(f):
-    @functools.wraps(f)
-    def inner(*args, **kwargs):
-        loop = asyncio.get_running_loop()
-        return loop.run_in_executor(None, lambda: f(*args, **kwargs))
-
-    return inner
+SET_MERGE_WINDOW = 0.005 # 5 ms to wait for more SETs to send with the first
 
 class HiQnetClientProtocol(asyncio.Protocol):
-    def __init__(self, name: str, h_id: str, node_id: int, msg_queue: SyncQueue, resp_queue: SyncQueue, subscribed_params: list, health_queue: SyncQueue, disco_info: DiscoveryInformation, loop):
+    def __init__(self, name: str, h_id: str, node_id: int, msg_queue: Queue, resp_queue: SyncQueue, subscribed_params: SubscriptionRegistry, health_queue: SyncQueue, disco_info: DiscoveryInformation, queue_loop, loop):
         self.name = name
         self.h_id = h_id
         self.node_id = node_id
@@ -43,10 +38,11 @@ class HiQnetClientProtocol(asyncio.Protocol):
         self.health_queue = health_queue
         self.disco_info = disco_info
         self._ready = asyncio.Event()
+        self.queue_loop = queue_loop
         self.loop = loop
         self.send_task = loop.create_task(self.send_messages())
         self.transport = None
-        self.read_buffer = b""
+        self.framer = MessageFramer()
         self.last_time = 0
         self.keepalive_interval_ms = self.disco_info.keep_alive_ms
         self.seq = 0
@@ -61,27 +57,45 @@ class HiQnetClientProtocol(asyncio.Protocol):
         self.seq = (s+1) % 0x10000 # max is 0xffff
         return s
 
-    @run_in_executor
-    def get_next_message(self):  # Your wrapper for async use
-        if self.msg_queue.closed:
-            self.end_connection()
-            return
-        try:
-            return self.msg_queue.get(timeout=1)
-        except SyncQueueEmpty:
-            pass
+    async def get_next_message(self):
+        """ Wait on the async side of the message queue, which lives on the main loop """
+        fut = asyncio.run_coroutine_threadsafe(self.msg_queue.async_q.get(), self.queue_loop)
+        return await asyncio.wrap_future(fut)
 
     async def send_messages(self):
         """ Send messages to the server as they become available. """
         await self._ready.wait()
         while True:
+            if self.msg_queue.closed or self.queue_loop.is_closed():
+                return
             p = await self.get_next_message()
-            if p:
+            if not p:
+                continue
+            packets = [p]
+            if p.message_type == MessageType.SET:
+                # wait for the rest of a group of SETs (e.g. a mute group) so they go in one message
+                await asyncio.sleep(SET_MERGE_WINDOW)
+                packets += self.get_queued_messages()
+            for msg in Packet.merge_sets(packets):
                 try:
-                    self.transport.write(p.to_msg().encode(self.next_seq()))
-                except UnsupportedMessage as ex:
+                    if type(msg) == UnsupportedMessage:
+                        raise msg
+                    self.transport.write(msg.encode(self.next_seq()))
+                except (UnsupportedMessage, struct.error) as ex:
+                    # only this message is lost, the send task keeps running
                     print(self.name, "Error Sending Message:", ex, flush=True)
 
+    def get_queued_messages(self) -> List[Packet]:
+        packets = []
+        while not self.msg_queue.closed:
+            try:
+                p = self.msg_queue.sync_q.get_nowait()
+            except SyncQueueEmpty:
+                break
+            if p:
+                packets.append(p)
+        return packets
+
     def send_keepalive(self, transport):
         if self.last_time:
             disco_info_msg = DiscoInfo(self.disco_info, is_query=True, header=HiQnetHeader(self.node_addr))
@@ -107,41 +121,41 @@ class HiQnetClientProtocol(asyncio.Protocol):
         self.resubscribe(transport)
         
         # empty message queue to clear delayed commands (otherwise could cause unexpected changes on connection)
-        while (not self.msg_queue.closed) and (not self.msg_queue.empty()):
-            self.msg_queue.get(timeout=1)
+        while not self.msg_queue.closed:
+            try:
+                self.msg_queue.sync_q.get_nowait()
+            except SyncQueueEmpty:
+                break
         self.transport = transport
         # clear read buffer
-        self.read_buffer = b""
+        self.framer = MessageFramer()
         self._ready.set()
 
     def resubscribe(self, transport):
         if self.subscribed_params:
-            for p in self.subscribed_params:
-                # unsubscribe first to get value sent to us
-                has_unsub = False
-                p2 = p.copy()
-                if p.message_type == MessageType.SUBSCRIBE:
-                    p2.message_type = MessageType.UNSUBSCRIBE
-                    has_unsub = True
-                elif p.message_type == MessageType.SUBSCRIBE_PERCENT:
-                    p2.message_type = MessageType.UNSUBSCRIBE_PERCENT
-                    has_unsub = True
-                if has_unsub:
-                    try:
-                        transport.write(p2.to_msg().encode(self.next_seq()))
-                    except UnsupportedMessage as ex:
-                        print(self.name, "Error Sending Unsubscription:", ex, flush=True)
+            subs = self.subscribed_params.snapshot()
+            # unsubscribe first to get value sent to us, with the parameters of each object in as few messages as possible
+            try:
+                for msg in Packet.to_msgs([sub.unsub_packet for sub in subs if sub.unsub_packet]):
+                    transport.write(msg.encode(self.next_seq()))
+            except UnsupportedMessage as ex:
+                print(self.name, "Error Sending Unsubscription:", ex, flush=True)
 
-                try:
-                    transport.write(p.to_msg().encode(self.next_seq()))
-                except UnsupportedMessage as ex:
-                    print(self.name, "Error Sending Subscription:", ex, flush=True)
+            try:
+                for msg in Packet.to_msgs([sub.packet for sub in subs]):
+                    transport.write(msg.encode(self.next_seq()))
+            except UnsupportedMessage as ex:
+                print(self.name, "Error Sending Subscription:", ex, flush=True)
         
     def data_received(self, data):
         try:
-            msgs = decode_message(data)
+            data = self.framer.feed(data)
         except DecodeFailed as ex:
-            print("Decode Error:", ex)
+            print(self.name, "Decode Error:", ex, flush=True)
+            return
+        if not data:
+            return
+        msgs = decode_message(data)
         
         resp_data = []
         for msg in msgs:
@@ -195,9 +209,11 @@ class HiQnetClientProtocol(asyncio.Protocol):
         print(self.name, "Connection Error:", exc, flush=True)
         self.end_connection()
 
-class HiQnetThread(threading.Thread):
-    def __init__(self, name: str, h_id: str, node_id: int, hiqnet_ip: str, hiqnet_port: int, msg_queue: Queue, resp_queue: Queue, subscribed_params: list, health_check_queue: Queue, disco_info: DiscoveryInformation):
-        super().__init__(daemon=True)
+class HiQnetConnection:
+    """ A connection to a single HiQnet node, reconnecting until exitFlag is set """
+    def __init__(self, name: str, h_id: str, node_id: int, hiqnet_ip: str, hiqnet_port: int, msg_queue: Queue, resp_queue: Queue, subscribed_params: SubscriptionRegistry, health_check_queue: Queue, disco_info: DiscoveryInformation):
+        # janus queues are bound to the loop they were created on
+        self.queue_loop = asyncio.get_running_loop()
         self.name = name
         self.h_id = h_id
         self.node_id = node_id
@@ -212,19 +228,22 @@ class HiQnetThread(threading.Thread):
         self.exitFlag = False
         self.restartFlag = False
         self.fast_reconnect = False
+
+    async def keepalive(self, protocol: HiQnetClientProtocol, transport):
+        """ Send keepalives at the interval negotiated with the node """
+        while True:
+            await asyncio.sleep(max(1, protocol.keepalive_interval_ms / 1000))
+            protocol.send_keepalive(transport)
+
     async def createClient(self, loop):
         transport, protocol = await loop.create_connection(
             lambda: HiQnetClientProtocol(self.name, self.h_id, self.node_id,
-                self.msg_queue.sync_q, self.resp_queue.sync_q,
-                self.subscribed_params, self.health_queue.sync_q, self.disco_info, loop),
+                self.msg_queue, self.resp_queue.sync_q,
+                self.subscribed_params, self.health_queue.sync_q, self.disco_info, self.queue_loop, loop),
             self.hiqnet_ip, self.hiqnet_port)
-        n = 0
+        keepalive_task = loop.create_task(self.keepalive(protocol, transport))
         while not self.exitFlag and not self.restartFlag:
             await asyncio.sleep(1)
-            n += 1  # check connection is alive every 10 seconds
-            if n >= protocol.keepalive_interval_ms / 1000:
-                n = 0
-                protocol.send_keepalive(transport)
             # check how long since last message
             if protocol.last_time:
                 # use 2x timeout period to be nice
@@ -236,37 +255,83 @@ class HiQnetThread(threading.Thread):
             # be good and send a Goodbye message
             protocol.send_goodbye(transport)
         transport.close()
-        # cancel send task
+        # cancel send and keepalive tasks
         protocol.send_task.cancel()
-        try:
-            await protocol.send_task
-        except asyncio.CancelledError:
-            pass
-    def run(self):
+        keepalive_task.cancel()
+        for task in [protocol.send_task, keepalive_task]:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
         print(self.name, "started", flush=True)
+        loop = asyncio.get_running_loop()
         while not self.exitFlag:
             self.restartFlag = False
             self.fast_reconnect = False
             try:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                client_task = loop.create_task(self.createClient(loop))
-                loop.run_until_complete(client_task)
-                loop.stop()
-                loop.close()
+                await self.createClient(loop)
             except Exception as ex:
                 print(self.name, "Error:", ex, flush=True)
             self.health_queue.sync_q.put({"id": self.h_id, "status": False})
             if not self.exitFlag:
                 if self.fast_reconnect:
                     print(self.name, "HiQnet thread timeout, Reconnecting now", flush=True)
-                    time.sleep(0.5)
+                    await asyncio.sleep(0.5)
                 else:
                     print(self.name, "Disconnected from HiQnet, Reconnecting in 5 seconds", flush=True)
                     for i in range(5):
                         if self.exitFlag:
                             break
-                        time.sleep(1)
+                        await asyncio.sleep(1)
+        print(self.name, "exited", flush=True)
+
+class HiQnetThread(threading.Thread):
+    """ Runs a single HiQnetConnection on its own event loop """
+    def __init__(self, *args, **kwargs):
+        super().__init__(daemon=True)
+        self.connection = HiQnetConnection(*args, **kwargs)
+        self.name = self.connection.name
+
+    @property
+    def exitFlag(self):
+        return self.connection.exitFlag
+
+    @exitFlag.setter
+    def exitFlag(self, value):
+        self.connection.exitFlag = value
+
+    @property
+    def restartFlag(self):
+        return self.connection.restartFlag
+
+    @restartFlag.setter
+    def restartFlag(self, value):
+        self.connection.restartFlag = value
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.connection.run())
+        loop.close()
+
+class HiQnetConnectionManager(threading.Thread):
+    """ Runs every HiQnetConnection as a task on one shared event loop """
+    def __init__(self, connections: list):
+        super().__init__(daemon=True)
+        self.name = "HiQnet Connection Manager"
+        self.connections = connections
+
+    async def run_connections(self):
+        await asyncio.gather(*[c.run() for c in self.connections])
+
+    def run(self):
+        print(self.name, "started", flush=True)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.run_connections())
+        loop.close()
         print(self.name, "exited", flush=True)
 
 class HiQnetUDPListenerProtocol(asyncio.DatagramProtocol):
@@ -638,6 +703,7 @@ class HiQnetTCPListenerProtocol(asyncio.Protocol):
         self.seq = 0
         self.peername = None
         self.decode_queue = Queue(200)
+        self.framer = MessageFramer()
         self.decode_thread = None
         self.reply_header = None
         self.send_keepalives = False
@@ -705,7 +771,12 @@ class HiQnetTCPListenerProtocol(asyncio.Protocol):
             print(self.name, f"Error Sending TCP Discovery Info to {self.peername}:", ex)
 
     def data_received(self, data):
-        if not self.decode_queue.sync_q.closed:
+        try:
+            data = self.framer.feed(data)
+        except DecodeFailed as ex:
+            print(self.name, f"Decode Error from {self.peername}:", ex, flush=True)
+            return
+        if data and not self.decode_queue.sync_q.closed:
             self.decode_queue.sync_q.put(data)
 
     def connection_lost(self, exc):
@@ -1,7 +1,7 @@
 from enum import Enum
 import dataclasses
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 import struct, re
 
 class DecodeFailed(Exception):
@@ -29,6 +29,12 @@ MAX_SEQ_NUM = 0xffff
 # MAX_MTU = 1048576
 # Takes from BLU-100, seems to be a common value
 MAX_MTU = 1452 # also in DiscoveryInformation
+# largest message accepted from a stream, anything bigger is treated as corrupt
+MAX_MESSAGE_LENGTH = 1048576
+# version, header length, message length, addresses, message id, flags, hop count and sequence number (no session number)
+HEADER_LENGTH = UBYTE + UBYTE + ULONG + 2 * HIQNETADDR + UWORD + UWORD + UBYTE + UWORD
+# the same fields, with the addresses split into device, v_device and obj_id (as a high byte and low word)
+HEADER_STRUCT = struct.Struct(">BBL" + "HBBH" * 2 + "HHBH")
 
 @dataclass
 class HiQnetAddress:
@@ -88,6 +94,9 @@ class MessageID(Enum):
     ParamSetPercent = 0x0102
     ParamSubscribePercent = 0x0111
 
+# raw message id -> MessageID, faster than MessageID(value)
+MESSAGE_IDS = {m.value: m for m in MessageID}
+
 # See Foundation.Interfaces.eNmAttributes
 class AttributeID(Enum):
     # All devices should support these
@@ -155,7 +164,10 @@ class HiQnetFlags:
 
     @classmethod
     def decode(cls, data):
-        flags = int.from_bytes(data, "big")
+        return cls.from_int(int.from_bytes(data, "big"))
+
+    @classmethod
+    def from_int(cls, flags: int):
         return cls(
             session_id = (flags & 0x0100) != 0,
             multi_part = (flags & 0x0040) != 0,
@@ -213,49 +225,50 @@ class HiQnetHeader:
         return data
 
     @classmethod
-    def decode(cls, data):
-        version = data[0]
+    def decode(cls, data, offset: int = 0):
+        """
+        Decode the header of the message at offset in data (bytes or a memoryview),
+        returns the header, the message as a slice of data and the offset of the next message
+        """
+        if len(data) - offset < HEADER_STRUCT.size:
+            raise DecodeFailed("Header too short!")
+        (version, header_length, message_length,
+            src_device, src_v_device, src_obj_high, src_obj_low,
+            dest_device, dest_v_device, dest_obj_high, dest_obj_low,
+            message_id, flags, hop_count, seq_number) = HEADER_STRUCT.unpack_from(data, offset)
         if version != HiQnetHeader.VERSION:
             raise DecodeFailed(f"Invalid version: {version}")
-        if len(data) < data[1]:
+        if len(data) - offset < header_length or header_length < HEADER_STRUCT.size:
             raise DecodeFailed("Header too short!")
-        header = data[2:data[1]]
-
-        message_length = int.from_bytes(header[:4], "big")
-        if len(data) < message_length and False:
+        if message_length < header_length:
             raise DecodeFailed("Incorrect message length")
 
-        source_addr = HiQnetAddress.decode(header[4:10])
-        dest_addr = HiQnetAddress.decode(header[10:16])
+        source_addr = HiQnetAddress(src_device, src_v_device, src_obj_high << 16 | src_obj_low)
+        dest_addr = HiQnetAddress(dest_device, dest_v_device, dest_obj_high << 16 | dest_obj_low)
         if dest_addr.device != MY_ADDRESS.device and not dest_addr.is_broadcast():
             raise IncorrectDestination(f"Incorrect destination address {dest_addr}")
 
-        message_id = int.from_bytes(header[16:18], "big")
         try:
-            message_id = MessageID(message_id)
-        except ValueError:
+            message_id = MESSAGE_IDS[message_id]
+        except KeyError:
             raise DecodeFailed(f"Unknown Message ID: {message_id}")
 
-        flags = HiQnetFlags.decode(header[18:20])
-        hop_count = header[20]
-        seq_number = int.from_bytes(header[21:23], "big")
+        flags = HiQnetFlags.from_int(flags)
 
         if flags.error_header: # error header extension
-            error_code = int.from_bytes(header[21:23], "big")
-            error_msg = header[23:]
+            error_code = seq_number
+            error_msg = bytes(data[offset+HEADER_STRUCT.size:offset+header_length])
             raise DecodeFailed(f"Received error: {error_code} = {error_msg}")
 
         if flags.multi_part: # multi part
-            start_seq_num = int.from_bytes(header[21:23], "big")
-            bytes_remaining = int.from_bytes(header[23:27], "big")
             raise DecodeFailed(f"Multi-Part messages not supported")
 
         session_num = 0
         if flags.session_id: # session num
-            session_num = int.from_bytes(header[21:23], "big")
+            session_num = seq_number
             # raise DecodeFailed(f"Sessions not supported")
 
-        message = data[data[1]:message_length]
+        message = data[offset+header_length:offset+message_length]
 
         return cls(
             source_address=source_addr,
@@ -265,7 +278,7 @@ class HiQnetHeader:
             hop_count=hop_count,
             sequence_number=seq_number,
             session_id=session_num
-        ), message, data[message_length:]
+        ), message, offset + message_length
 
 class HiQnetMessage:
     def __init__(self, header: HiQnetHeader):
@@ -286,14 +299,23 @@ class HiQnetMessage:
     def decode(cls, data: bytes, header: HiQnetHeader):
         raise DecodeFailed("decode not implemented")
 
+# parameter messages, the bulk of what we receive, are decoded straight from a view of the data.
+# the rest get a copy, as their decoders keep slices of it
+VIEW_MESSAGE_IDS = {MessageID.MultiObjectParamSet, MessageID.MultiParamSet, MessageID.ParamSetPercent}
+
 def decode_message(data) -> List[HiQnetMessage]:
     msgs = []
-    while len(data):
+    # messages are decoded from views of data, so the rest of it is never copied
+    data = memoryview(data)
+    offset = 0
+    while offset < len(data):
         try:
-            header, message, data = HiQnetHeader.decode(data)
+            header, message, offset = HiQnetHeader.decode(data, offset)
         except (IncorrectDestination, DecodeFailed) as ex:
             msgs.append(ex)
             break
+        if header.message_id not in VIEW_MESSAGE_IDS:
+            message = bytes(message)
 
         try:
             if header.message_id == MessageID.DiscoInfo:
@@ -306,6 +328,8 @@ def decode_message(data) -> List[HiQnetMessage]:
                 msgs.append(Goodbye.decode(message, header))
             elif header.message_id == MessageID.MultiObjectParamSet:
                 msgs.append(MultiObjectParamSet.decode(message, header))
+            elif header.message_id == MessageID.MultiParamSet:
+                msgs.append(MultiParamSet.decode(message, header))
             elif header.message_id == MessageID.ParamSetPercent:
                 msgs.append(ParamSetPercent.decode(message, header))
             elif header.message_id == MessageID.MultiParamGet:
@@ -327,8 +351,63 @@ def decode_message(data) -> List[HiQnetMessage]:
                 raise DecodeFailed(f"Message ID {header.message_id} not implemented")
         except DecodeFailed as ex: 
             msgs.append(ex)
+        except (struct.error, IndexError) as ex:
+            msgs.append(DecodeFailed(f"{header.message_id.name} too short: {ex}"))
+        except ValueError as ex:
+            msgs.append(DecodeFailed(f"{header.message_id.name} invalid: {ex}"))
     return msgs
 
+class MessageFramer:
+    """
+    Splits a TCP stream into whole HiQnet messages, using the message length in each header.
+    Data is added to one buffer and read from an offset, the buffer is only compacted
+    once everything in it has been read or the read part is most of it.
+    """
+    # version, header length and message length
+    PREFIX = struct.Struct(">BBL")
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def feed(self, data: bytes) -> bytes:
+        """ Add data from the stream, returns the messages it completed (for decode_message) """
+        buf = self.buffer
+        buf += data
+        start = pos = self.offset
+        while len(buf) - pos >= self.PREFIX.size:
+            version, header_length, message_length = self.PREFIX.unpack_from(buf, pos)
+            # a length shorter than a header would never advance pos
+            if (version != HiQnetHeader.VERSION or header_length < HEADER_LENGTH
+                    or message_length < header_length or message_length > MAX_MESSAGE_LENGTH):
+                # we can't find the next message, start again from the next read
+                buf.clear()
+                self.offset = 0
+                raise DecodeFailed(f"Invalid message prefix: version {version}, header length {header_length}, length {message_length}")
+            if len(buf) - pos < message_length:
+                break # wait for the rest of the message
+            pos += message_length
+
+        messages = bytes(buf[start:pos])
+        if pos == len(buf):
+            buf.clear()
+            pos = 0
+        elif pos > len(buf) // 2:
+            del buf[:pos]
+            pos = 0
+        self.offset = pos
+        return messages
+
+def __test_framer_rejects(data: bytes):
+    try:
+        MessageFramer().feed(data)
+    except DecodeFailed:
+        return True
+    return False
+# zero length and too short prefixes must be rejected, not loop forever
+assert __test_framer_rejects(bytes([2, 0, 0, 0, 0, 0, 0, 0])), "Failed to reject zero length message"
+assert __test_framer_rejects(bytes([2, 6, 0, 0, 0, 6, 0, 0])), "Failed to reject message shorter than a header"
+
 class ParamType(Enum):
     BYTE = 0
     UBYTE = 1
@@ -343,6 +422,56 @@ class ParamType(Enum):
     LONG64 = 10
     ULONG64 = 11
 
+def encode_block(value: bytes) -> bytes:
+    return len(value).to_bytes(2, "big") + value
+
+def decode_block(data, i: int) -> Tuple[int, bytes]:
+    length = int.from_bytes(data[i:i+2], "big")
+    return i+2+length, bytes(data[i+2:i+2+length])
+
+def encode_string(value: str) -> bytes:
+    encoded = (value + "\x00").encode("UTF-16BE") # append null byte
+    return len(encoded).to_bytes(2, "big") + encoded
+
+def decode_string(data, i: int) -> Tuple[int, str]:
+    length = int.from_bytes(data[i:i+2], "big")
+    try:
+        return i+2+length, bytes(data[i+2:i+2+length-2]).decode("UTF-16BE") # remove null byte
+    except UnicodeDecodeError as ex:
+        raise DecodeFailed(f"Invalid string parameter: {ex}")
+
+class ParamCodec(NamedTuple):
+    datatype: ParamType
+    # the value, for fixed size datatypes
+    value_struct: Optional[struct.Struct]
+    # parameter id, datatype and value, to decode a fixed size parameter in one unpack
+    param_struct: Optional[struct.Struct]
+    # for variable size datatypes, decode returns the offset after the value and the value
+    encode: Optional[Callable[[Any], bytes]] = None
+    decode: Optional[Callable[[Any, int], Tuple[int, Any]]] = None
+
+def fixed_size_codec(datatype: ParamType, value_format: str) -> ParamCodec:
+    return ParamCodec(datatype, struct.Struct(">" + value_format), struct.Struct(">HB" + value_format))
+
+# raw datatype -> codec
+PARAM_CODECS: List[ParamCodec] = [
+    fixed_size_codec(ParamType.BYTE, "b"),
+    fixed_size_codec(ParamType.UBYTE, "B"),
+    fixed_size_codec(ParamType.WORD, "h"),
+    fixed_size_codec(ParamType.UWORD, "H"),
+    fixed_size_codec(ParamType.LONG, "l"),
+    fixed_size_codec(ParamType.ULONG, "L"),
+    fixed_size_codec(ParamType.FLOAT32, "f"),
+    fixed_size_codec(ParamType.FLOAT64, "d"),
+    ParamCodec(ParamType.BLOCK, None, None, encode_block, decode_block),
+    ParamCodec(ParamType.STRING, None, None, encode_string, decode_string),
+    fixed_size_codec(ParamType.LONG64, "q"),
+    fixed_size_codec(ParamType.ULONG64, "Q"),
+]
+
+# parameter id and datatype, followed by the value
+PARAM_STRUCT = struct.Struct(">HB")
+
 @dataclass
 class Parameter:
     param_id: int
@@ -350,71 +479,48 @@ class Parameter:
     value: Any
 
     def encode(self):
-        if self.datatype == ParamType.BYTE:
-            return struct.pack(">b", self.value)
-        elif self.datatype == ParamType.UBYTE:
-            return struct.pack(">B", self.value)
-        elif self.datatype == ParamType.WORD:
-            return struct.pack(">h", self.value)
-        elif self.datatype == ParamType.UWORD:
-            return struct.pack(">H", self.value)
-        elif self.datatype == ParamType.LONG:
-            return struct.pack(">l", self.value)
-        elif self.datatype == ParamType.ULONG:
-            return struct.pack(">L", self.value)
-        elif self.datatype == ParamType.FLOAT32:
-            return struct.pack(">f", self.value)
-        elif self.datatype == ParamType.FLOAT64:
-            return struct.pack(">d", self.value)
-        elif self.datatype == ParamType.BLOCK:
-            return len(self.value).to_bytes(2, "big") + self.value
-        elif self.datatype == ParamType.STRING:
-            encoded = (self.value + "\x00").encode("UTF-16BE") # append null byte
-            return len(encoded).to_bytes(2, "big") + encoded
-        elif self.datatype == ParamType.LONG64:
-            return struct.pack(">q", self.value)
-        elif self.datatype == ParamType.ULONG64:
-            return struct.pack(">Q", self.value)
-        else:
-            raise EncodeFailed(f"Unknown Parameter Datatype {self.datatype}")
+        if not isinstance(self.datatype, ParamType):
+            raise EncodeFailed(f"Unknown Parameter Datatype {self.datatype!r}")
+        codec = PARAM_CODECS[self.datatype.value]
+        if codec.value_struct is not None:
+            return codec.value_struct.pack(self.value)
+        return codec.encode(self.value)
 
     @classmethod
     def decode(cls, param_id: int, datatype: int, data: bytes, i: int):
-        try:
-            datatype = ParamType(datatype)
-        except ValueError:
-            raise DecodeFailed(f"Unknown Parameter Datatype {datatype}")
-        
-        if datatype == ParamType.BYTE:
-            return i+1, cls(param_id, datatype, struct.unpack_from(">b", data, i)[0])
-        elif datatype == ParamType.UBYTE:
-            return i+1, cls(param_id, datatype, struct.unpack_from(">B", data, i)[0])
-        elif datatype == ParamType.WORD:
-            return i+2, cls(param_id, datatype, struct.unpack_from(">h", data, i)[0])
-        elif datatype == ParamType.UWORD:
-            return i+2, cls(param_id, datatype, struct.unpack_from(">H", data, i)[0])
-        elif datatype == ParamType.LONG:
-            return i+4, cls(param_id, datatype, struct.unpack_from(">l", data, i)[0])
-        elif datatype == ParamType.ULONG:
-            return i+4, cls(param_id, datatype, struct.unpack_from(">L", data, i)[0])
-        elif datatype == ParamType.FLOAT32:
-            return i+4, cls(param_id, datatype, struct.unpack_from(">f", data, i)[0])
-        elif datatype == ParamType.FLOAT64:
-            return i+8, cls(param_id, datatype, struct.unpack_from(">d", data, i)[0])
-        elif datatype == ParamType.BLOCK:
-            length = int.from_bytes(data[i:i+2], "big")
-            value = data[i+2:i+2+length]
-            return i+2+length, cls(param_id, datatype, value)
-        elif datatype == ParamType.STRING:
-            length = int.from_bytes(data[i:i+2], "big")
-            value = data[i+2:i+2+length-2].decode("UTF-16BE") # remove null byte
-            return i+2+length, cls(param_id, datatype, value)
-        elif datatype == ParamType.LONG64:
-            return i+8, cls(param_id, datatype, struct.unpack_from(">q", data, i)[0])
-        elif datatype == ParamType.ULONG64:
-            return i+8, cls(param_id, datatype, struct.unpack_from(">Q", data, i)[0])
-        else:
+        if datatype >= len(PARAM_CODECS):
             raise DecodeFailed(f"Unknown Parameter Datatype {datatype}")
+        codec = PARAM_CODECS[datatype]
+        if codec.value_struct is not None:
+            return i + codec.value_struct.size, cls(param_id, codec.datatype, codec.value_struct.unpack_from(data, i)[0])
+        i, value = codec.decode(data, i)
+        return i, cls(param_id, codec.datatype, value)
+
+    @staticmethod
+    def decode_many(data: bytes, i: int, num_params: int) -> Tuple[int, List[int], List[ParamType], List[Any]]:
+        """
+        Decode num_params parameters (id, datatype and value) starting at i,
+        returns the offset after them and their ids, datatypes and values as parallel lists
+        """
+        codecs = PARAM_CODECS
+        ids = []
+        datatypes = []
+        values = []
+        for _ in range(num_params):
+            datatype = data[i+2]
+            if datatype >= len(codecs):
+                raise DecodeFailed(f"Unknown Parameter Datatype {datatype}")
+            codec = codecs[datatype]
+            if codec.param_struct is not None:
+                param_id, _, value = codec.param_struct.unpack_from(data, i)
+                i += codec.param_struct.size
+            else:
+                param_id, _ = PARAM_STRUCT.unpack_from(data, i)
+                i, value = codec.decode(data, i + PARAM_STRUCT.size)
+            ids.append(param_id)
+            datatypes.append(codec.datatype)
+            values.append(value)
+        return i, ids, datatypes, values
 
 class RawMessage(HiQnetMessage):
     def __init__(self, message: bytes, *args, **kwargs):
@@ -703,11 +809,10 @@ class Attribute:
     @classmethod
     def decode(cls, data, i):
         aid = int.from_bytes(data[i:2+i], "big")
-        datatype = ParamType(data[2+i])
         # avoid re-writing datatype decode function
         # use from Parameter
-        i, p = Parameter.decode(0, datatype, data, 3+i)
-        return i, cls(aid, datatype, p.value)
+        i, p = Parameter.decode(0, data[2+i], data, 3+i)
+        return i, cls(aid, p.datatype, p.value)
 
 class GetAttributesReply(HiQnetMessage):
     def __init__(self, attributes: List[Attribute], *args, **kwargs):
@@ -735,12 +840,46 @@ class GetAttributesReply(HiQnetMessage):
             attributes.append(attr)
         return cls(attributes, header)
 
+# parameter id, datatype and a LONG value
+LONG_PARAM_SET_SIZE = UWORD + UBYTE + ULONG
+
+def is_long_value(value) -> bool:
+    """ True if value can be sent as a LONG parameter, bool is an int but not a valid value """
+    return type(value) == int and -0x80000000 <= value <= 0x7fffffff
+
+# number of objects or parameters
+COUNT_STRUCT = struct.Struct(">H")
+# object id and number of parameters
+OBJECT_STRUCT = struct.Struct(">LH")
+# parameter id and percent
+PERCENT_STRUCT = struct.Struct(">Hh")
+
+# parameter ids, datatypes and values as parallel lists, as Parameter.decode_many returns them
+ParamLists = Tuple[List[int], List[ParamType], List[Any]]
+
+def param_lists(params: List[Parameter]) -> ParamLists:
+    return [p.param_id for p in params], [p.datatype for p in params], [p.value for p in params]
+
 class MultiObjectParamSet(HiQnetMessage):
     # dictionary of objects with list of parameters
     def __init__(self, object_params: Dict[int, List[Parameter]], *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.header.message_id = MessageID.MultiObjectParamSet
-        self.object_params = object_params
+        self._object_params = object_params
+        # decoded messages keep each object's parameters as lists until object_params is used
+        self._object_param_lists: Optional[Dict[int, ParamLists]] = None
+
+    @property
+    def object_params(self) -> Dict[int, List[Parameter]]:
+        if self._object_params is None:
+            self._object_params = {obj: list(map(Parameter, *lists)) for obj, lists in self._object_param_lists.items()}
+        return self._object_params
+
+    def object_param_lists(self) -> Dict[int, ParamLists]:
+        """ Each object's parameter ids, datatypes and values, without creating Parameter objects """
+        if self._object_params is None:
+            return self._object_param_lists
+        return {obj: param_lists(params) for obj, params in self._object_params.items()}
 
     def get_payload(self):
         data = len(self.object_params).to_bytes(UWORD, "big")
@@ -755,32 +894,42 @@ class MultiObjectParamSet(HiQnetMessage):
 
     @classmethod
     def decode(cls, data: bytes, header: HiQnetHeader):
-        object_params = {}
-        num_objects = int.from_bytes(data[:2], "big")
-        i = 2
+        object_param_lists = {}
+        num_objects, = COUNT_STRUCT.unpack_from(data, 0)
+        i = COUNT_STRUCT.size
         for _ in range(num_objects):
-            params = []
-            object_dest = int.from_bytes(data[i:i+4], "big")
-            num_params = int.from_bytes(data[i+4:i+6], "big")
-            i += 6
-            for _ in range(num_params):
-                param_id = int.from_bytes(data[i:i+2], "big")
-                param_datatype = int.from_bytes(data[i+2:i+3], "big")
-                i, param = Parameter.decode(param_id, param_datatype, data, i+3)
-                params.append(param)
-            if params:
-                object_params[object_dest] = params
-
-        # print("MultiObjectParamSet", object_params)
-
-        return cls(object_params, header)
+            object_dest, num_params = OBJECT_STRUCT.unpack_from(data, i)
+            i += OBJECT_STRUCT.size
+            if num_params:
+                i, ids, datatypes, values = Parameter.decode_many(data, i, num_params)
+                object_param_lists[object_dest] = (ids, datatypes, values)
+
+        # print("MultiObjectParamSet", object_param_lists)
+
+        msg = cls(None, header)
+        msg._object_param_lists = object_param_lists
+        return msg
 
 class MultiParamSet(HiQnetMessage):
     # list of parameters
     def __init__(self, params: List[Parameter], *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.header.message_id = MessageID.MultiParamSet
-        self.params = params
+        self._params = params
+        # decoded messages keep the parameters as lists until params is used
+        self._param_lists: Optional[ParamLists] = None
+
+    @property
+    def params(self) -> List[Parameter]:
+        if self._params is None:
+            self._params = list(map(Parameter, *self._param_lists))
+        return self._params
+
+    def param_lists(self) -> ParamLists:
+        """ The parameter ids, datatypes and values, without creating Parameter objects """
+        if self._params is None:
+            return self._param_lists
+        return param_lists(self._params)
 
     def get_payload(self):
         data = len(self.params).to_bytes(UWORD, "big")
@@ -792,18 +941,14 @@ class MultiParamSet(HiQnetMessage):
 
     @classmethod
     def decode(cls, data: bytes, header: HiQnetHeader):
-        params = []
-        num_params = int.from_bytes(data[i:i+2], "big")
-        i = 2
-        for _ in range(num_params):
-            param_id = int.from_bytes(data[i:i+2], "big")
-            param_datatype = int.from_bytes(data[i+2:i+3], "big")
-            i, param = Parameter.decode(param_id, param_datatype, data, i+3)
-            params.append(param)
+        num_params, = COUNT_STRUCT.unpack_from(data, 0)
+        _, ids, datatypes, values = Parameter.decode_many(data, COUNT_STRUCT.size, num_params)
 
-        # print("MultiParamSet", params)
+        # print("MultiParamSet", ids, values)
 
-        return cls(params, header)
+        msg = cls(None, header)
+        msg._param_lists = (ids, datatypes, values)
+        return msg
 
 @dataclass
 class SubscriptionEntry():
@@ -814,6 +959,9 @@ class SubscriptionEntry():
     sub_type: int = 0 # 0 = all
 
 class MultiParamSubscribe(HiQnetMessage):
+    # subscriptions that fit in a message within MAX_MTU, each is 16 bytes after the count
+    MAX_ENTRIES = (MAX_MTU - HEADER_LENGTH - UWORD) // 16
+
     def __init__(self, subscriptions: List[SubscriptionEntry], *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.header.message_id = MessageID.MultiParamSubscribe
@@ -840,6 +988,9 @@ class UnsubEntry():
     dest_param_id: int
 
 class MultiParamUnsubscribe(HiQnetMessage):
+    # unsubscriptions that fit in a message within MAX_MTU, each is 4 bytes after the address and count
+    MAX_ENTRIES = (MAX_MTU - HEADER_LENGTH - HIQNETADDR - UWORD) // 4
+
     def __init__(self, dest_address, unsubscriptions: List[UnsubEntry], *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.header.message_id = MessageID.MultiParamUnsubscribe
@@ -933,21 +1084,20 @@ class ParamSetPercent(HiQnetMessage):
 
     @classmethod
     def decode(cls, data: bytes, header: HiQnetHeader):
-        params = []
-        num_params = int.from_bytes(data[:2], "big")
-        i = 2
-        for _ in range(num_params):
-            param_id = int.from_bytes(data[i:i+2], "big")
-            percent_value = int.from_bytes(data[i+2:i+4], "big", signed=True)
-            percent_value = min(0x7fff, max(-0x8000, percent_value))
-            params.append((param_id, percent_value))
-            i += 4
+        num_params, = COUNT_STRUCT.unpack_from(data, 0)
+        end = COUNT_STRUCT.size + num_params * PERCENT_STRUCT.size
+        if len(data) < end:
+            raise DecodeFailed("ParamSetPercent too short")
+        # a signed word is always within -0x8000 to 0x7fff
+        params = list(PERCENT_STRUCT.iter_unpack(data[COUNT_STRUCT.size:end]))
 
         # print("ParamSetPercent", params)
 
         return cls(params, header)
 
 class ParamSubscribePercent(HiQnetMessage):
+    MAX_ENTRIES = MultiParamSubscribe.MAX_ENTRIES
+
     def __init__(self, subscriptions: List[SubscriptionEntry], *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.header.message_id = MessageID.ParamSubscribePercent
@@ -1137,6 +1287,60 @@ class Packet:
         else:
             raise UnsupportedMessage(f"Unknown message type: {self.message_type}")
 
+    @classmethod
+    def to_msgs(cls, packets: List['Packet']) -> List[HiQnetMessage]:
+        """
+        Messages for a list of packets, with subscribes and unsubscribes to the same object
+        combined into as few messages as fit within MAX_MTU, in the order of their first packet.
+        A subscribe and unsubscribe for the same parameter may be reordered, so send those in separate lists.
+        """
+        def entries(msg):
+            return msg.unsubscriptions if type(msg) == MultiParamUnsubscribe else msg.subscriptions
+
+        msgs = []
+        # (message type, node, v_device, obj_id) -> the last message for it
+        last_msgs: Dict[Tuple[MessageType, int, int, int], HiQnetMessage] = {}
+        for p in packets:
+            msg = p.to_msg()
+            if p.message_type not in (MessageType.SUBSCRIBE, MessageType.SUBSCRIBE_PERCENT, MessageType.UNSUBSCRIBE, MessageType.UNSUBSCRIBE_PERCENT):
+                msgs.append(msg)
+                continue
+            key = (p.message_type, p.node, p.v_device, p.obj_id)
+            last_msg = last_msgs.get(key)
+            if last_msg is not None and len(entries(last_msg)) < last_msg.MAX_ENTRIES:
+                entries(last_msg).extend(entries(msg))
+            else:
+                last_msgs[key] = msg
+                msgs.append(msg)
+        return msgs
+
+    @classmethod
+    def merge_sets(cls, packets: List['Packet']) -> List[HiQnetMessage]:
+        """
+        Messages for a list of packets, with each run of SETs merged into one message per virtual device
+        within MAX_MTU, a MultiParamSet if they are all to one object or a MultiObjectParamSet if not.
+        If a parameter is set more than once in a run only the last value is sent.
+        Packets that can't be converted are returned as UnsupportedMessage,
+        a SET with an invalid value only drops that SET rather than the whole message.
+        """
+        msgs = []
+        # (node, v_device) -> obj_id -> param_id -> value, for the current run of SETs
+        sets: Dict[Tuple[int, int], Dict[int, Dict[int, int]]] = {}
+        for p in packets:
+            if p.message_type == MessageType.SET:
+                if not is_long_value(p.value):
+                    msgs.append(UnsupportedMessage(f"Invalid SET value: {p.value!r} for {p.param_str()}"))
+                    continue
+                sets.setdefault((p.node, p.v_device), {}).setdefault(p.obj_id, {})[p.param_id] = p.value
+                continue
+            msgs += set_msgs(sets)
+            sets = {}
+            try:
+                msgs.append(p.to_msg())
+            except UnsupportedMessage as ex:
+                msgs.append(ex)
+        msgs += set_msgs(sets)
+        return msgs
 
     @classmethod
     def from_msg(cls, msg: HiQnetMessage) -> List['Packet']:
@@ -1144,21 +1348,20 @@ class Packet:
         if type(msg) == MultiObjectParamSet:
             node = msg.header.source_address.device
             v_device = msg.header.source_address.v_device
-            for obj_id, params in msg.object_params.items():
-                for parameter in params:
-                    param_id = parameter.param_id
-                    if parameter.datatype == ParamType.BLOCK:
+            for obj_id, (ids, datatypes, values) in msg.object_param_lists().items():
+                for param_id, datatype, param_value in zip(ids, datatypes, values):
+                    if datatype == ParamType.BLOCK:
                         packets.append(UnsupportedMessage(f"Unsupported packet datatype: BLOCK from {node:04x}:{v_device:02x}:{obj_id:06x}:{param_id:04x}"))
                         continue
-                    elif parameter.datatype == ParamType.STRING:
+                    elif datatype == ParamType.STRING:
                         packets.append(cls(MessageType.SET_STRING,
                             node=node, v_device=v_device, obj_id=obj_id, param_id=param_id,
-                            string_bytes=parameter.value.encode("UTF-8")
+                            string_bytes=param_value.encode("UTF-8")
                         ))
                         continue
                     
                     # convert value to signed 32-bit
-                    value = int.from_bytes(parameter.value.to_bytes(4, "big", signed=True), "big", signed=True) 
+                    value = int.from_bytes(param_value.to_bytes(4, "big", signed=True), "big", signed=True) 
 
                     packets.append(cls(MessageType.SET,
                         node=node, v_device=v_device, obj_id=obj_id, param_id=param_id,
@@ -1168,20 +1371,19 @@ class Packet:
             node = msg.header.source_address.device
             v_device = msg.header.source_address.v_device
             obj_id = msg.header.source_address.obj_id
-            for parameter in msg.params:
-                param_id = parameter.param_id
-                if parameter.datatype == ParamType.BLOCK:
+            for param_id, datatype, param_value in zip(*msg.param_lists()):
+                if datatype == ParamType.BLOCK:
                     packets.append(UnsupportedMessage(f"Unsupported packet datatype: BLOCK from {node:04x}:{v_device:02x}:{obj_id:06x}:{param_id:04x}"))
                     continue
-                elif parameter.datatype == ParamType.STRING:
+                elif datatype == ParamType.STRING:
                     packets.append(cls(MessageType.SET_STRING,
                         node=node, v_device=v_device, obj_id=obj_id, param_id=param_id,
-                        string_bytes=parameter.value.encode("UTF-8")
+                        string_bytes=param_value.encode("UTF-8")
                     ))
                     continue
                 
                 # convert value to signed 32-bit
-                value = int.from_bytes(parameter.value.to_bytes(4, "big", signed=True), "big", signed=True) 
+                value = int.from_bytes(param_value.to_bytes(4, "big", signed=True), "big", signed=True) 
 
                 packets.append(cls(MessageType.SET,
                     node=node, v_device=v_device, obj_id=obj_id, param_id=param_id,
@@ -1232,5 +1434,35 @@ class Packet:
         c.v_device = from_hex(parameter[1], 2)
         c.obj_id = from_hex(parameter[2], 6)
         c.param_id = from_hex(parameter[3], 4)
+        if c.message_type == MessageType.SET and not is_long_value(data["value"]):
+            raise DecodeFailed("Value must be a 32 bit integer")
         c.value = data["value"]
-        return c
\ No newline at end of file
+        return c
+
+def set_msgs(sets: Dict[Tuple[int, int], Dict[int, Dict[int, int]]]) -> List[HiQnetMessage]:
+    """ Messages for the values to set, by (node, v_device) then object then parameter, see Packet.merge_sets """
+    msgs = []
+    def add_msg(node: int, v_device: int, object_params: Dict[int, List[Parameter]]):
+        if len(object_params) == 1:
+            (obj_id, params), = object_params.items()
+            msgs.append(MultiParamSet(params, HiQnetHeader(HiQnetAddress(device=node, v_device=v_device, obj_id=obj_id))))
+        else:
+            msgs.append(MultiObjectParamSet(object_params, HiQnetHeader(HiQnetAddress(device=node, v_device=v_device))))
+
+    for (node, v_device), objects in sets.items():
+        object_params = {}
+        # sized as a MultiObjectParamSet, which is never smaller than a MultiParamSet for the same parameters
+        length = HEADER_LENGTH + UWORD
+        for obj_id, values in objects.items():
+            for param_id, value in values.items():
+                size = LONG_PARAM_SET_SIZE if obj_id in object_params else ULONG + UWORD + LONG_PARAM_SET_SIZE
+                if length + size > MAX_MTU:
+                    add_msg(node, v_device, object_params)
+                    object_params = {}
+                    length = HEADER_LENGTH + UWORD
+                    size = ULONG + UWORD + LONG_PARAM_SET_SIZE
+                object_params.setdefault(obj_id, []).append(Parameter(param_id, ParamType.LONG, value))
+                length += size
+        if object_params:
+            add_msg(node, v_device, object_params)
+    return msgs
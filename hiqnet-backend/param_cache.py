@@ -0,0 +1,56 @@
+import threading
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+# locks shared between the parameters, by hash of the parameter string
+LOCK_STRIPES = 16
+
+class CacheEntry(NamedTuple):
+    # time sent, None if the entry is invalid
+    t: Optional[float]
+    value: Any
+    # json data and websocket frame for the message
+    data: str
+    frame: bytes
+
+class ParamCache:
+    """
+    The last value sent for each parameter string.
+    Entries are immutable and replaced as a whole, so reads never lock.
+    Values are only stored by the broadcaster on the event loop, the only other
+    writes are invalidations from the websocket threads. Those take a lock striped
+    by parameter, so a burst of subscribes doesn't hold up the meter stream and
+    a value stored while invalidating isn't lost.
+    """
+    def __init__(self):
+        self.entries: Dict[str, CacheEntry] = {}
+        self.locks: List[threading.Lock] = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _lock(self, parameter: str) -> threading.Lock:
+        return self.locks[hash(parameter) % LOCK_STRIPES]
+
+    def get(self, parameter: str) -> Optional[CacheEntry]:
+        return self.entries.get(parameter)
+
+    def store(self, parameter: str, entry: CacheEntry):
+        with self._lock(parameter):
+            self.entries[parameter] = entry
+
+    def restore(self, parameter: str, entry: CacheEntry):
+        """ Store an entry unless the parameter already has one """
+        with self._lock(parameter):
+            self.entries.setdefault(parameter, entry)
+
+    def invalidate(self, parameter: str) -> Optional[CacheEntry]:
+        """ Mark the entry invalid so the next value is always sent, returns the entry before """
+        with self._lock(parameter):
+            entry = self.entries.get(parameter)
+            if entry is not None and entry.t is not None:
+                self.entries[parameter] = CacheEntry(None, entry.value, entry.data, entry.frame)
+            return entry
+
+    def items(self) -> Iterator[Tuple[str, CacheEntry]]:
+        """ Snapshot of the entries, safe to iterate from another thread """
+        return iter(list(self.entries.items()))
@@ -0,0 +1,137 @@
+import threading, time
+from typing import Dict, List, Optional, Set, Tuple
+
+from hiqnet_proto import MessageType, Packet
+
+# (node, v_device, obj_id, param_id, kind) where kind is the subscribe message type
+SubscriptionKey = Tuple[int, int, int, int, MessageType]
+
+UNSUBSCRIBE_TYPES = {
+    MessageType.SUBSCRIBE: MessageType.UNSUBSCRIBE,
+    MessageType.SUBSCRIBE_PERCENT: MessageType.UNSUBSCRIBE_PERCENT,
+}
+SUBSCRIBE_TYPES = {v: k for k, v in UNSUBSCRIBE_TYPES.items()}
+
+def subscription_key(p: Packet) -> SubscriptionKey:
+    """ Key for a subscribe or unsubscribe packet, both map to the same subscription """
+    kind = SUBSCRIBE_TYPES.get(p.message_type, p.message_type)
+    return (p.node, p.v_device, p.obj_id, p.param_id, kind)
+
+def param_str_key(param_str: str, kind: MessageType) -> SubscriptionKey:
+    node, v_device, obj_id, param_id = (int(s, 16) for s in param_str.split(":"))
+    return (node, v_device, obj_id, param_id, kind)
+
+def unsubscribe_packet(p: Packet) -> Packet:
+    p2 = p.copy()
+    p2.message_type = UNSUBSCRIBE_TYPES[p.message_type]
+    return p2
+
+class Subscription:
+    __slots__ = ("packet", "unsub_packet", "subscribers", "unsub_time")
+
+    def __init__(self, packet: Optional[Packet], unsub_packet: Optional[Packet]):
+        self.packet = packet
+        self.unsub_packet = unsub_packet
+        # addresses of the websocket clients using this subscription
+        self.subscribers: Set[str] = set()
+        # time the last subscriber left, None while subscribed
+        self.unsub_time: Optional[float] = None
+
+    @property
+    def refcount(self):
+        return len(self.subscribers)
+
+class SubscriptionRegistry:
+    """
+    The parameters subscribed to on a node, shared between the websocket
+    clients and the node connection (which resubscribes on reconnect).
+    Iteration is in insertion order.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions: Dict[SubscriptionKey, Subscription] = {}
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def __contains__(self, key: SubscriptionKey):
+        return key in self.subscriptions
+
+    def add_subscriber(self, key: SubscriptionKey, addr: str) -> bool:
+        """ Add addr to an existing subscription, returns False if there isn't one """
+        with self.lock:
+            sub = self.subscriptions.get(key)
+            if sub is None:
+                return False
+            sub.subscribers.add(addr)
+            sub.unsub_time = None
+            return True
+
+    def subscribe(self, key: SubscriptionKey, packet: Packet, unsub_packet: Packet, addr: str) -> Subscription:
+        """ Add or replace the subscribe packet for key, and add addr to its subscribers """
+        with self.lock:
+            sub = self.subscriptions.get(key)
+            if sub is None:
+                sub = self.subscriptions[key] = Subscription(packet, unsub_packet)
+            else:
+                sub.packet = packet
+                sub.unsub_packet = unsub_packet
+            sub.subscribers.add(addr)
+            sub.unsub_time = None
+            return sub
+
+    def restore(self, key: SubscriptionKey, packet: Packet, unsub_packet: Packet, grace: float = 0):
+        """
+        Add a subscription from before a restart, unless there already is one.
+        It has no subscribers, so it is unsubscribed after grace seconds plus the delay,
+        unless a client reconnects and claims it.
+        """
+        with self.lock:
+            if key not in self.subscriptions:
+                sub = self.subscriptions[key] = Subscription(packet, unsub_packet)
+                sub.unsub_time = time.time() + grace
+
+    def release(self, key: SubscriptionKey, addr: str, fallback_unsub: Packet = None) -> bool:
+        """
+        Remove addr from the subscription, returns True if no subscribers remain.
+        Subscriptions left without subscribers are marked with the time they became unused.
+        """
+        with self.lock:
+            sub = self.subscriptions.get(key)
+            if sub is None:
+                if fallback_unsub is None:
+                    return True
+                # unsubscribe even though we don't know about it
+                sub = self.subscriptions[key] = Subscription(None, fallback_unsub)
+            sub.subscribers.discard(addr)
+            if sub.subscribers:
+                return False # Other clients are still subscribed
+            if sub.unsub_packet is None:
+                sub.unsub_packet = fallback_unsub
+            sub.unsub_time = time.time()
+            return True
+
+    def remove(self, key: SubscriptionKey) -> Optional[Subscription]:
+        with self.lock:
+            return self.subscriptions.pop(key, None)
+
+    def expired(self, delay: float) -> List[SubscriptionKey]:
+        """ Keys of subscriptions that have been unused for at least delay seconds """
+        t = time.time()
+        with self.lock:
+            return [key for key, sub in self.subscriptions.items()
+                if sub.unsub_time is not None and t - sub.unsub_time >= delay]
+
+    def expire(self, key: SubscriptionKey, delay: float) -> Optional[Subscription]:
+        """ Remove and return the subscription if it has been unused for at least delay seconds """
+        t = time.time()
+        with self.lock:
+            sub = self.subscriptions.get(key)
+            if sub is None or sub.unsub_time is None or t - sub.unsub_time < delay:
+                return None
+            return self.subscriptions.pop(key)
+
+    def snapshot(self) -> List[Subscription]:
+        """ Subscriptions to send to the node, safe to iterate from another thread """
+        with self.lock:
+            return [sub for sub in self.subscriptions.values() if sub.packet is not None]
@@ -1,21 +1,26 @@
 import asyncio, os, sys, threading, ipaddress
-from janus import Queue, SyncQueueEmpty
+from janus import Queue, SyncQueueEmpty, SyncQueueFull
 import json, hmac, hashlib, time
 from config import load_config
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial
 import socket, uuid
-from typing import Optional, Dict, Set
+from typing import Optional, Dict, Tuple
 
-from websocket_server import WebsocketServer
+from websocket_server import WebsocketServer, AsyncWebsocketServer
 from hiqnet_proto import *
-from hiqnet_client import HiQnetThread, HiQnetUDPListenerThread, HiQnetTCPListenerThread
+from binary_protocol import BinarySession
+from pending_updates import PendingUpdates
+from param_cache import ParamCache, CacheEntry
+from cache_snapshot import save_snapshot, load_snapshot
+from subscriptions import SubscriptionRegistry, subscription_key, param_str_key, unsubscribe_packet
+from hiqnet_client import HiQnetThread, HiQnetConnection, HiQnetConnectionManager, HiQnetUDPListenerThread, HiQnetTCPListenerThread
 
 token_time_range = 10 * 60 * 1000 # +-10 minutes
 
 HIQNET_PORT = 3804
 FAILSAFE_SHUTDOWN_TIME = 30 # safe shutdown aborted after 30 seconds
 
+# SubscriptionRegistry per node, used to know when to unsubscribe and to resubscribe on reconnect
 subscribed_params = {}
 
 ws_server = None
@@ -24,23 +29,10 @@ WEBSOCKET_LIST = []
 WS_USER_DATA = {}
 RUN_SERVER = True
 
-# used to store subscriptions, to know when to unsubscribe
-SUBS_lock = threading.Lock()
-SUBS: Dict[str, Set[str]] = {}
-SUBS_UNSUB_DELAY: Dict[str, float] = {}
-UNSUB_PACKETS: Dict[str, Packet] = {}
-
-PC_SUBS_lock = threading.Lock()
-PC_SUBS: Dict[str, Set[str]] = {}
-PC_SUBS_UNSUB_DELAY: Dict[str, float] = {}
-PC_UNSUB_PACKETS: Dict[str, Packet] = {}
-# used to store unsub packets for later
-
-param_cache_lock = threading.Lock()
-param_cache = {}
+# parameter -> last value sent
+param_cache = ParamCache()
 # separate cache for percent values (in case we get both)
-pc_param_cache_lock = threading.Lock()
-pc_param_cache = {}
+pc_param_cache = ParamCache()
 param_rebroadcast_time = 5 # 5 seconds
 
 client_thread_status = {}
@@ -55,21 +47,125 @@ except:
 if VERSION == "":
     VERSION = "Unknown"
 
-def should_send(client, parameter=None):
-    if parameter is None:
-        return True
-    addr = client.get("address", "")
-    if not addr:
-        return True
-    if not addr in WS_USER_DATA:
-        return False
-    _, _, user_subs = WS_USER_DATA[addr]
-    if user_subs is None:
-        return False
-    return parameter in user_subs[0] or parameter in user_subs[1]
-
-def subscribe(p: Packet, addr: str) -> Optional[dict]:
-    global subscribed_params, param_cache, param_cache_lock, pc_param_cache, param_cache_lock
+# parameter string -> {client id: client} for the clients subscribed to it
+# entries are replaced rather than modified (under WS_DATA_LOCK) so the broadcast threads can read them without locking
+PARAM_CLIENTS: Dict[str, Dict[int, dict]] = {}
+# same as PARAM_CLIENTS for clients with the batch option, mapping to their pending batch instead
+PARAM_BATCH_CLIENTS: Dict[str, Dict[int, PendingUpdates]] = {}
+# client id -> (client, pending json messages) for clients with the batch option
+BATCH_CLIENTS: Dict[int, Tuple[dict, PendingUpdates]] = {}
+# same as PARAM_CLIENTS for clients with the binary option, mapping to their BinarySession instead
+PARAM_BINARY_CLIENTS: Dict[str, Dict[int, BinarySession]] = {}
+# client id -> BinarySession for clients with the binary option
+BINARY_CLIENTS: Dict[int, BinarySession] = {}
+
+def client_param_index(client: dict):
+    # the index for the client, and what it maps the client to
+    session = BINARY_CLIENTS.get(client["id"])
+    if session:
+        return PARAM_BINARY_CLIENTS, session
+    batch = BATCH_CLIENTS.get(client["id"])
+    if batch:
+        return PARAM_BATCH_CLIENTS, batch[1]
+    return PARAM_CLIENTS, client
+
+def add_param_client(parameter: str, client: dict):
+    index, value = client_param_index(client)
+    clients = dict(index.get(parameter, {}))
+    clients[client["id"]] = value
+    index[parameter] = clients
+
+def remove_param_client(parameter: str, client: dict):
+    index, _ = client_param_index(client)
+    clients = index.get(parameter)
+    if clients is None or client["id"] not in clients:
+        return
+    clients = dict(clients)
+    del clients[client["id"]]
+    if clients:
+        index[parameter] = clients
+    else:
+        del index[parameter]
+
+def remove_param_client_subs(client: dict, user_subs):
+    for param_str in user_subs[0] | user_subs[1]:
+        remove_param_client(param_str, client)
+
+def send_to_param_clients(msg: dict, data: str, frame: bytes):
+    parameter = msg["parameter"]
+    clients = PARAM_CLIENTS.get(parameter)
+    if clients:
+        # keyed on the type too, so a queued percent value is never replaced by a plain one
+        ws_server.send_frame_to_list(clients.values(), frame, (msg["type"], parameter))
+    batches = PARAM_BATCH_CLIENTS.get(parameter)
+    if batches:
+        for batch in batches.values():
+            batch.put((msg["type"], parameter), data)
+    sessions = PARAM_BINARY_CLIENTS.get(parameter)
+    if sessions:
+        for session in sessions.values():
+            record = session.pack(msg)
+            if record is None:
+                ws_server.send_frame(session.client, frame, (msg["type"], parameter))
+            else:
+                session.pending.put((msg["type"], parameter), record)
+
+def add_binary_index(client: dict, msg_type: str, parameter: str):
+    # send the table entry before any record can use it
+    session = BINARY_CLIENTS.get(client["id"])
+    if session is None:
+        return
+    index = session.add(msg_type, parameter)
+    if index is not None:
+        # keyed by index so a full send queue never drops it, the client ignores records for unknown indices
+        frame = ws_server.prepare_send_text(json.dumps({
+            "type": "BINARY_INDEX",
+            "data": {"index": index, "type": msg_type, "parameter": parameter}
+        }))
+        ws_server.send_frame(client, frame, ("BINARY_INDEX", index))
+
+def client_flush_interval(user_options: dict) -> float:
+    # seconds between flushes for a client's rate option (updates per second),
+    # at most once per batch window and at least once a second
+    window = config["batch_window_ms"] / 1000
+    rate = user_options.get("rate")
+    if type(rate) not in (int, float) or rate <= 0:
+        return window
+    return max(window, 1 / max(rate, 1))
+
+# send queue key for batch frames, see websocket_batch_thread
+BATCH_KEY = "BATCH"
+
+def websocket_batch_thread():
+    print("Starting websocket batch thread", flush=True)
+    window = config["batch_window_ms"] / 1000
+    while RUN_SERVER:
+        time.sleep(window)
+        t = time.monotonic()
+        with WS_DATA_LOCK:
+            batches = list(BATCH_CLIENTS.values())
+            sessions = list(BINARY_CLIENTS.values())
+        # while a client's last batch is still queued its updates stay pending (and coalescing),
+        # batches are keyed so a full send queue never drops the only copy of a value
+        for client, batch in batches:
+            if not batch or ws_server.client_send_backlog(client) or not batch.due(t):
+                continue
+            msgs = batch.take()
+            try:
+                ws_server.send_frame(client, ws_server.prepare_send_text("[" + ",".join(msgs) + "]"), BATCH_KEY)
+            except Exception as ex:
+                print("Websocket batch thread error:", ex, flush=True)
+        for session in sessions:
+            if not session.pending or ws_server.client_send_backlog(session.client) or not session.pending.due(t):
+                continue
+            try:
+                ws_server.send_binary(session.client, session.take(), BATCH_KEY)
+            except Exception as ex:
+                print("Websocket batch thread error:", ex, flush=True)
+    print("Finished websocket batch thread", flush=True)
+
+def subscribe(p: Packet, addr: str) -> Optional[bytes]:
+    global subscribed_params, param_cache, pc_param_cache
     sub_handler_node = get_packet_node_handler(p)
     if sub_handler_node is None:
         return None
@@ -77,163 +173,62 @@ def subscribe(p: Packet, addr: str) -> Optional[dict]:
     p.value = config["subscription_rate_ms"]
     is_percent = p.message_type ==  MessageType.SUBSCRIBE_PERCENT
     param_str = p.param_str()
+    subscriptions = subscribed_params[sub_handler_node]
+    key = subscription_key(p)
+
+    old_cached_frame = None
+    invalidate_cache = not subscriptions.add_subscriber(key, addr)
+    cache = pc_param_cache if is_percent else param_cache
+    cached = cache.invalidate(param_str) if invalidate_cache else cache.get(param_str)
+    if cached is not None:
+        old_cached_frame = cached.frame
+        # entry is not invalid
+        if cached.t is not None and not invalidate_cache:
+            return old_cached_frame
+        # if we didn't find it in the param cache, try and resubscribe
 
-    old_cached_value = None
-    invalidate_cache = True
-    if is_percent:
-        with PC_SUBS_lock:
-            if param_str in PC_SUBS:
-                PC_SUBS[param_str].add(addr)
-                invalidate_cache = False
-            if param_str in PC_SUBS_UNSUB_DELAY:
-                del PC_SUBS_UNSUB_DELAY[param_str]
-        with pc_param_cache_lock:
-            if param_str in pc_param_cache:
-                t, old_cached_value = pc_param_cache[param_str]
-                # entry is not invalid
-                if t is not None:
-                    if invalidate_cache:
-                        pc_param_cache[param_str] = (None, old_cached_value)
-                    else:
-                        return old_cached_value
-                # if we didn't find it in the param cache, try and resubscribe
-    else:
-        with SUBS_lock:
-            if param_str in SUBS:
-                SUBS[param_str].add(addr)
-                invalidate_cache = False
-            if param_str in SUBS_UNSUB_DELAY:
-                del SUBS_UNSUB_DELAY[param_str]
-        with param_cache_lock:
-            if param_str in param_cache:
-                t, old_cached_value = param_cache[param_str]
-                # entry is not invalid
-                if t is not None:
-                    if invalidate_cache:
-                        param_cache[param_str] = (None, old_cached_value)
-                    else:
-                        return old_cached_value
-                # if we didn't find it in the param cache, try and resubscribe
-
-    
     # send unsub first so we get param sent to us
-    p2 = p.copy()
-    has_unsub = False
-    if p.message_type == MessageType.SUBSCRIBE:
-        p2.message_type = MessageType.UNSUBSCRIBE
-        has_unsub = True
-    elif p.message_type == MessageType.SUBSCRIBE_PERCENT:
-        p2.message_type = MessageType.UNSUBSCRIBE_PERCENT
-        has_unsub = True
-
-    assert has_unsub, "Error generating unsub packet"
-    msg_queues[sub_handler_node].sync_q.put(p2)
-
-    msg_queues[sub_handler_node].sync_q.put(p) # resubscribe (sometimes soundweb forgets about us i think)
-
-    # append to the nodes subscribe parameters (remove old copies first)
-    for sub in subscribed_params[sub_handler_node]:
-        if sub.param_str() == p.param_str() and sub.message_type == p.message_type:
-            subscribed_params[sub_handler_node].remove(sub)
-    subscribed_params[sub_handler_node].append(p)
+    p2 = unsubscribe_packet(p)
+    queue_packet(sub_handler_node, p2)
+
+    queue_packet(sub_handler_node, p) # resubscribe (sometimes soundweb forgets about us i think)
+
+    subscriptions.subscribe(key, p, p2, addr)
     if config["subscription_debug"]:
         print(f"Subscribing to: [{sub_handler_node}] {p.param_str()}{' %' if is_percent else ''}", flush=True)
 
-    if is_percent:
-        with PC_SUBS_lock:
-            if param_str not in PC_SUBS:
-                PC_SUBS[param_str] = set()
-            PC_SUBS[param_str].add(addr)
-            PC_UNSUB_PACKETS[param_str] = p2
-    else:
-        with SUBS_lock:
-            if param_str not in SUBS:
-                SUBS[param_str] = set()
-            SUBS[param_str].add(addr)
-            UNSUB_PACKETS[param_str] = p2
-
-    return old_cached_value
+    return old_cached_frame
 
 def client_unsubscribe(param_str: str, is_percent: bool, addr: str, fallback_packet: Packet = None):
-    global subscribed_params, param_cache, param_cache_lock, pc_param_cache, param_cache_lock
-    if is_percent:
-        with PC_SUBS_lock:
-            if param_str in PC_SUBS and addr in PC_SUBS[param_str]:
-                PC_SUBS[param_str].remove(addr)
-                if len(PC_SUBS[param_str]) != 0:
-                    return # Other clients are still subscribed, don't unsubscribe yet
-            if param_str not in PC_UNSUB_PACKETS:
-                PC_UNSUB_PACKETS[param_str] = fallback_packet
-            PC_SUBS_UNSUB_DELAY[param_str] = time.time()
-    else:
-        with SUBS_lock:
-            if param_str in SUBS and addr in SUBS[param_str]:
-                SUBS[param_str].remove(addr)
-                if len(SUBS[param_str]) != 0:
-                    return # Other clients are still subscribed, don't unsubscribe yet
-            if param_str not in UNSUB_PACKETS:
-                UNSUB_PACKETS[param_str] = fallback_packet
-            SUBS_UNSUB_DELAY[param_str] = time.time()
+    global subscribed_params
+    key = param_str_key(param_str, MessageType.SUBSCRIBE_PERCENT if is_percent else MessageType.SUBSCRIBE)
+    subscriptions = subscribed_params.get(hex(key[0]))
+    if subscriptions is None:
+        return
+    if not subscriptions.release(key, addr, fallback_packet):
+        return # Other clients are still subscribed, don't unsubscribe yet
     
     if config["unsubscribe_delay_s"] == 0:
-        unsubscribe(param_str, is_percent)
-
-def unsubscribe(param_str: str, is_percent: bool):
-    global subscribed_params, param_cache, param_cache_lock, pc_param_cache, param_cache_lock
-    t = time.time()
-    unsub_packet = None
-    if is_percent:
-        with PC_SUBS_lock:
-            if param_str not in PC_SUBS_UNSUB_DELAY:
-                return
-            if t - PC_SUBS_UNSUB_DELAY[param_str] < config["unsubscribe_delay_s"]:
-                return
-            if param_str in PC_UNSUB_PACKETS:
-                unsub_packet = PC_UNSUB_PACKETS[param_str]
-    else:
-        with SUBS_lock:
-            if param_str not in SUBS_UNSUB_DELAY:
-                return
-            if t - SUBS_UNSUB_DELAY[param_str] < config["unsubscribe_delay_s"]:
-                return
-            if param_str in UNSUB_PACKETS:
-                unsub_packet = UNSUB_PACKETS[param_str]
-    
+        unsubscribe(subscriptions, key)
+
+def unsubscribe(subscriptions: SubscriptionRegistry, key):
+    global param_cache, pc_param_cache
+    sub = subscriptions.expire(key, config["unsubscribe_delay_s"])
+    if sub is None:
+        return
+    unsub_packet = sub.unsub_packet
     if not unsub_packet:
         print("Error:", "Attempted to unsubscribe without an unsubscribe packet", flush=True)
         return
     
+    is_percent = unsub_packet.message_type == MessageType.UNSUBSCRIBE_PERCENT
     sub_handler_node = get_packet_node_handler(unsub_packet)
-    msg_queues[sub_handler_node].sync_q.put(unsub_packet)
+    queue_packet(sub_handler_node, unsub_packet)
     if config["subscription_debug"]:
         print(f"Unsubscribing from: [{sub_handler_node}] {unsub_packet.param_str()}{' %' if is_percent else ''}", flush=True)
 
-    # remove from the nodes subscribed parameters
-    expected_msg_type = MessageType.SUBSCRIBE_PERCENT if is_percent else MessageType.SUBSCRIBE
-    for sub in subscribed_params[sub_handler_node]:
-        if sub.param_str() == unsub_packet.param_str() and sub.message_type == expected_msg_type:
-            subscribed_params[sub_handler_node].remove(sub)
-
-    if is_percent:
-        with PC_SUBS_lock:
-            if param_str in PC_SUBS:
-                del PC_SUBS[param_str]
-            if param_str in PC_SUBS_UNSUB_DELAY:
-                del PC_SUBS_UNSUB_DELAY[param_str]
-        with pc_param_cache_lock:
-            if param_str in pc_param_cache:
-                # invalidate cache entry (set t to None)
-                pc_param_cache[param_str] = (None, pc_param_cache[param_str][1])
-    else:
-        with SUBS_lock:
-            if param_str in SUBS:
-                del SUBS[param_str]
-            if param_str in SUBS_UNSUB_DELAY:
-                del SUBS_UNSUB_DELAY[param_str]
-        with param_cache_lock:
-            if param_str in param_cache:
-                # invalidate cache entry (set t to None)
-                param_cache[param_str] = (None, param_cache[param_str][1])
+    cache = pc_param_cache if is_percent else param_cache
+    cache.invalidate(unsub_packet.param_str())
 
 def restart_all_connections():
     if hiqnet_tcp_threads:
@@ -242,36 +237,52 @@ def restart_all_connections():
     if hiqnet_udp_thread:
         hiqnet_udp_thread.restartFlag = True
 
+def get_deadband(msg_type: str, parameter: str) -> int:
+    # per parameter, then per object (parameter string without the parameter id), then per message type
+    deadband = config["deadband_parameters"].get(parameter)
+    if deadband is None:
+        deadband = config["deadband_parameters"].get(parameter.rsplit(":", 1)[0])
+    if deadband is None:
+        deadband = config["deadband"].get(msg_type, 0)
+    return deadband
+
+def within_deadband(old_value, value, deadband: int) -> bool:
+    if old_value == value:
+        return True
+    return deadband > 0 and type(old_value) == int and type(value) == int and abs(value - old_value) < deadband
+
 async def resp_broadcast(node: str):
-    global param_cache, param_cache_lock, pc_param_cache, param_cache_lock, ws_server, WEBSOCKET_LIST
+    global param_cache, pc_param_cache, ws_server, WEBSOCKET_LIST
     while True:
         # Get a "work item" out of the queue.
         msgs = await resp_queues[node].async_q.get()
         bc_msgs = []
         for msg in msgs:
-            data = json.dumps(msg)
             parameter = msg["parameter"]
-            if msg["type"] == "SET":
-                with param_cache_lock:
-                    t = time.time()
-                    # check if value has stayed the same in the cache (only check if cache line is valid)
-                    if parameter in param_cache and param_cache[parameter][1] == data and param_cache[parameter][0] is not None:
-                        # if it has not been the minimum rebroadcast time, don't bother resending the data
-                        if t - param_cache[parameter][0] < param_rebroadcast_time:
-                            continue
-                    param_cache[parameter] = (t, data)
-            elif msg["type"] == "SET_PERCENT":
-                with pc_param_cache_lock:
-                    t = time.time()
-                    # check if value has stayed the same in the cache (only check if cache line is valid)
-                    if parameter in pc_param_cache and pc_param_cache[parameter][1] == data and pc_param_cache[parameter][0] is not None:
-                        # if it has not been the minimum rebroadcast time, don't bother resending the data
-                        if t - pc_param_cache[parameter][0] < param_rebroadcast_time:
-                            continue
-                    pc_param_cache[parameter] = (t, data)
+            if msg["type"] == "SET" or msg["type"] == "SET_PERCENT":
+                cache = param_cache if msg["type"] == "SET" else pc_param_cache
+                value = msg["value"]
+                t = time.time()
+                # values are only stored here, so the only change between the get and store can be an invalidation,
+                # which the new value replaces anyway
+                cached = cache.get(parameter)
+                # if the value is within the deadband of the last value sent (only check if cache line is valid),
+                # and it has not been the minimum rebroadcast time, don't bother resending the data
+                if cached is not None and cached.t is not None and t - cached.t < param_rebroadcast_time \
+                        and within_deadband(cached.value, value, get_deadband(msg["type"], parameter)):
+                    continue
+                if cached is not None and cached.value == value:
+                    data, frame = cached.data, cached.frame
+                else:
+                    data = json.dumps(msg)
+                    frame = ws_server.prepare_send_text(data)
+                cache.store(parameter, CacheEntry(t, value, data, frame))
+            else:
+                data = json.dumps(msg)
+                frame = ws_server.prepare_send_text(data)
             if config["hiqnet_debug"]:
                 print(f"HiQnet RX [{node}]:", msg, flush=True)
-            bc_msgs.append((parameter, data))
+            bc_msgs.append((msg, data, frame))
         await bc_queues[node].async_q.put(bc_msgs)
 
 def websocket_broadcast_thread(node: str):
@@ -282,11 +293,9 @@ def websocket_broadcast_thread(node: str):
             msgs = bc_queues[node].sync_q.get(timeout=1)
         except SyncQueueEmpty:
             continue
-        for parameter, data in msgs:
+        for msg, data, frame in msgs:
             try:
-                SEND_LIST = filter(partial(should_send, parameter=parameter), WEBSOCKET_LIST)
-                if SEND_LIST:
-                    ws_server.send_message_to_list(SEND_LIST, data)
+                send_to_param_clients(msg, data, frame)
             except Exception as ex:
                 print(f"Websocket broadcast thread {node} error:", ex)
     print("Finished websocket broadcast thread for:", node)
@@ -298,6 +307,14 @@ def get_packet_node_handler(p: Packet) -> str:
     print(f"Node {hex(p.node)} not available, please add a config entry for it", flush=True)
     return None
 
+def queue_packet(node: str, p: Packet):
+    # never blocks, the websocket callbacks can run on the server's event loop
+    # the queue fills up while a node is disconnected, subscriptions are resent on reconnect
+    try:
+        msg_queues[node].sync_q.put_nowait(p)
+    except SyncQueueFull:
+        print(f"Queue for node {node} is full, dropping {p}", flush=True)
+
 previous_tokens = {}
 
 def check_auth_token_hmac(message: str):
@@ -351,9 +368,13 @@ def ws_on_data_receive(client, server, message):
             return
         user_options = user_data.get("options", {})
         with WS_DATA_LOCK:
-            WS_USER_DATA[client["address"]] = (user_data, user_options, ([], []))
+            WS_USER_DATA[client["address"]] = (user_data, user_options, (set(), set()))
             if not user_options.get("status", False):
                 WEBSOCKET_LIST.append(client)
+                if user_options.get("binary", False):
+                    BINARY_CLIENTS[client["id"]] = BinarySession(client, client_flush_interval(user_options))
+                elif user_options.get("batch", False):
+                    BATCH_CLIENTS[client["id"]] = (client, PendingUpdates(client_flush_interval(user_options)))
         # send __test__ to acknowledge websocket auth
         server.send_message(client, "__test__")
         # update users stats
@@ -374,7 +395,7 @@ def ws_on_data_receive(client, server, message):
         if user_data.get("admin", False):
             server.send_message(client, json.dumps({
                 "type": "stats",
-                "data": stats
+                "data": dict(stats, websocket_backlog=websocket_backlog_stats())
             }))
     elif message == "version":
         if user_data.get("admin", False):
@@ -426,8 +447,9 @@ def ws_on_data_receive(client, server, message):
                     client_unsubscribe(param_str, False, client["address"])
                 for param_str in user_subs[1]:
                     client_unsubscribe(param_str, True, client["address"])
-                user_subs = ([], [])
                 with WS_DATA_LOCK:
+                    remove_param_client_subs(client, user_subs)
+                    user_subs = (set(), set())
                     WS_USER_DATA[client["address"]] = (user_data, user_options, user_subs)
             else:
                 p = Packet.from_json(json.loads(message))
@@ -436,43 +458,72 @@ def ws_on_data_receive(client, server, message):
                     return
                 # print(p, flush=True)
                 if p.message_type == MessageType.SUBSCRIBE or p.message_type == MessageType.SUBSCRIBE_PERCENT:
-                    value = subscribe(p, client["address"])
-                    if value is not None:
-                        server.send_message(client, value)
+                    frame = subscribe(p, client["address"])
+                    if frame is not None:
+                        server.send_frame(client, frame)
 
                     is_percent = p.message_type == MessageType.SUBSCRIBE_PERCENT
-                    if p.param_str not in user_subs[1 if is_percent else 0]:
-                        user_subs[1 if is_percent else 0].append(p.param_str())
+                    if p.param_str() not in user_subs[1 if is_percent else 0]:
                         with WS_DATA_LOCK:
+                            user_subs[1 if is_percent else 0].add(p.param_str())
+                            if not user_options.get("status", False):
+                                add_binary_index(client, "SET_PERCENT" if is_percent else "SET", p.param_str())
+                                add_param_client(p.param_str(), client)
                             WS_USER_DATA[client["address"]] = (user_data, user_options, user_subs)
                 elif p.message_type == MessageType.UNSUBSCRIBE or p.message_type == MessageType.UNSUBSCRIBE_PERCENT:
                     is_percent = p.message_type == MessageType.UNSUBSCRIBE_PERCENT
                     client_unsubscribe(p.param_str(), is_percent, client["address"], fallback_packet=p)
 
                     if p.param_str() in user_subs[1 if is_percent else 0]:
-                        user_subs[1 if is_percent else 0].remove(p.param_str())
                         with WS_DATA_LOCK:
+                            user_subs[1 if is_percent else 0].remove(p.param_str())
+                            # still wanted if subscribed to the other (percent/non percent) value
+                            if p.param_str() not in user_subs[0 if is_percent else 1]:
+                                remove_param_client(p.param_str(), client)
                             WS_USER_DATA[client["address"]] = (user_data, user_options, user_subs)
                 else:
-                    msg_queues[sub_handler_node].sync_q.put(p)
+                    queue_packet(sub_handler_node, p)
         except (json.JSONDecodeError, DecodeFailed, UnsupportedMessage) as ex:
             print("Failed to decode:", ex, ":", message, flush=True)
 
+def ws_on_binary_receive(client, server, data):
+    # parameter updates as records, for clients with the binary option
+    if client is None:
+        return
+    session = BINARY_CLIENTS.get(client["id"])
+    _, user_options, _ = WS_USER_DATA.get(client["address"], (None, None, None))
+    if session is None or user_options is None or user_options.get("statusonly", False):
+        return
+    try:
+        for msg in session.unpack(data):
+            p = Packet.from_json(msg)
+            sub_handler_node = get_packet_node_handler(p)
+            if sub_handler_node is not None:
+                queue_packet(sub_handler_node, p)
+    except (ValueError, DecodeFailed, UnsupportedMessage) as ex:
+        print("Failed to decode binary message:", ex, flush=True)
+
 def ws_on_connection_close(client, server):
     global WS_DATA_LOCK, WEBSOCKET_LIST, WS_USER_DATA
     if client is None:
         return
+    user_subs = None
+    addr = client["address"]
     with WS_DATA_LOCK:
         if client in WEBSOCKET_LIST:
             WEBSOCKET_LIST.remove(client)
-        addr = client["address"]
         if addr in WS_USER_DATA:
             _, _, user_subs = WS_USER_DATA.pop(addr)
             if user_subs is not None:
-                for param_str in user_subs[0]:
-                    client_unsubscribe(param_str, False, addr)
-                for param_str in user_subs[1]:
-                    client_unsubscribe(param_str, True, addr)
+                remove_param_client_subs(client, user_subs)
+        BATCH_CLIENTS.pop(client["id"], None)
+        BINARY_CLIENTS.pop(client["id"], None)
+    # outside the lock, as unsubscribing queues packets for the nodes
+    if user_subs is not None:
+        for param_str in user_subs[0]:
+            client_unsubscribe(param_str, False, addr)
+        for param_str in user_subs[1]:
+            client_unsubscribe(param_str, True, addr)
     update_connected_users()
 
 health_check_queue = None
@@ -514,6 +565,16 @@ async def stats_check():
         stat = await stats_queue.async_q.get()
         stats[stat["id"]] = stat["stats"]
 
+def format_address(address) -> str:
+    try:
+        return f"{address[0]}:{address[1]}"
+    except:
+        return str(address)
+
+def websocket_backlog_stats() -> dict:
+    # outbound queue stats per websocket client, to spot slow clients
+    return {format_address(client["address"]): ws_server.client_send_stats(client) for client in list(ws_server.clients.values())}
+
 def update_connected_users():
     global stats_queue, WS_USER_DATA
     if stats_queue is None:
@@ -522,49 +583,82 @@ def update_connected_users():
     users = []
     with WS_DATA_LOCK:
         for address, (user_data, user_options, user_subs) in WS_USER_DATA.items():
-            formatted_address = str(address)
-            try:
-                formatted_address = f"{address[0]}:{address[1]}"
-            except:
-                pass
-
             users.append({
-                "address": formatted_address,
+                "address": format_address(address),
                 "username": user_data.get("username", None),
                 "admin": user_data.get("admin", False),
                 "options": user_options,
                 # "subs": user_subs,
             })
 
-    stats_queue.sync_q.put({
-        "id": "users",
-        "stats": users
-    })
+    try:
+        stats_queue.sync_q.put_nowait({
+            "id": "users",
+            "stats": users
+        })
+    except SyncQueueFull:
+        pass # the stats task is behind, the next update will catch up
 
 async def unsubscribe_delay_task():
     global RUN_SERVER
     if config["unsubscribe_delay_s"] == 0:
         return
     while RUN_SERVER:
-        t = time.time()
-        pc_to_unsubscribe = []
-        to_unsubscribe = []
-        with PC_SUBS_lock:
-            for param_str, st in PC_SUBS_UNSUB_DELAY.items():
-                if t - st >= config["unsubscribe_delay_s"]:
-                    pc_to_unsubscribe.append(param_str)
-        with SUBS_lock:
-            for param_str, st in SUBS_UNSUB_DELAY.items():
-                if t - st >= config["unsubscribe_delay_s"]:
-                    to_unsubscribe.append(param_str)
-        for param_str in pc_to_unsubscribe:
-            unsubscribe(param_str, is_percent=True)
-            await asyncio.sleep(0.02) # some delay here to avoid DOS'ing the server
-        for param_str in to_unsubscribe:
-            unsubscribe(param_str, is_percent=False)
-            await asyncio.sleep(0.02) # some delay here to avoid DOS'ing the server
+        for subscriptions in subscribed_params.values():
+            for key in subscriptions.expired(config["unsubscribe_delay_s"]):
+                unsubscribe(subscriptions, key)
+                await asyncio.sleep(0.02) # some delay here to avoid DOS'ing the server
         await asyncio.sleep(1)
 
+def save_cache_snapshot():
+    try:
+        save_snapshot(config["cache_snapshot_file"], {"SET": param_cache, "SET_PERCENT": pc_param_cache}, subscribed_params)
+    except Exception as ex:
+        print("Error saving cache snapshot:", ex, flush=True)
+
+def restore_subscriptions(snapshot: dict):
+    # resubscribed when the nodes connect, which refreshes the cached values before the clients come back
+    if config["unsubscribe_delay_s"] == 0:
+        return # nothing would unsubscribe them if no client does
+    count = 0
+    for node, packets in snapshot.get("subscriptions", {}).items():
+        subscriptions = subscribed_params.get(node)
+        if subscriptions is None:
+            continue # node no longer in the config
+        for data in packets:
+            try:
+                msg_type, parameter = data
+                p = Packet.from_json({"type": msg_type, "parameter": parameter, "value": config["subscription_rate_ms"]})
+            except (DecodeFailed, TypeError, ValueError) as ex:
+                print("Failed to restore subscription:", ex, ":", data, flush=True)
+                continue
+            subscriptions.restore(subscription_key(p), p, unsubscribe_packet(p), config["cache_snapshot_grace_s"])
+            count += 1
+    print(f"Restored {count} subscriptions from cache snapshot", flush=True)
+
+def restore_param_cache(snapshot: dict):
+    # entries are restored invalid, so they are sent to subscribing clients but still resubscribed
+    count = 0
+    for msg_type, cache in (("SET", param_cache), ("SET_PERCENT", pc_param_cache)):
+        for data in snapshot.get("values", {}).get(msg_type, []):
+            try:
+                parameter, value = data
+                msg = json.dumps({"type": msg_type, "parameter": parameter, "value": value})
+            except (TypeError, ValueError) as ex:
+                print("Failed to restore cached value:", ex, ":", data, flush=True)
+                continue
+            cache.restore(parameter, CacheEntry(None, value, msg, ws_server.prepare_send_text(msg)))
+            count += 1
+    print(f"Restored {count} cached values from cache snapshot", flush=True)
+
+async def cache_snapshot_task():
+    global RUN_SERVER
+    if not config["cache_snapshot_file"]:
+        return
+    while RUN_SERVER:
+        await asyncio.sleep(config["cache_snapshot_interval_s"])
+        await asyncio.to_thread(save_cache_snapshot)
+
 def get_node_alias(n):
     global config
     # Return the alias or just the node id
@@ -610,11 +704,14 @@ def test_udp_receive(bind_ip, hiqnet_port, dest_ip):
 hiqnet_udp_thread = None
 hiqnet_tcp_server_thread = None
 hiqnet_tcp_threads = {}
+hiqnet_connection_manager = None
 broadcast_threads = {}
+batch_thread = None
+cache_snapshot_ready = False # only save once the caches have been restored
 UDP_NODE_ID = "UDP"
 TCP_NODE_ID = "TCP"
 async def main():
-    global config, ws_server, msg_queues, resp_queues, bc_queues, hiqnet_udp_thread, hiqnet_tcp_threads, broadcast_threads, subscribed_params, health_check_queue, stats_queue, RUN_SERVER
+    global config, ws_server, msg_queues, resp_queues, bc_queues, hiqnet_udp_thread, hiqnet_tcp_threads, hiqnet_connection_manager, broadcast_threads, batch_thread, subscribed_params, health_check_queue, stats_queue, cache_snapshot_ready, RUN_SERVER
     health_check_queue = Queue(50)
     stats_queue = Queue(50)
     msg_queues = {key: Queue(200) for key in config["nodes"].keys()}
@@ -622,7 +719,10 @@ async def main():
     bc_queues = {key: Queue(200) for key in config["nodes"].keys()}
     resp_queues[UDP_NODE_ID] = Queue(200)
     bc_queues[UDP_NODE_ID] = Queue(200)
-    subscribed_params = {key: list() for key in config["nodes"].keys()}
+    subscribed_params = {key: SubscriptionRegistry() for key in config["nodes"].keys()}
+    snapshot = load_snapshot(config["cache_snapshot_file"]) if config["cache_snapshot_file"] else None
+    if snapshot:
+        restore_subscriptions(snapshot)
 
     # check UDP works
     if not test_udp_receive("0.0.0.0", HIQNET_PORT, config["server_ip_address"]):
@@ -643,8 +743,10 @@ async def main():
     net = ipaddress.IPv4Network(config["server_ip_address"] + '/' + config["server_subnet_mask"], False)
     broadcast_address = str(net.broadcast_address)
 
+    # with a shared event loop all the node connections run as tasks on the connection manager thread
+    connection_type = HiQnetConnection if config["shared_event_loop"] else HiQnetThread
     hiqnet_tcp_threads = {
-        key: HiQnetThread(f"HiQnet {key} TCP Thread", get_node_alias(key), int(key, base=16), ip, HIQNET_PORT,msg_queues[key], resp_queues[key], subscribed_params[key], health_check_queue, disco_info)
+        key: connection_type(f"HiQnet {key} TCP Thread", get_node_alias(key), int(key, base=16), ip, HIQNET_PORT,msg_queues[key], resp_queues[key], subscribed_params[key], health_check_queue, disco_info)
         for key, ip in config["nodes"].items()}
     hiqnet_udp_thread = HiQnetUDPListenerThread("HiQnet UDP Thread", UDP_NODE_ID, "0.0.0.0", config["server_ip_address"], HIQNET_PORT, resp_queues[UDP_NODE_ID], health_check_queue, stats_queue, disco_info, broadcast_address)
     hiqnet_tcp_server_thread = HiQnetTCPListenerThread("HiQnet TCP Server Thread", TCP_NODE_ID, "0.0.0.0", config["server_ip_address"], HIQNET_PORT, health_check_queue, disco_info, VERSION)
@@ -660,28 +762,42 @@ async def main():
     # start udp thread first to receive initial messages
     hiqnet_udp_thread.start()
     hiqnet_tcp_server_thread.start()
-    for t in hiqnet_tcp_threads.values():
-        t.start()
+    if config["shared_event_loop"]:
+        hiqnet_connection_manager = HiQnetConnectionManager(list(hiqnet_tcp_threads.values()))
+        hiqnet_connection_manager.start()
+    else:
+        for t in hiqnet_tcp_threads.values():
+            t.start()
     print(f"Websocket server listening on ws://0.0.0.0:{config['websocket_port']}", flush=True)
     
     for node in config["nodes"]:
         asyncio.create_task(resp_broadcast(node))
     asyncio.create_task(resp_broadcast(UDP_NODE_ID))
 
-    ws_server = WebsocketServer(host="0.0.0.0", port=config["websocket_port"], proxy_ip_header=config['proxy_ip_header'], proxy_port_header=config['proxy_port_header'])
+    ws_server_cls = AsyncWebsocketServer if config["websocket_engine"] == "asyncio" else WebsocketServer
+    ws_server = ws_server_cls(host="0.0.0.0", port=config["websocket_port"], proxy_ip_header=config['proxy_ip_header'], proxy_port_header=config['proxy_port_header'],
+        deflate=config["websocket_deflate"], deflate_window_bits=config["websocket_deflate_window_bits"], deflate_level=config["websocket_deflate_level"])
     ws_server.set_fn_new_client(ws_on_connection_open)
     ws_server.set_fn_client_left(ws_on_connection_close)
     ws_server.set_fn_message_received(ws_on_data_receive)
+    ws_server.set_fn_binary_message_received(ws_on_binary_receive)
+    if snapshot:
+        restore_param_cache(snapshot)
+        snapshot = None
+    cache_snapshot_ready = True
     ws_server.run_forever(threaded=True)
+    batch_thread = threading.Thread(target=websocket_batch_thread, daemon=True)
+    batch_thread.start()
     health_task = asyncio.create_task(health_check())
     stats_task = asyncio.create_task(stats_check())
     unsubscribe_task = asyncio.create_task(unsubscribe_delay_task())
+    snapshot_task = asyncio.create_task(cache_snapshot_task())
     while RUN_SERVER:
         await asyncio.sleep(2)
         
-    for task in [health_task, unsubscribe_task, stats_task]:
+    for task in [health_task, unsubscribe_task, stats_task, snapshot_task]:
         task.cancel()
-    for task in [health_task, unsubscribe_task, stats_task]:
+    for task in [health_task, unsubscribe_task, stats_task, snapshot_task]:
         try:
             await task
         except asyncio.CancelledError:
@@ -691,11 +807,16 @@ def safe_shutdown_thread():
     if hiqnet_tcp_threads:
         for t in hiqnet_tcp_threads.values():
             t.exitFlag = True
-        for t in hiqnet_tcp_threads.values():
-            t.join()
+        if hiqnet_connection_manager:
+            hiqnet_connection_manager.join()
+        else:
+            for t in hiqnet_tcp_threads.values():
+                t.join()
     if broadcast_threads:
         for t in broadcast_threads.values():
             t.join()
+    if batch_thread:
+        batch_thread.join()
     if ws_server:
         ws_server.shutdown_gracefully()
         # should figure out how to get thread to exit, but thread is daemonized so will get killed when program exits
@@ -721,6 +842,9 @@ if __name__ == "__main__":
         asyncio.run(main())
     except KeyboardInterrupt:
         RUN_SERVER = False
+    finally:
+        if cache_snapshot_ready and config["cache_snapshot_file"]:
+            save_cache_snapshot()
     print("Exiting...")
 
     safe_shutdown_thread = threading.Thread(target=safe_shutdown_thread)
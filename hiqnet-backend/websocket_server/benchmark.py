@@ -0,0 +1,37 @@
+"""
+Micro-benchmarks for the websocket server, run with
+python -m websocket_server.benchmark
+"""
+import os
+import timeit
+
+from websocket_server.websocket_server import unmask_payload
+
+
+def unmask_bytewise(payload, masks):
+    # the per byte loop unmask_payload replaced
+    message_bytes = bytearray()
+    for message_byte in payload:
+        message_byte ^= masks[len(message_bytes) % 4]
+        message_bytes.append(message_byte)
+    return message_bytes
+
+
+def best_of(fn, number, repeat=5):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def benchmark_unmask():
+    print("Unmask payload:")
+    for size, name in [(10, "10 B"), (1024, "1 KB"), (1024 * 1024, "1 MB")]:
+        payload = os.urandom(size)
+        masks = os.urandom(4)
+        assert unmask_payload(payload, masks) == unmask_bytewise(payload, masks)
+        number = max(1, 100000 // size)
+        old = best_of(lambda: unmask_bytewise(payload, masks), number)
+        new = best_of(lambda: unmask_payload(payload, masks), number)
+        print(f"  {name:>5}: bytewise {old * 1e6:10.1f} us, unmask_payload {new * 1e6:8.1f} us ({old / new:.1f}x)")
+
+
+if __name__ == "__main__":
+    benchmark_unmask()
@@ -14,13 +14,45 @@ class Tabs extends React.Component {
     this.state = {connected: false};
     this.lasttab = 0;
     this.tab = 0;
+    this.resetBinaryIndex();
+  }
+
+  resetBinaryIndex() {
+    // parameter index table for binary updates, sent as BINARY_INDEX messages
+    this.binaryParams = [];
+    this.binaryIndices = {};
+  }
+
+  binaryRecord(msg) {
+    // (u16 index, i32 value) record for a SET, or null if it has to be sent as json
+    const index = this.binaryIndices[msg.type + " " + msg.parameter];
+    if (index === undefined || !Number.isInteger(msg.value) || msg.value < -2147483648 || msg.value > 2147483647) {
+      return null;
+    }
+    const record = new DataView(new ArrayBuffer(6));
+    record.setUint16(0, index);
+    record.setInt32(2, msg.value);
+    return record.buffer;
+  }
+
+  dispatchResult(result) {
+    if (result.type == "SET") {
+      const event = new CustomEvent('SWSET_' + result.parameter, { detail: result.value });
+      document.dispatchEvent(event);
+    } else if (result.type == "BINARY_INDEX") {
+      this.binaryParams[result.data.index] = result.data;
+      this.binaryIndices[result.data.type + " " + result.data.parameter] = result.data.index;
+    } else {
+      const event = new CustomEvent('soundweb_data', { detail: result });
+      document.dispatchEvent(event);
+    }
   }
 
   messageEvent(event) {
     document.ws = this.websocket;
 
     if (this.websocket?.readyState() == 1) { // Connected
-      const result = this.websocket.sendMessage(JSON.stringify(event.detail));
+      const result = this.websocket.sendMessage(this.binaryRecord(event.detail) ?? JSON.stringify(event.detail));
       if (this.state.connected !== result) {
         this.setState({connected: result})
       }
@@ -52,17 +84,27 @@ class Tabs extends React.Component {
     this.websocket = new WebSocket({
       url: this.props.websocket,
       onMessage: (data) => {
-        let result = JSON.parse(data);
-        if (result.type == "SET") {
-          const event = new CustomEvent('SWSET_' + result.parameter, { detail: result.value });
-          document.dispatchEvent(event);
-        } else {
-          const event = new CustomEvent('soundweb_data', { detail: result });
-          document.dispatchEvent(event);
+        if (data instanceof ArrayBuffer) {
+          // binary updates are (u16 index, i32 value) records
+          const view = new DataView(data);
+          for (let offset = 0; offset + 6 <= view.byteLength; offset += 6) {
+            const param = this.binaryParams[view.getUint16(offset)];
+            if (param) {
+              this.dispatchResult({type: param.type, parameter: param.parameter, value: view.getInt32(offset + 2)});
+            }
+          }
+          return;
+        }
+        const data_json = JSON.parse(data);
+        // batched updates arrive as an array of messages
+        const results = Array.isArray(data_json) ? data_json : [data_json];
+        for (const result of results) {
+          this.dispatchResult(result);
         }
       },
       // Dirty hack to use correct context in callback
       onOpen: (() => {
+        this.resetBinaryIndex();
         this.websocketConnected();
         this.setState({connected: true});
       }).bind(this),
@@ -75,6 +117,8 @@ class Tabs extends React.Component {
       reconnect: true,
       debug: true,
       use_auth: true,
+      // phones get fewer updates per second than desktops
+      options: {batch: true, binary: true, rate: window.matchMedia("(pointer: coarse)").matches ? 10 : 30},
       reconnectIntervalInMilliSeconds: 5000 // Auto reconnect after 5 seconds
     });
     this.websocket.connect();
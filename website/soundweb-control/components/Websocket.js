@@ -39,6 +39,7 @@ class WebSocket {
 
   setupWebsocket(auth_token) {
     let websocket = new W3CWebSocket(this.props.url);
+    websocket.binaryType = 'arraybuffer';
     this.ws = websocket;
     if (this.ws_test) {
       clearInterval(this.ws_test);
@@ -11,8 +11,14 @@ export default withSessionRoute(
       return;
     }
     const safe_options = {
-      statusonly: !!options?.statusonly
+      statusonly: !!options?.statusonly,
+      batch: !!options?.batch,
+      binary: !!options?.binary
     };
+    // updates per second for batched clients
+    if (Number.isFinite(options?.rate) && options.rate > 0) {
+      safe_options.rate = options.rate;
+    }
 
     // admin is checked per command on backend so statusonly is safe for regular users
 